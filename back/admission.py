@@ -0,0 +1,246 @@
+"""
+Adaptive admission control for the prediction endpoints.
+
+Each worker process admits at most `limit` predictions at once. The limit
+adapts AIMD-style to the latency of the predictions it lets through,
+counting only the backend work (segmentation plus analysis) of those that
+succeeded after running both: upload time, cache hits, degraded runs and
+errors say nothing about backend capacity, so they are left out. It
+grows by about one per `limit` completions while requests keep finishing
+close to their long-run latency (by one per completion until the first
+cut, so a fresh worker finds its level quickly), and is cut by `backoff`
+when the recent latency (a fast moving average) runs `tolerance` times
+over the long-run one (a slow moving average), i.e. when adding work has
+started to slow everything down. At most one cut is made per
+recent-latency interval, so one congested batch finishing doesn't
+collapse the limit.
+
+Requests over the limit wait in a short queue. When the queue is full they
+are refused at once with 429, and when their deadline passes while queued
+with 503; both carry Retry-After, estimated from the queue and the recent
+latency. Refusing fast keeps gunicorn threads free and memory flat instead
+of letting every request time out.
+
+When U2NetP is backed up (the estimated wait for a session or segmentation
+worker is over ADMISSION_DEGRADE_SECONDS), pipelines skip background
+removal and send the whole picture to the vision model (see
+should_skip_segmentation).
+
+Configuration (environment):
+  ADMISSION_CONTROL           on or off (default on)
+  ADMISSION_INITIAL_LIMIT     concurrent predictions to start with (default 4)
+  ADMISSION_MIN_LIMIT         floor for the limit (default 1)
+  ADMISSION_MAX_LIMIT         ceiling for the limit (default 16)
+  ADMISSION_QUEUE             requests that may wait for a slot (default 8)
+  ADMISSION_QUEUE_TIMEOUT     seconds a request may wait (default 2)
+  ADMISSION_TOLERANCE         recent / long-run latency ratio counted as congestion (default 2)
+  ADMISSION_DEGRADE_SECONDS   session backlog that turns on degraded mode (default 1; 0 = never)
+"""
+import math
+import os
+import threading
+import time
+
+from metrics import REGISTRY, STAGE_SECONDS
+
+SHED = REGISTRY.counter(
+    'admission_shed_total', 'Prediction requests refused by admission control, by reason (queue_full, queue_timeout)')
+DEGRADED = REGISTRY.counter(
+    'admission_degraded_total', 'Predictions that skipped background removal because segmentation was backed up')
+
+# Latency moving averages: recent reacts within a few requests, long-run over a few hundred
+RECENT_WEIGHT = 0.2
+LONG_RUN_WEIGHT = 0.01
+# Completions seen before the latency signal is trusted
+MIN_SAMPLES = 10
+MAX_RETRY_AFTER = 30
+
+
+class Overloaded(Exception):
+    """A request was refused; `status` is 429 or 503"""
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    An admitted request holding `weight` slots; release() it when the response is done. Set
+    `sample` to the seconds of backend work the request took to feed the
+    latency signal; released without one, it only frees its slot.
+    """
+
+    def __init__(self, controller, weight=1):
+        self.controller = controller
+        self.weight = weight
+        self.sample = None
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.controller._release(self.sample, self.weight)
+
+
+class AdmissionController:
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=16, max_queue=8, queue_timeout=2.0,
+                 tolerance=2.0, backoff=0.8):
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial_limit)))
+        self.max_queue = int(max_queue)
+        self.queue_timeout = float(queue_timeout)
+        self.tolerance = float(tolerance)
+        self.backoff = float(backoff)
+
+        self.in_flight = 0
+        self.queued = 0
+        self._recent = None  # seconds per request, fast average
+        self._long_run = None  # seconds per request, slow average
+        self._samples = 0
+        self._last_decrease = 0.0
+        self._slow_start = True  # until the first decrease
+        self._stats = {'admitted': 0, 'queued': 0, 'shed': 0, 'increases': 0, 'decreases': 0}
+        self._cond = threading.Condition()
+
+    def _has_room(self, weight=1):
+        # A request heavier than the whole limit gets in once the worker is idle
+        return self.in_flight == 0 or self.in_flight + weight <= int(self.limit)
+
+    def acquire(self, weight=1):
+        """
+        Admit a request, waiting up to queue_timeout for `weight` slots (a
+        batch running that many analyses at once); raises Overloaded
+        """
+        start = time.perf_counter()
+        with self._cond:
+            # Waiting requests go first, so a new arrival doesn't take the slot just freed for them
+            if not self._has_room(weight) or self.queued:
+                if self.queued >= self.max_queue:
+                    self._shed('queue_full')
+                    raise Overloaded(429, 'Too many requests are waiting, please retry shortly',
+                                     self.retry_after())
+                self.queued += 1
+                self._stats['queued'] += 1
+                deadline = start + self.queue_timeout
+                try:
+                    while not self._has_room(weight):
+                        remaining = deadline - time.perf_counter()
+                        if remaining <= 0:
+                            self._shed('queue_timeout')
+                            raise Overloaded(503, 'The server is busy, please retry shortly', self.retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.in_flight += weight
+            self._stats['admitted'] += 1
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage='admission_wait')
+        return Ticket(self, weight)
+
+    def _shed(self, reason):
+        # Called with the condition held
+        self._stats['shed'] += 1
+        SHED.inc(reason=reason)
+
+    def _release(self, seconds, weight=1):
+        with self._cond:
+            self.in_flight -= weight
+            if seconds is not None:
+                self._update_limit(seconds)
+            # Waiters need different numbers of slots, so each re-checks its own
+            self._cond.notify_all()
+
+    def _update_limit(self, seconds):
+        if self._recent is None:
+            self._recent = self._long_run = seconds
+        else:
+            self._recent += RECENT_WEIGHT * (seconds - self._recent)
+            self._long_run += LONG_RUN_WEIGHT * (seconds - self._long_run)
+        self._samples += 1
+        if self._samples < MIN_SAMPLES:
+            return
+
+        now = time.monotonic()
+        if self._recent > self.tolerance * self._long_run:
+            if now - self._last_decrease >= self._recent:
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                self._last_decrease = now
+                self._slow_start = False
+                self._stats['decreases'] += 1
+        elif self.in_flight + 1 >= self.limit / 2:
+            # Only grow a limit that is actually being used
+            previous = int(self.limit)
+            step = 1.0 if self._slow_start else 1 / self.limit
+            self.limit = min(float(self.max_limit), self.limit + step)
+            if int(self.limit) > previous:
+                self._stats['increases'] += 1
+
+    def retry_after(self):
+        """Seconds until a slot is likely to free up"""
+        per_request = self._recent or 1.0
+        waiting = self.queued + 1
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(per_request * waiting / max(1, int(self.limit)))))
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'recent_seconds': round(self._recent, 3) if self._recent is not None else None,
+                'long_run_seconds': round(self._long_run, 3) if self._long_run is not None else None,
+            })
+        return stats
+
+
+def should_skip_segmentation():
+    """
+    True when a new request would wait more than ADMISSION_DEGRADE_SECONDS
+    for a U2NetP session; the caller then goes without background removal.
+    """
+    threshold = float(os.getenv('ADMISSION_DEGRADE_SECONDS', '1'))
+    if not threshold or get_admission_controller() is None:
+        return False
+    from segmentation_service import get_segmenter
+    if get_segmenter().backlog_seconds() <= threshold:
+        return False
+    DEGRADED.inc()
+    return True
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # In-flight counts belong to the parent
+    global _controller, _controller_lock
+    _controller = None
+    _controller_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_admission_controller():
+    """The process-wide controller, or None when ADMISSION_CONTROL=off"""
+    global _controller
+    if os.getenv('ADMISSION_CONTROL', 'on').lower() in ('off', 'false'):
+        return None
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController(
+                    initial_limit=int(os.getenv('ADMISSION_INITIAL_LIMIT', '4')),
+                    min_limit=int(os.getenv('ADMISSION_MIN_LIMIT', '1')),
+                    max_limit=int(os.getenv('ADMISSION_MAX_LIMIT', '16')),
+                    max_queue=int(os.getenv('ADMISSION_QUEUE', '8')),
+                    queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '2')),
+                    tolerance=float(os.getenv('ADMISSION_TOLERANCE', '2')),
+                )
+    return _controller
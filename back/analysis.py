@@ -0,0 +1,258 @@
+"""
+Vision-model analysis for the API: turns an image into a spirit animal match.
+"""
+import os
+import asyncio
+import base64
+import time
+from contextlib import aclosing
+import openai_client
+import prompts
+from hedging import get_hedge_policy, run_hedged
+from metrics import REGISTRY, STAGE_SECONDS, OPENAI_ATTEMPT_SECONDS, VALIDATION_FAILURES, FALLBACKS
+from animal_analyzer import extract_and_validate_animal, early_animal, normalize_animal_name, with_dataset_animal
+
+MAX_ATTEMPTS = 3
+
+STREAM_CANCELLED = REGISTRY.counter(
+    'openai_stream_cancelled_total', 'Streamed vision attempts abandoned before the reply finished, by reason')
+
+# Explanations for labels chosen by the local classifier, when LOCAL_EXPLAIN_CACHE is on
+_explanations = {}
+
+async def explain_animal_async(animal: str):
+    """
+    Text-only call that writes the Explanation/Connection for an animal that
+    was already chosen locally. Uses the smaller LOCAL_EXPLAIN_MODEL
+    (default gpt-4o-mini); with LOCAL_EXPLAIN_CACHE=true one explanation per
+    animal is reused. Returns None on failure so the caller can fall back to
+    the vision call.
+    """
+    use_cache = os.getenv('LOCAL_EXPLAIN_CACHE', 'false').lower() == 'true'
+    if use_cache and animal in _explanations:
+        return _explanations[animal]
+    
+    request = prompts.explain_request(animal, os.getenv('LOCAL_EXPLAIN_MODEL', 'gpt-4o-mini'))
+    try:
+        with STAGE_SECONDS.time(stage='explain'):
+            response = await openai_client.create_chat_completion(**request)
+        text = response.choices[0].message.content
+    except Exception as e:
+        print(f"Warning: Explanation call failed, falling back to vision: {e}")
+        return None
+    
+    if 'response_format' in request:
+        result = prompts.parse_reply(text, animal=animal)
+        if result is None:
+            return None
+        if use_cache:
+            _explanations[animal] = result
+        return result
+    
+    if not text or 'sorry' in text.lower():
+        return None
+    # Keep our label even if the model restates one
+    lines = [line for line in text.strip().split('\n') if 'animal:' not in line.lower()]
+    result = f"**animal:** {animal}\n" + '\n'.join(lines)
+    if use_cache:
+        _explanations[animal] = result
+    return result
+
+async def _stream_reply(request, on_label=None, on_delta=None):
+    """
+    Stream one vision reply, checking the animal line as soon as it is complete.
+    Structured (JSON) replies are rendered to the markdown layout as they
+    arrive, so callers see the same text either way.
+    Returns (text, animal, reason):
+      - animal is set once a valid label was committed; on_label(animal) has
+        then been called and every later delta passed to on_delta, and the
+        text's animal line names it
+      - reason is 'sorry' or 'invalid' if the stream was cancelled early
+      - both are None if the reply ended without a finished animal line
+    """
+    reply = prompts.StreamingReply() if 'response_format' in request else None
+    text = ''
+    animal = None
+    start = time.perf_counter()
+    async with aclosing(openai_client.stream_chat_completion(**request)) as deltas:
+        async for delta in deltas:
+            if reply is not None:
+                delta = reply.feed(delta)
+            text += delta
+            if animal is not None:
+                if on_delta and delta:
+                    on_delta(delta)
+                continue
+            if reply is not None:
+                if reply.animal is None:
+                    continue
+                found, label = True, normalize_animal_name(reply.animal)
+            elif 'sorry' in text.lower():
+                return text, None, 'sorry'
+            else:
+                found, label = early_animal(text)
+            if not found:
+                continue
+            if label is None:
+                return text, None, 'invalid'
+            # Commit: this attempt's label stands, the rest is explanation. The
+            # text says the committed name too, so the label event, the deltas
+            # and the final result agree
+            animal = label
+            text = with_dataset_animal(text, animal)
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage='first_label')
+            if on_label:
+                on_label(animal)
+            if on_delta:
+                on_delta(text)
+    if reply is not None:
+        # The whole reply, rendered from the parsed JSON
+        text = reply.finish()
+        if animal is not None:
+            text = with_dataset_animal(text, animal)
+    return text, animal, None
+
+async def analyze_animal_async(image_bytes: bytes, mime_type: str = 'image/jpeg', known_animal: str = None,
+                               on_label=None, on_delta=None):
+    """
+    Modified version of analyze_animal that returns the result instead of printing.
+    Takes the encoded image straight from memory and runs on the shared client loop.
+    Retries up to 3 times, with jittered backoff, if the response contains 'sorry',
+    if animal validation fails or if the API call hit a transient error.
+    With OPENAI_HEDGE set, slow attempts are hedged with extra ones (see
+    hedging.py); hedges count against the same 3-attempt budget.
+    If `known_animal` was already picked by the local classifier, only the
+    text-only explanation is requested.
+
+    With OPENAI_STREAM on (the default) replies are streamed: an attempt is
+    cancelled as soon as its animal line turns out invalid or it apologises,
+    and a valid label is handed to on_label(animal) while the explanation is
+    still generating (its text then arrives through on_delta(text)).
+    Callbacks run on the client loop and must not block.
+
+    With OPENAI_STRUCTURED_OUTPUT on (the default) the label is constrained
+    to the dataset by the response schema, so validation retries only
+    happen with servers that don't enforce it; the reply is still returned
+    in the markdown layout (see prompts.py).
+    """
+    # Load API Key from environment variable
+    api_key = os.getenv('OPENAI_API_KEY')
+    if not api_key:
+        return "Error: OPENAI_API_KEY environment variable not set"
+    
+    if known_animal:
+        result = await explain_animal_async(known_animal)
+        if result is not None:
+            if on_label:
+                on_label(known_animal)
+            if on_delta:
+                on_delta(result)
+            return result
+    
+    if not image_bytes:
+        return "Error: Image is empty"
+    
+    with STAGE_SECONDS.time(stage='base64'):
+        base64_image = base64.b64encode(image_bytes).decode('utf-8')
+    
+    # Static instructions and schema first, the image last (see prompts.py)
+    vision_request = prompts.vision_request(f"data:{mime_type};base64,{base64_image}")
+    structured = 'response_format' in vision_request
+    stream = os.getenv('OPENAI_STREAM', 'true').lower() == 'true'
+    
+    async def attempt(number, on_label, on_delta):
+        """One vision attempt: returns (text, 'ok' | 'retry' | 'fatal')"""
+        attempt_start = time.perf_counter()
+        outcome = 'error'
+        try:
+            if stream:
+                result, animal_name, cancelled = await _stream_reply(vision_request, on_label, on_delta)
+                if animal_name is not None:
+                    outcome = 'ok'
+                    return result, 'ok'
+                if cancelled:
+                    outcome = 'cancelled'
+                    STREAM_CANCELLED.inc(reason=cancelled)
+                    VALIDATION_FAILURES.inc()
+                    return result, 'retry'
+            else:
+                response = await openai_client.create_chat_completion(**vision_request)
+                result = response.choices[0].message.content
+                if structured:
+                    result = prompts.parse_reply(result) or result
+            
+            # Validate the animal name from the response
+            with STAGE_SECONDS.time(stage='validate'):
+                animal_name, is_valid, _ = extract_and_validate_animal(result)
+            
+            # If response doesn't contain 'sorry' and animal is valid, return the result
+            # (structured replies refuse through a separate field, not the text)
+            if result and (structured or 'sorry' not in result.lower()) and is_valid:
+                outcome = 'ok'
+                # The frontend reads the label from the text; make it the one we resolved
+                result = with_dataset_animal(result, animal_name)
+                on_label(animal_name)
+                on_delta(result)
+                return result, 'ok'
+            outcome = 'invalid'
+            VALIDATION_FAILURES.inc()
+            return result, 'retry'
+        except asyncio.CancelledError:
+            outcome = 'lost'  # Another attempt answered first
+            raise
+        except openai_client.transient_errors() as e:
+            return f"Error calling OpenAI API: {e}", 'retry'
+        except Exception as e:
+            return f"Error calling OpenAI API: {e}", 'fatal'  # Don't retry on permanent API errors
+        finally:
+            OPENAI_ATTEMPT_SECONDS.observe(time.perf_counter() - attempt_start,
+                                           attempt=str(number + 1), outcome=outcome)
+    
+    last_response, won = await run_hedged(attempt, MAX_ATTEMPTS, get_hedge_policy(), openai_client.backoff_delay,
+                                          on_label, on_delta)
+    if won:
+        return last_response
+    
+    # If we get here, either all attempts failed or animal validation failed
+    # Return a fallback response with a default animal
+    if last_response and 'Error:' not in last_response:
+        # Try to extract and fix the animal name
+        animal_name, is_valid, original_response = extract_and_validate_animal(last_response)
+        if not is_valid and animal_name is None:
+            # If no valid animal found, use a default
+            fallback_response = f"""**animal:** cat
+**Explanation:** Based on the image analysis, this vibe represents a {animal_name or 'mysterious'} energy.
+**Connection:** 
+- The visual elements suggest a {animal_name or 'unique'} personality
+- This animal best captures the essence of the image
+- The connection reflects the overall aesthetic and mood"""
+            FALLBACKS.inc()
+            if on_label:
+                on_label('cat')
+            if on_delta:
+                on_delta(fallback_response)
+            return fallback_response
+    
+    return last_response
+
+def analyze_animal_bytes(image_bytes: bytes, mime_type: str = 'image/jpeg', known_animal: str = None):
+    """
+    Blocking wrapper around analyze_animal_async for sync callers
+    """
+    return openai_client.run(analyze_animal_async(image_bytes, mime_type, known_animal))
+
+def analyze_animal_api(image_path: str):
+    """
+    File-path wrapper around analyze_animal_bytes
+    """
+    # Check and encode image
+    if not os.path.exists(image_path):
+        return "Error: Image file not found"
+    
+    try:
+        with open(image_path, "rb") as image_file:
+            image_bytes = image_file.read()
+    except Exception as e:
+        return f"Error reading image: {e}"
+    
+    return analyze_animal_bytes(image_bytes)
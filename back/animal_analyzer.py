@@ -1,6 +1,7 @@
 import os
+import re
 import base64
-from openai import OpenAI
+from typing import NamedTuple, Optional
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -35,82 +36,262 @@ AVAILABLE_ANIMALS = {
     'dinosaur'
 }
 
+# Common variations the model writes instead of the exact dataset name
+ANIMAL_VARIATIONS = {
+    'bear': ['grizzly', 'polar_bear', 'teddy_bear', 'grizzly_bear', 'brown_bear', 'black_bear'],
+    'koala': ['koala_bear'],
+    'leopard': ['snow_leopard'],
+    'fox': ['red_fox', 'arctic_fox'],
+    'bat': ['flying_fox'],
+    'eagle': ['bald_eagle'],
+    'turtle': ['sea_turtle', 'tortoise'],
+    'whale': ['killer_whale', 'orca'],
+    'lizard': ['bearded_dragon', 'komodo_dragon'],
+    'cat': ['kitten', 'kitty', 'tiger_cat'],
+    'dog': ['puppy', 'pup', 'hound'],
+    'mouse': ['mice'],
+    'ox': ['oxen'],
+    'octopus': ['octopi'],
+    'horse': ['pony', 'stallion', 'mare'],
+    'rabbit': ['bunny', 'hare'],
+    'honeybee': ['bee', 'bumblebee', 'honey_bee'],
+    'tropical_fish': ['clownfish', 'clown_fish', 'goldfish'],
+    'blowfish': ['pufferfish', 'puffer_fish'],
+    'hippopotamus': ['hippo'],
+    'rhinoceros': ['rhino'],
+    'dinosaur': ['t-rex', 'trex', 't_rex'],
+}
+
+def _plural_forms(name):
+    if name.endswith(('s', 'sh', 'ch', 'x')):
+        return [name + 'es']
+    if name.endswith('y') and name[-2:-1] not in 'aeiou':
+        return [name[:-1] + 'ies']
+    if name.endswith('f'):
+        return [name + 's', name[:-1] + 'ves']
+    return [name + 's']
+
+def _build_alias_index():
+    index = {}
+    for animal in AVAILABLE_ANIMALS:
+        for alias in [animal] + ANIMAL_VARIATIONS.get(animal, []):
+            index.setdefault(alias, animal)
+            for plural in _plural_forms(alias):
+                index.setdefault(plural, animal)
+    return index
+
+# alias (lowercase, underscores for spaces) -> dataset name
+ALIAS_INDEX = _build_alias_index()
+
+# Two-word names of animals outside the dataset whose words name one inside it;
+# "sea lion" is not a lion
+OTHER_ANIMALS = {
+    'sea_lion', 'mountain_lion', 'guinea_pig', 'prairie_dog', 'red_panda', 'sea_cow',
+    'sea_horse', 'jelly_fish', 'star_fish', 'ant_eater', 'sea_dragon',
+}
+_OTHER_ANIMAL_INDEX = OTHER_ANIMALS | {plural for name in OTHER_ANIMALS for plural in _plural_forms(name)}
+
+MAX_EDIT_DISTANCE = 2
+# Short names are a letter away from other animals (hog/dog, gnat/goat, moose/mouse),
+# and 6-8 letter ones two letters away (beaver/bear, hornet/horse); only typo-correct
+# names long enough that a slip can't land on a different animal
+MIN_FUZZY_LENGTH = 6
+LONG_NAME_LENGTH = 9
+
+def _deletions(word, depth):
+    """Every string reachable from word by deleting up to `depth` characters"""
+    variants = {word}
+    frontier = {word}
+    for _ in range(depth):
+        frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+        variants |= frontier
+    return variants
+
+def _build_deletion_index():
+    # Symmetric-delete index: two words within edit distance d share a
+    # deletion variant of depth <= d, so fuzzy lookups only verify a handful
+    # of candidates instead of scanning the vocabulary
+    index = {}
+    for alias in ALIAS_INDEX:
+        for variant in _deletions(alias, MAX_EDIT_DISTANCE):
+            index.setdefault(variant, set()).add(alias)
+    return index
+
+_DELETION_INDEX = _build_deletion_index()
+
+# Answers longer than this are sentences, not names; don't mine them for words
+MAX_NAME_WORDS = 3
+
+_SEPARATORS = re.compile(r'[\s\-]+')
+_NON_NAME = re.compile(r'[^a-z_]')
+
+def _edit_distance(a, b, limit):
+    """Edit distance counting an adjacent swap as one edit, giving up early once it exceeds limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                distance = min(distance, before[j - 2] + 1)
+            current.append(distance)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+def _fuzzy_match(token):
+    """Closest alias within 1 edit (2 for long names), if it is unambiguous; short names must match exactly"""
+    if len(token) < MIN_FUZZY_LENGTH:
+        return None
+    limit = 1 if len(token) < LONG_NAME_LENGTH else MAX_EDIT_DISTANCE
+    best, best_distance, tied = None, limit + 1, False
+    candidates = set()
+    for variant in _deletions(token, limit):
+        candidates |= _DELETION_INDEX.get(variant, set())
+    for alias in sorted(candidates):
+        distance = _edit_distance(token, alias, limit)
+        if distance < best_distance:
+            best, best_distance, tied = ALIAS_INDEX[alias], distance, False
+        elif distance == best_distance and best is not None and ALIAS_INDEX[alias] != best:
+            tied = True
+    return best if best is not None and not tied else None
+
+def _resolve(token):
+    if token in ALIAS_INDEX:
+        return ALIAS_INDEX[token]
+    # Plural stemming for names outside the index
+    for suffix, replacement in (('ies', 'y'), ('ves', 'f'), ('es', ''), ('s', '')):
+        if token.endswith(suffix) and token[:-len(suffix)] + replacement in ALIAS_INDEX:
+            return ALIAS_INDEX[token[:-len(suffix)] + replacement]
+    return None
+
 def normalize_animal_name(animal_name):
     """
     Normalize animal name to match the dataset exactly.
+    Resolves through the alias index (variations, plurals and two-word names
+    like "koala bear"), then tries the individual words ("majestic lion"),
+    then fuzzy matching for typos. Answers naming two dataset animals ("cat
+    or dog") or a different animal ("sea lion") don't resolve.
     Returns the normalized name if found, otherwise returns None.
     """
     if not animal_name:
         return None
     
-    # Convert to lowercase and remove extra whitespace
-    normalized = animal_name.lower().strip()
-    
-    # Direct match
-    if normalized in AVAILABLE_ANIMALS:
-        return normalized
+    # Convert to lowercase, join words with underscores and drop punctuation
+    normalized = _NON_NAME.sub('', _SEPARATORS.sub('_', animal_name.lower().strip()))
+    normalized = normalized.strip('_')
+    if not normalized:
+        return None
     
-    # Handle common variations
-    variations = {
-        'tiger': ['tiger', 'tigers'],
-        'lion': ['lion', 'lions'],
-        'elephant': ['elephant', 'elephants'],
-        'bear': ['bear', 'bears', 'grizzly', 'polar_bear'],
-        'cat': ['cat', 'cats', 'kitten', 'kitty'],
-        'dog': ['dog', 'dogs', 'puppy', 'pup'],
-        'fox': ['fox', 'foxes'],
-        'wolf': ['wolf', 'wolves'],
-        'deer': ['deer', 'deers'],
-        'horse': ['horse', 'horses', 'pony'],
-        'bird': ['bird', 'birds'],
-        'fish': ['fish', 'fishes'],
-        'butterfly': ['butterfly', 'butterflies'],
-        'dragon': ['dragon', 'dragons'],
-        'unicorn': ['unicorn', 'unicorns'],
-        'dinosaur': ['dinosaur', 'dinosaurs', 't-rex', 'trex']
-    }
+    match = _resolve(normalized)
+    if match:
+        return match
+    if normalized in _OTHER_ANIMAL_INDEX:
+        return None
     
-    for standard_name, variants in variations.items():
-        if normalized in variants and standard_name in AVAILABLE_ANIMALS:
-            return standard_name
+    words = [word for word in normalized.split('_') if word]
+    if len(words) > MAX_NAME_WORDS:
+        return None
+    # A two-word name inside a longer answer ("majestic koala bear", "baby sea lion")
+    for pair in map('_'.join, zip(words, words[1:])):
+        if pair in _OTHER_ANIMAL_INDEX:
+            return None
+        match = _resolve(pair)
+        if match:
+            return match
+    # Then single words ("majestic lion"), as long as they agree on one animal
+    named = {_resolve(word) for word in words} - {None}
+    if len(named) > 1:
+        return None
+    if named:
+        return named.pop()
     
-    return None
+    return _fuzzy_match(normalized) or (len(words) > 1 and _fuzzy_match(words[-1])) or None
 
-def extract_and_validate_animal(response_text):
+class AnimalResponse(NamedTuple):
+    animal: Optional[str]       # dataset name, or None if it couldn't be resolved
+    is_valid: bool
+    raw_animal: Optional[str]   # what the model actually wrote
+    explanation: Optional[str]
+    connection: Optional[str]
+    response: Optional[str]
+
+# "**animal:** lion", "Animal: lion", "- **Spirit Animal**: lion", ...
+_FIELD = re.compile(
+    r'^[^\n:]*?\b(animal|explanation|connection)\b[ \t*_]*:[ \t*_]*(.*)$',
+    re.IGNORECASE | re.MULTILINE,
+)
+
+def _clean_value(value):
+    return value.replace('**', '').replace('*', '').strip().strip('[]').strip(' .!')
+
+def parse_response(response_text):
     """
-    Extract animal name from response and validate it against the dataset.
-    Returns (animal_name, is_valid, original_response)
+    Single pass over the response: pulls out the animal, Explanation and
+    Connection fields and resolves the animal against the dataset.
     """
     if not response_text:
-        return None, False, response_text
+        return AnimalResponse(None, False, None, None, None, response_text)
     
-    # Try to extract animal name from the response
-    lines = response_text.split('\n')
-    animal_name = None
-    
-    for line in lines:
-        line = line.strip()
-        # Look for patterns like "**animal:** lion" or "animal: lion"
-        if '**animal:**' in line.lower() or 'animal:' in line.lower():
-            # Extract the animal name after the colon
-            parts = line.split(':', 1)
-            if len(parts) > 1:
-                animal_name = parts[1].strip()
-                # Remove any remaining markdown formatting
-                animal_name = animal_name.replace('**', '').replace('*', '').strip()
-                break
+    fields = {}
+    matches = list(_FIELD.finditer(response_text))
+    for i, match in enumerate(matches):
+        name = match.group(1).lower()
+        if name in fields:
+            continue
+        if name == 'animal':
+            fields[name] = _clean_value(match.group(2))
+        else:
+            # Multi-line fields run until the next field (or the end)
+            end = matches[i + 1].start() if i + 1 < len(matches) else len(response_text)
+            fields[name] = (match.group(2) + response_text[match.end():end]).strip()
     
+    raw_animal = fields.get('animal')
     # If no structured format found, try to extract from first line
-    if not animal_name and lines:
-        first_line = lines[0].strip()
-        # Remove markdown formatting
-        first_line = first_line.replace('**', '').replace('*', '').strip()
-        animal_name = first_line
-    
-    # Normalize the animal name
-    normalized_name = normalize_animal_name(animal_name)
+    if not raw_animal:
+        raw_animal = _clean_value(response_text.split('\n', 1)[0])
     
-    return normalized_name, normalized_name is not None, response_text
+    animal = normalize_animal_name(raw_animal)
+    return AnimalResponse(animal, animal is not None, raw_animal,
+                          fields.get('explanation'), fields.get('connection'), response_text)
+
+def with_dataset_animal(response_text, animal):
+    """
+    The response with its animal line rewritten to the dataset name, so what
+    the frontend reads from the text is the label the server resolved.
+    Without an animal field the first line is the one replaced.
+    """
+    line = f"**animal:** {animal}"
+    for match in _FIELD.finditer(response_text):
+        if match.group(1).lower() == 'animal':
+            return response_text[:match.start()] + line + response_text[match.end():]
+    _, newline, rest = response_text.partition('\n')
+    return line + newline + rest
+
+def early_animal(partial_text):
+    """
+    Check a reply that is still streaming for a finished animal line.
+    Returns (found, animal): found stays False until the line holding the
+    animal field has ended; animal is None if that name isn't in the dataset.
+    """
+    for match in _FIELD.finditer(partial_text):
+        if match.group(1).lower() != 'animal':
+            continue
+        if match.end() == len(partial_text):
+            return False, None  # The line may still be growing
+        return True, normalize_animal_name(_clean_value(match.group(2)))
+    return False, None
+
+def extract_and_validate_animal(response_text):
+    """
+    Extract animal name from response and validate it against the dataset.
+    Returns (animal_name, is_valid, original_response)
+    """
+    parsed = parse_response(response_text)
+    return parsed.animal, parsed.is_valid, response_text
 
 # --- CONFIGURATION ---
 # 1. SET YOUR IMAGE FILE PATH HERE
@@ -129,6 +310,7 @@ def analyze_animal(image_path: str):
         return
 
     # Initialize OpenAI client
+    from openai import OpenAI
     client = OpenAI(api_key=api_key)
 
     # --- 2. Check and Encode Image ---
@@ -143,56 +325,22 @@ def analyze_animal(image_path: str):
         print(f"❌ Bummer! Had trouble reading that image: {e}. Is it a valid picture?")
         return
 
-    # --- 3. Define the Prompt ---
-    # This prompt is designed to be punchy, fun, and directly lead to an entertaining spirit animal match.
-
-    # Format the available animals for the prompt
-    available_animals_text = """
-    leopard, lion, tiger, elephant, panda, bear, koala, gorilla, orangutan, dog, poodle, wolf, fox, raccoon, cat, cow, ox, buffalo, pig, boar, goat, sheep, ram, deer, horse, zebra, giraffe, camel, llama, hippopotamus, rhinoceros, kangaroo, bat, mouse, rat, rabbit, chipmunk, hedgehog,chick, rooster, chicken, turkey, duck, swan, eagle, dove, flamingo, peacock, parrot, penguin,fish, tropical_fish, blowfish, shark, whale, seal, octopus, crab, lobster, shrimp, squid,snail, butterfly, bug, ant, honeybee, cricket, spider, scorpion, mosquito,turtle, crocodile, lizard, snake, frog,dragon, unicorn,dinosaur
-    """
-
-    prompt = f"""
-VIBE ANIMAL MATCH
-
-What animal best represents this energy and style? You MUST choose from the following predefined animals only:
-
-{available_animals_text}
-
-Please respond in the following format:
-
-**animal:** [ANIMAL_NAME_FROM_THE_LIST_ABOVE]
-**Explanation:** [Explanation of the vibe represented by the input]
-**Connection:** [With simplified bullet points, Connection of the vibe and visual elements to the chosen animal. Elaborate on why this animal *feels right* for this aesthetic.]
-
-IMPORTANT: You must choose an animal name that exactly matches one from the list above. Do not use variations or similar names.
-"""
+    # --- 3. Build the Request ---
+    # Same prompt, animal list and response schema as the API (see prompts.py)
+    import prompts
+    request = prompts.vision_request(f"data:image/jpeg;base64,{base64_image}")
 
     # --- 4. Call the OpenAI API ---
     print(f"✨ Matching the vibe for: {os.path.basename(image_path)}...")
     print("=" * 50)
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=300 # Reduced tokens for shorter, snappier responses
-        )
+        response = client.chat.completions.create(**request)
 
         # --- 5. Print the Result ---
         analysis_result = response.choices[0].message.content
+        if 'response_format' in request:
+            analysis_result = prompts.parse_reply(analysis_result) or analysis_result
         print(analysis_result)
 
     except Exception as e:
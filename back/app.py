@@ -1,19 +1,35 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify, Response, g, make_response
 from flask_cors import CORS
 import os
-import tempfile
-from werkzeug.utils import secure_filename
+import hmac
+import json
+import time
+from functools import wraps
 from dotenv import load_dotenv
-import stripe
-from background_remover import remove_background
+from pipeline import predict_image_bytes, stream_image_bytes, predict_batch, iter_image_files, timed_stage, PipelineError
+from result_cache import get_result_cache
+from jobs import get_job_queue, InvalidCallback, QueueFull, FINISHED
+import metrics
+from session_pool import get_session_pool
+from segmentation_service import SegmentationService, get_segmenter
+from warmup import start_warm_up, get_warm_up
+from upload import ALLOWED_EXTENSIONS, ImageUploadStream, UploadRejected, allowed_extension
+from admission import get_admission_controller, Overloaded
+import payments
 
 # Load environment variables
 load_dotenv()
 
-# Configure Stripe
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+class ImageUploadRequest(Request):
+    """Checks uploaded images while the body is being parsed, see upload.py"""
+    # Endpoints taking several files clear this to reject them one by one
+    abort_on_rejected_upload = True
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return ImageUploadStream(filename, abort=self.abort_on_rejected_upload)
 
 app = Flask(__name__)
+app.request_class = ImageUploadRequest
 
 # Secure CORS configuration
 allowed_origins = [
@@ -23,54 +39,286 @@ allowed_origins = [
     "https://vibe-animal.vercel.app",  # Your production frontend
 ]
 
-CORS(app, origins=allowed_origins, methods=['GET', 'POST', 'OPTIONS'], allow_headers=['Content-Type'])
+CORS(app, origins=allowed_origins, methods=['GET', 'POST', 'OPTIONS'], allow_headers=['Content-Type', 'Authorization', 'Idempotency-Key', 'X-Usage-Token'])
 
 # Configuration
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Load the heavy libraries, U2NetP sessions and OpenAI client in the background;
+# /ready reports when they are warm
+start_warm_up()
+
+metrics.REGISTRY.gauge('session_pool_idle_sessions', 'U2NetP sessions (or segmentation workers) waiting in the pool',
+                       lambda: get_segmenter().metrics()['idle'])
+metrics.REGISTRY.gauge('job_queue_depth', 'Jobs waiting for a worker',
+                       lambda: get_job_queue().stats()['queued'])
+def _admission_value(name):
+    controller = get_admission_controller()
+    return getattr(controller, name) if controller is not None else None
+
+metrics.REGISTRY.gauge('admission_limit', 'Concurrent predictions admitted by this worker',
+                       lambda: _admission_value('limit'))
+metrics.REGISTRY.gauge('admission_in_flight', 'Predictions running in this worker',
+                       lambda: _admission_value('in_flight'))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.timings = {}
+
+@app.after_request
+def record_request_timing(response):
+    """Feed the latency histogram and expose per-stage timings as a Server-Timing header"""
+    elapsed = time.perf_counter() - g.request_start
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint or 'unknown',
+                                    status=str(response.status_code))
+    g.timings['total'] = elapsed
+    response.headers['Server-Timing'] = metrics.server_timing(g.timings)
+    return response
+
+def overloaded_response(e):
+    response = jsonify({
+        'error': 'Server busy',
+        'message': e.message
+    })
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.status
+
+def pipeline_seconds(timings):
+    """Segmentation plus analysis time of a prediction that ran both, else None (cache hits, degraded runs)"""
+    if 'segmentation' in timings and 'analysis' in timings:
+        return timings['segmentation'] + timings['analysis']
+    return None
+
+def admission_controlled(view):
+    """
+    Run the view only once admission control lets the request in (see
+    admission.py); refused requests get 429/503 with Retry-After right away.
+    Streamed responses hold their slot until the stream is closed, and set
+    the ticket's latency sample themselves (g.admission_ticket).
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        controller = get_admission_controller()
+        if controller is None:
+            return view(*args, **kwargs)
+        try:
+            ticket = controller.acquire()
+        except Overloaded as e:
+            return overloaded_response(e)
+        g.admission_ticket = ticket
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            ticket.release()
+            raise
+        if response.is_streamed:
+            response.call_on_close(ticket.release)
+        else:
+            if response.status_code < 400:
+                ticket.sample = pipeline_seconds(g.timings)
+            ticket.release()
+        return response
+    return wrapper
+
+def payment_error_response(e):
+    return jsonify({
+        'error': e.error,
+        'message': e.message
+    }), e.status
+
+def usage_token():
+    """The usage token sent as `Authorization: Bearer <token>` or X-Usage-Token"""
+    authorization = request.headers.get('Authorization', '')
+    if authorization.lower().startswith('bearer '):
+        return authorization[7:].strip()
+    return request.headers.get('X-Usage-Token')
+
+def payment_required(view):
+    """
+    With PAYMENT_REQUIRED, spend the request's usage token (see payments.py)
+    before running the view; no Stripe call is made. The token is refunded
+    if the view answers with an error. Streamed responses keep it spent.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not payments.payment_required():
+            return view(*args, **kwargs)
+        try:
+            service = payments.get_payments()
+            token_id = service.redeem(usage_token())
+        except payments.PaymentError as e:
+            return payment_error_response(e)
+        try:
+            response = make_response(view(*args, **kwargs))
+        except BaseException:
+            service.refund(token_id)
+            raise
+        if response.status_code >= 400 and not response.is_streamed:
+            service.refund(token_id)
+        return response
+    return wrapper
+
+def internal_only(view):
+    """
+    For endpoints that read server paths or run many analyses per request,
+    which a usage token doesn't pay for. With INTERNAL_API_TOKEN set the
+    request must carry it in X-Internal-Token; without it they are only
+    open while PAYMENT_REQUIRED is off.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        expected = os.getenv('INTERNAL_API_TOKEN')
+        if expected:
+            supplied = request.headers.get('X-Internal-Token', '')
+            allowed = hmac.compare_digest(supplied.encode('utf-8', 'surrogateescape'), expected.encode())
+        else:
+            allowed = not payments.payment_required()
+        if not allowed:
+            return jsonify({
+                'error': 'Forbidden',
+                'message': 'This endpoint is for internal use'
+            }), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+def rejected_upload_response(e):
+    return jsonify({
+        'error': e.error,
+        'message': e.message
+    }), e.status
+
+def read_image_upload():
+    """
+    Validate the 'image' upload and read it into memory.
+    Returns (image_bytes, None) or (None, error_response).
+    """
+    # Parsing the form streams the upload through ImageUploadStream, which
+    # stops reading the body as soon as the file turns out to be unusable
+    try:
+        with timed_stage(g.timings, 'upload'):
+            files = request.files
+    except UploadRejected as e:
+        return None, rejected_upload_response(e)
+    
+    # Check if image file is present
+    if 'image' not in files:
+        return None, (jsonify({
+            'error': 'No image file provided',
+            'message': 'Please upload an image file'
+        }), 400)
+    
+    file = files['image']
+    
+    # Check if file is selected
+    if file.filename == '':
+        return None, (jsonify({
+            'error': 'No file selected',
+            'message': 'Please select an image file'
+        }), 400)
+    
+    # Check if file type is allowed
+    if not allowed_extension(file.filename):
+        return None, (jsonify({
+            'error': 'Invalid file type',
+            'message': f'Please upload an image in one of these formats: {", ".join(ALLOWED_EXTENSIONS).upper()}'
+        }), 400)
+    
+    try:
+        file.stream.validate()
+    except UploadRejected as e:
+        return None, rejected_upload_response(e)
+    return file.read(), None
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
+    cache = get_result_cache()
+    segmenter = get_segmenter()
     return jsonify({
         'status': 'healthy',
-        'message': 'Aesthetic Matcher API is running'
+        'message': 'Aesthetic Matcher API is running',
+        'session_pool': get_session_pool().metrics(),
+        'segmentation_workers': segmenter.metrics() if isinstance(segmenter, SegmentationService) else None,
+        'result_cache': cache.stats() if cache is not None else None,
+        'admission': get_admission_controller().stats() if get_admission_controller() is not None else None,
+        'jobs': get_job_queue().stats()
     })
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 200 once warm-up has loaded the models, 503 until then"""
+    ready, report = get_warm_up().status()
+    return jsonify(report), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of this process's metrics"""
+    return Response(metrics.REGISTRY.render(), mimetype=None, content_type=metrics.CONTENT_TYPE)
+
 @app.route('/create-payment-intent', methods=['POST'])
 def create_payment_intent():
-    """Create a Stripe payment intent for 99 cents"""
+    """
+    Create a Stripe payment intent for 99 cents. A checkout retried with the
+    same Idempotency-Key header gets the same intent back.
+    """
+    data = request.get_json(silent=True) or {}
     try:
-        data = request.get_json()
-        
-        # Create a PaymentIntent with the order amount and currency
-        intent = stripe.PaymentIntent.create(
-            amount=99,
-            currency='usd',
-            automatic_payment_methods={
-                'enabled': True,
-            },
-            metadata={
-                'product_id': data.get('product_id', os.getenv('STRIPE_CREDIT_PRODUCT_ID')),
-                'service': 'image_analysis'
-            }
+        intent = payments.create_intent(
+            data.get('product_id', os.getenv('STRIPE_CREDIT_PRODUCT_ID')),
+            idempotency_key=request.headers.get('Idempotency-Key'),
         )
-        
+    except payments.PaymentError as e:
+        return payment_error_response(e)
+
+    return jsonify({
+        'clientSecret': intent.client_secret,
+        'paymentIntentId': intent.id
+    })
+
+@app.route('/stripe-webhook', methods=['POST'])
+def stripe_webhook():
+    """Stripe webhook endpoint; records succeeded payments so tokens can be issued for them"""
+    try:
+        event_type = payments.get_payments().handle_webhook(request.get_data(), request.headers.get('Stripe-Signature'))
+    except payments.PaymentError as e:
+        return payment_error_response(e)
+    return jsonify({'received': True, 'type': event_type})
+
+@app.route('/payment-token', methods=['POST'])
+def payment_token():
+    """
+    Exchange a paid intent's id for a usage token. Answers 202 with
+    Retry-After until Stripe's webhook for the payment has arrived.
+    """
+    data = request.get_json(silent=True) or {}
+    intent = data.get('payment_intent')
+    if not intent:
         return jsonify({
-            'clientSecret': intent.client_secret
+            'error': 'No payment intent',
+            'message': 'Send the id of the paid payment intent as payment_intent'
+        }), 400
+    try:
+        issued = payments.get_payments().issue_token(intent)
+    except payments.PaymentError as e:
+        return payment_error_response(e)
+    if issued is None:
+        response = jsonify({
+            'status': 'pending',
+            'message': 'The payment has not been confirmed yet'
         })
-        
-    except Exception as e:
-        return jsonify({
-            'error': 'Payment intent creation failed',
-            'message': str(e)
-        }), 500
+        response.headers['Retry-After'] = '1'
+        return response, 202
+
+    token, expires = issued
+    return jsonify({
+        'token': token,
+        'expiresAt': expires
+    })
 
 @app.route('/predict', methods=['POST'])
+@payment_required
+@admission_controlled
 def predict():
     """
     Main prediction endpoint that:
@@ -78,73 +326,32 @@ def predict():
     2. Removes background
     3. Analyzes the image for animal matching
     4. Returns the result
+    With ?stream=true the answer is sent as server-sent events instead: 'label'
+    as soon as the animal is settled, 'delta' pieces of the reply while the
+    explanation generates, then 'result' (or 'error').
     """
     try:
-        # Check if image file is present
-        if 'image' not in request.files:
-            return jsonify({
-                'error': 'No image file provided',
-                'message': 'Please upload an image file'
-            }), 400
+        image_data, error_response = read_image_upload()
+        if error_response is not None:
+            return error_response
         
-        file = request.files['image']
+        if request.args.get('stream', 'false').lower() == 'true':
+            return stream_prediction(image_data)
         
-        # Check if file is selected
-        if file.filename == '':
-            return jsonify({
-                'error': 'No file selected',
-                'message': 'Please select an image file'
-            }), 400
-        
-        # Check if file type is allowed
-        if not allowed_file(file.filename):
-            return jsonify({
-                'error': 'Invalid file type',
-                'message': f'Please upload an image in one of these formats: {", ".join(ALLOWED_EXTENSIONS).upper()}'
-            }), 400
-        
-        # Save uploaded file to temporary location
-        filename = secure_filename(file.filename)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as temp_input:
-            file.save(temp_input.name)
-            input_path = temp_input.name
-        
-        # Create temporary output path for background-removed image
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_output:
-            output_path = temp_output.name
-        
-        # Step 1: Remove background
+        # Decode the upload from memory; identical images are served from the result cache
         try:
-            remove_background(input_path, output_path)
-        except Exception as e:
+            output = predict_image_bytes(image_data, timings=g.timings)
+        except PipelineError as e:
             return jsonify({
-                'error': 'Background removal failed',
-                'message': str(e)
-            }), 500
-        
-        # Step 2: Analyze animal
-        try:
-            # We need to modify analyze_animal to return the result instead of printing
-            result = analyze_animal_api(output_path)
-        except Exception as e:
-            return jsonify({
-                'error': 'Animal analysis failed',
-                'message': str(e)
-            }), 500
-        
-        # Clean up temporary files
-        try:
-            if os.path.exists(input_path):
-                os.remove(input_path)
-            if os.path.exists(output_path):
-                os.remove(output_path)
-        except Exception as e:
-            print(f"Warning: Could not clean up temporary files: {e}")
-            pass  # Don't fail if cleanup fails
+                'error': e.error,
+                'message': e.message
+            }), e.status
         
         return jsonify({
             'success': True,
-            'result': result,
+            'result': output['result'],
+            'cache': output['cache'],
+            'degraded': output.get('degraded', False),
             'message': 'Analysis completed successfully'
         })
         
@@ -154,7 +361,48 @@ def predict():
             'message': str(e)
         }), 500
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_prediction(image_data):
+    """Server-sent events for one prediction; the vision call is cancelled if the client goes away"""
+    timings = g.timings
+    request_start = g.request_start
+    ticket = g.get('admission_ticket')
+    
+    def generate():
+        events = stream_image_bytes(image_data, timings=timings)
+        try:
+            for event, data in events:
+                if event == 'label':
+                    yield sse_event('label', {'animal': data})
+                elif event == 'delta':
+                    yield sse_event('delta', {'text': data})
+                else:
+                    # after_request ran before the body was generated; its total is only the setup
+                    timings['total'] = round(time.perf_counter() - request_start, 4)
+                    if ticket is not None:
+                        ticket.sample = pipeline_seconds(timings)
+                    yield sse_event('result', {
+                        'success': True,
+                        'result': data['result'],
+                        'cache': data['cache'],
+                        'degraded': data.get('degraded', False),
+                        'timings': timings,
+                        'message': 'Analysis completed successfully'
+                    })
+        except PipelineError as e:
+            yield sse_event('error', {'error': e.error, 'message': e.message})
+        except Exception as e:
+            yield sse_event('error', {'error': 'Internal server error', 'message': str(e)})
+        finally:
+            events.close()
+    
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/predict_path', methods=['POST'])
+@internal_only
+@admission_controlled
 def predict_path():
     """
     Alternative endpoint that accepts an image path instead of file upload
@@ -177,39 +425,22 @@ def predict_path():
                 'message': f'Image file not found at: {input_path}'
             }), 404
         
-        # Create temporary output path
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_output:
-            output_path = temp_output.name
-        
-        # Step 1: Remove background
-        try:
-            remove_background(input_path, output_path)
-        except Exception as e:
-            return jsonify({
-                'error': 'Background removal failed',
-                'message': str(e)
-            }), 500
+        with open(input_path, 'rb') as image_file:
+            image_data = image_file.read()
         
-        # Step 2: Analyze animal
         try:
-            result = analyze_animal_api(output_path)
-        except Exception as e:
+            output = predict_image_bytes(image_data, timings=g.timings)
+        except PipelineError as e:
             return jsonify({
-                'error': 'Animal analysis failed',
-                'message': str(e)
-            }), 500
-        
-        # Clean up temporary file
-        try:
-            if os.path.exists(output_path):
-                os.remove(output_path)
-        except Exception as e:
-            print(f"Warning: Could not clean up temporary file: {e}")
-            pass
+                'error': e.error,
+                'message': e.message
+            }), e.status
         
         return jsonify({
             'success': True,
-            'result': result,
+            'result': output['result'],
+            'cache': output['cache'],
+            'degraded': output.get('degraded', False),
             'message': 'Analysis completed successfully'
         })
         
@@ -219,115 +450,187 @@ def predict_path():
             'message': str(e)
         }), 500
 
-def analyze_animal_api(image_path: str):
+@app.route('/predict_batch', methods=['POST'])
+@internal_only
+def predict_batch_endpoint():
     """
-    Modified version of analyze_animal that returns the result instead of printing
-    Retries up to 3 times if the response contains 'sorry' or if animal validation fails.
+    Batch endpoint: accepts several uploads under 'images' (multipart) or a
+    JSON body with 'image_dir'. Streams one NDJSON line per image as soon as
+    it finishes, followed by a summary line.
+    Query parameters: batch_size (default 8, at most BATCH_MAX_SIZE, default 16),
+    parallelism (default 4, at most BATCH_MAX_PARALLELISM, default 8).
+    The batch is admitted as `parallelism` predictions (see admission.py).
     """
-    import base64
-    from openai import OpenAI
-    import time
-    from animal_analyzer import extract_and_validate_animal
-
-    # Load API Key from environment variable
-    api_key = os.getenv('OPENAI_API_KEY')
-    if not api_key:
-        return "Error: OPENAI_API_KEY environment variable not set"
+    try:
+        batch_size = min(max(1, int(request.args.get('batch_size', 8))),
+                         int(os.getenv('BATCH_MAX_SIZE', '16')))
+        parallelism = min(max(1, int(request.args.get('parallelism', 4))),
+                          int(os.getenv('BATCH_MAX_PARALLELISM', '8')))
+    except ValueError:
+        return jsonify({
+            'error': 'Invalid parameters',
+            'message': 'batch_size and parallelism must be integers'
+        }), 400
+    
+    rejected = []
+    request.abort_on_rejected_upload = False
+    if request.files:
+        items = []
+        for file in request.files.getlist('images'):
+            if file.filename == '' or not allowed_extension(file.filename):
+                rejected.append({
+                    'name': file.filename,
+                    'success': False,
+                    'error': 'Invalid file type',
+                    'message': f'Please upload an image in one of these formats: {", ".join(ALLOWED_EXTENSIONS).upper()}'
+                })
+                continue
+            try:
+                file.stream.validate()
+            except UploadRejected as e:
+                rejected.append({
+                    'name': file.filename,
+                    'success': False,
+                    'error': e.error,
+                    'message': e.message
+                })
+            else:
+                items.append((file.filename, file.read()))
+    else:
+        data = request.get_json(silent=True)
+        if not data or 'image_dir' not in data:
+            return jsonify({
+                'error': 'No images provided',
+                'message': "Please upload files under 'images' or provide image_dir in JSON body"
+            }), 400
+        if not os.path.isdir(data['image_dir']):
+            return jsonify({
+                'error': 'Directory not found',
+                'message': f"Image directory not found at: {data['image_dir']}"
+            }), 404
+        items = iter_image_files([data['image_dir']])
     
-    # Initialize OpenAI client
-    client = OpenAI(api_key=api_key)
+    # A batch holds as many admission slots as it runs analyses at once
+    controller = get_admission_controller()
+    ticket = None
+    if controller is not None:
+        try:
+            ticket = controller.acquire(weight=parallelism)
+        except Overloaded as e:
+            return overloaded_response(e)
     
-    # Check and encode image
-    if not os.path.exists(image_path):
-        return "Error: Image file not found"
+    def generate():
+        start = time.perf_counter()
+        count = 0
+        for record in rejected:
+            yield json.dumps(record) + '\n'
+        for record in predict_batch(items, batch_size=batch_size, parallelism=parallelism):
+            count += 1
+            yield json.dumps(record) + '\n'
+        elapsed = time.perf_counter() - start
+        yield json.dumps({
+            'done': True,
+            'count': count,
+            'seconds': round(elapsed, 3),
+            'images_per_second': round(count / elapsed, 3) if elapsed else None
+        }) + '\n'
     
+    response = Response(generate(), mimetype='application/x-ndjson')
+    if ticket is not None:
+        response.call_on_close(ticket.release)
+    return response
+
+@app.route('/jobs', methods=['POST'])
+@payment_required
+def submit_job():
+    """
+    Queue an image for analysis and return immediately with a job id.
+    Poll /jobs/<id> or stream /jobs/<id>/events for the result.
+    An optional 'callback_url' form field receives the finished job as a POST
+    when JOB_WEBHOOKS_ENABLED is set.
+    """
     try:
-        with open(image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+        image_data, error_response = read_image_upload()
+        if error_response is not None:
+            return error_response
+        
+        try:
+            job = get_job_queue().submit(image_data, callback_url=request.form.get('callback_url'))
+        except QueueFull as e:
+            response = jsonify({
+                'error': 'Too many requests',
+                'message': 'The analysis queue is full, please retry shortly'
+            })
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
+        except InvalidCallback as e:
+            return jsonify({
+                'error': 'Invalid callback URL',
+                'message': str(e)
+            }), 400
+        
+        return jsonify({
+            'success': True,
+            'job_id': job['id'],
+            'status': job['status'],
+            'status_url': f"/jobs/{job['id']}",
+            'events_url': f"/jobs/{job['id']}/events"
+        }), 202
+        
     except Exception as e:
-        return f"Error reading image: {e}"
-    
-    # Define the available animals from the frontend dataset
-    available_animals = """
-    leopard, lion, tiger, elephant, panda, bear, koala, gorilla, orangutan, dog, poodle, wolf, fox, raccoon, cat, cow, ox, buffalo, pig, boar, goat, sheep, ram, deer, horse, zebra, giraffe, camel, llama, hippopotamus, rhinoceros, kangaroo, bat, mouse, rat, rabbit, chipmunk, hedgehog,chick, rooster, chicken, turkey, duck, swan, eagle, dove, flamingo, peacock, parrot, penguin,fish, tropical_fish, blowfish, shark, whale, octopus, crab, lobster, shrimp, squid,snail, butterfly, bug, ant, honeybee, cricket, spider, scorpion, mosquito,turtle, crocodile, lizard, snake, frog,dragon, unicorn,dinosaur
-"""
-
-    # Define the prompt
-    prompt = f"""
-VIBE ANIMAL MATCH
-
-What animal best represents this energy and style? You MUST choose from the following predefined animals only:
-
-{available_animals}
-
-Please respond in the following format:
+        return jsonify({
+            'error': 'Internal server error',
+            'message': str(e)
+        }), 500
 
-**animal:** [ANIMAL_NAME_FROM_THE_LIST_ABOVE]
-**Explanation:** [Explanation of the vibe represented by the input]
-**Connection:** [With simplified bullet points, Connection of the vibe and visual elements to the chosen animal. Elaborate on why this animal *feels right* for this aesthetic.]
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Current state of a job, including the result and per-stage timings once finished"""
+    job = get_job_queue().store.get(job_id)
+    if job is None:
+        return jsonify({
+            'error': 'Job not found',
+            'message': f'No job with id: {job_id}'
+        }), 404
+    job.pop('callback_url', None)
+    return jsonify(job)
 
-IMPORTANT: You must choose an animal name that exactly matches one from the list above. Do not use variations or similar names.
-"""
-    
-    last_response = None
-    for attempt in range(3):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=300
-            )
-            result = response.choices[0].message.content
-            last_response = result
-            
-            # Validate the animal name from the response
-            animal_name, is_valid, _ = extract_and_validate_animal(result)
-            
-            # If response doesn't contain 'sorry' and animal is valid, return the result
-            if result and 'sorry' not in result.lower() and is_valid:
-                return result
-            else:
-                time.sleep(1)  # Wait 1 second before retrying
-        except Exception as e:
-            last_response = f"Error calling OpenAI API: {e}"
-            break  # Don't retry on API errors
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-sent events: one 'status' event per state change, ending when the job finishes"""
+    store = get_job_queue().store
+    if store.get(job_id) is None:
+        return jsonify({
+            'error': 'Job not found',
+            'message': f'No job with id: {job_id}'
+        }), 404
     
-    # If we get here, either all attempts failed or animal validation failed
-    # Return a fallback response with a default animal
-    if last_response and 'Error:' not in last_response:
-        # Try to extract and fix the animal name
-        animal_name, is_valid, original_response = extract_and_validate_animal(last_response)
-        if not is_valid and animal_name is None:
-            # If no valid animal found, use a default
-            fallback_response = f"""**animal:** cat
-**Explanation:** Based on the image analysis, this vibe represents a {animal_name or 'mysterious'} energy.
-**Connection:** 
-- The visual elements suggest a {animal_name or 'unique'} personality
-- This animal best captures the essence of the image
-- The connection reflects the overall aesthetic and mood"""
-            return fallback_response
+    def generate():
+        last_status = None
+        while True:
+            job = store.get(job_id)
+            if job is None:
+                return
+            if job['status'] != last_status:
+                last_status = job['status']
+                job.pop('callback_url', None)
+                yield f"event: status\ndata: {json.dumps(job)}\n\n"
+            if job['status'] in FINISHED:
+                return
+            time.sleep(0.25)
     
-    return last_response
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 if __name__ == '__main__':
     print("Starting Aesthetic Matcher API Server...")
     print("Available endpoints:")
     print("- GET  /health - Health check")
-    print("- POST /predict - Upload image for analysis")
-    print("- POST /predict_path - Analyze image by path")
+    print("- GET  /ready - Readiness (models warmed up)")
+    print("- GET  /metrics - Prometheus metrics")
+    print("- POST /predict - Upload image for analysis (?stream=true for server-sent events)")
+    print("- POST /predict_path - Analyze image by path (internal)")
+    print("- POST /predict_batch - Analyze many images, streamed as NDJSON (internal)")
+    print("- POST /jobs - Queue an image for analysis, poll /jobs/<id> for the result")
     
     # Get port from environment variable (for Railway) or default to 5000
     port = int(os.environ.get('PORT', 5000))
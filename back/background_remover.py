@@ -1,24 +1,338 @@
+"""
+Background removal: U2NetP mask, then composite onto white.
+
+The mask stays a NumPy array from the model output to the composite:
+threshold and feather are vectorized ops on the 320x320 prediction, the
+mask is upsampled only over the region that is kept, and the composite is
+computed strip by strip in 16-bit integer arithmetic, in small per-thread
+scratch buffers, straight into the preallocated result.
+
+Configuration (environment):
+  MASK_THRESHOLD     make the mask hard around this level, 0..1 (default: keep the soft mask)
+  MASK_FEATHER       width of the ramp around MASK_THRESHOLD (default 0.1)
+  COMPOSITE_CROP     crop the result to the subject's bounding box (default false)
+  COMPOSITE_CROP_MARGIN  margin added around the box, as a fraction of its size (default 0.05)
+
+Smart crop (SMART_CROP=true) replaces the fixed resize with a normalization
+step driven by the 320px U2NetP pass: the subject's box, plus a margin and
+widened toward a square where the image allows, is cut out of the decoded
+image, scaled to fit SMART_CROP_SIZE and composited in the middle of a
+white SMART_CROP_SIZE square. Letterboxing with white is invisible on the
+white background, and every image sent to the vision model, batched or
+cached has the same shape. With SMART_CROP_REFINE the crop gets a second
+U2NetP pass, which gives small subjects a sharper mask than the first
+pass's upsampled one, at the cost of a second inference.
+
+  SMART_CROP         crop to the subject and letterbox to a square (default false)
+  SMART_CROP_SIZE    side of the square, in pixels (default 768: 4 gpt-4o tiles; 512 fits in 1)
+  SMART_CROP_MARGIN  margin around the subject, as a fraction of its size (default 0.1)
+  SMART_CROP_REFINE  segment the crop again for the final mask (default false)
+"""
+import io
 import os
-import tempfile
-import rembg
+import threading
+import numpy as np
 from PIL import Image
+from preprocess import normalize_image, resize_for_vision, resize_for_segmentation
+from segmentation_service import get_segmenter
+from metrics import STAGE_SECONDS
 
-# Set U2NET_HOME to the model directory relative to this file
-current_dir = os.path.dirname(os.path.abspath(__file__))
-model_dir = os.path.join(current_dir, 'model')
-os.environ['U2NET_HOME'] = model_dir
+# Mask level that counts as subject when finding the crop box
+SUBJECT_LEVEL = 0.5
+# Rows composited at a time; 64 rows of a 1024px image keep the scratch at ~800KB
+STRIP_ROWS = 64
 
-def remove_background(input_image_path, output_image_path):
-    input_image = Image.open(input_image_path)
-    session = rembg.new_session(model_name='u2netp')
-    output_image = rembg.remove(input_image, session=session)
-    
-    # Check if the output image has transparency (RGBA)
-    if output_image.mode == 'RGBA':
-        # Convert to RGB by compositing with white background
-        rgb_image = Image.new('RGB', output_image.size, (255, 255, 255))
-        rgb_image.paste(output_image, mask=output_image.split()[-1])  # Use alpha channel as mask
-        rgb_image.save(output_image_path, 'JPEG', quality=95)
+_scratch = threading.local()
+
+def refine_mask(prediction, threshold=None, feather=0.1):
+    """
+    Alpha in 0..1 from a 0..1 prediction. Without a threshold the soft mask
+    is kept; with one, alpha ramps linearly from 0 to 1 across a band of
+    width `feather` centred on it (feather 0 gives a hard cut-out).
+    """
+    if threshold is None:
+        return prediction
+    if feather <= 0:
+        return (prediction >= threshold).astype(np.float32)
+    alpha = prediction - (threshold - feather / 2)
+    alpha *= 1.0 / feather
+    return np.clip(alpha, 0.0, 1.0, out=alpha)
+
+def subject_bbox(alpha, margin=0.05, level=SUBJECT_LEVEL):
+    """
+    Bounding box (left, top, right, bottom) of the subject in mask
+    coordinates, grown by `margin` of its size on each side; None if
+    nothing in the mask reaches `level`.
+    """
+    rows = np.flatnonzero(alpha.max(axis=1) >= level)
+    cols = np.flatnonzero(alpha.max(axis=0) >= level)
+    if not len(rows) or not len(cols):
+        return None
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+    pad_x = (right - left) * margin
+    pad_y = (bottom - top) * margin
+    height, width = alpha.shape
+    return (max(0.0, left - pad_x), max(0.0, top - pad_y),
+            min(float(width), right + pad_x), min(float(height), bottom + pad_y))
+
+def upsample_alpha(alpha, size, box=None):
+    """
+    Quantize a 0..1 mask to 8 bits and bilinearly upsample it (or just its
+    `box` region) to `size`: a uint8 (h, w) array.
+    """
+    mask = Image.fromarray(np.rint(alpha * 255).astype(np.uint8), mode='L')
+    return np.asarray(mask.resize(size, Image.Resampling.BILINEAR, box=box))
+
+def _scratch_buffers(shape):
+    """Two uint16 work arrays of `shape`, reused by this thread from call to call"""
+    size = shape[0] * shape[1] * shape[2]
+    buffer = getattr(_scratch, 'buffer', None)
+    if buffer is None or buffer.size < 2 * size:
+        buffer = _scratch.buffer = np.empty(2 * size, dtype=np.uint16)
+    return buffer[:size].reshape(shape), buffer[size:2 * size].reshape(shape)
+
+def composite_array(image, alpha, box=None):
+    """
+    White-background composite of an RGB PIL image (or its `box` region)
+    through a uint8 (h, w) alpha: 255 - round((255 - pixel) * alpha / 255).
+    Works in strips of STRIP_ROWS rows so the 16-bit intermediates stay
+    small and cache-resident, writing straight into the preallocated
+    result. Within a strip only the columns the subject reaches are
+    blended; the background either side is filled with white.
+    Returns a uint8 (h, w, 3) array.
+    """
+    pixels = np.asarray(image.crop(box) if box else image)
+    height, width = alpha.shape
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    work_rows, carry_rows = _scratch_buffers((STRIP_ROWS, width, 3))
+    for row in range(0, height, STRIP_ROWS):
+        end = min(height, row + STRIP_ROWS)
+        columns = np.flatnonzero(alpha[row:end].any(axis=0))
+        if not len(columns):
+            out[row:end] = 255
+            continue
+        first, last = columns[0], columns[-1] + 1
+        out[row:end, :first] = 255
+        out[row:end, last:] = 255
+
+        strip = alpha[row:end, first:last]
+        work = work_rows[:end - row, :last - first]
+        carry = carry_rows[:end - row, :last - first]
+        np.subtract(255, pixels[row:end, first:last], out=work)
+        for channel in range(3):
+            np.multiply(work[..., channel], strip, out=work[..., channel])
+        # Exact rounded division by 255 for 16-bit products, using shifts
+        work += 128
+        np.right_shift(work, 8, out=carry)
+        work += carry
+        work >>= 8
+        np.subtract(255, work, out=out[row:end, first:last], casting='unsafe')
+    return out
+
+def _mask_settings():
+    threshold = os.getenv('MASK_THRESHOLD')
+    return {
+        'threshold': float(threshold) if threshold else None,
+        'feather': float(os.getenv('MASK_FEATHER', '0.1')),
+    }
+
+def _crop_margin(crop):
+    if crop is None:
+        crop = os.getenv('COMPOSITE_CROP', 'false').lower() == 'true'
+    return float(os.getenv('COMPOSITE_CROP_MARGIN', '0.05')) if crop else None
+
+def composite_prediction(image, prediction, crop=None):
+    """
+    Turn a raw 0..1 U2NetP prediction into the white-background composite of
+    `image` (RGB PIL). With crop (default COMPOSITE_CROP), only the subject's
+    bounding box is upsampled, composited and returned. Returns a uint8 array.
+    """
+    alpha = refine_mask(prediction, **_mask_settings())
+    width, height = image.size
+    margin = _crop_margin(crop)
+    box = subject_bbox(alpha, margin) if margin is not None else None
+    if box is None:
+        return composite_array(image, upsample_alpha(alpha, (width, height)))
+
+    # Map the mask-space box onto whole pixels of the image
+    scale_x = width / alpha.shape[1]
+    scale_y = height / alpha.shape[0]
+    left, top = int(box[0] * scale_x), int(box[1] * scale_y)
+    right, bottom = max(left + 1, round(box[2] * scale_x)), max(top + 1, round(box[3] * scale_y))
+    region = (left, top, right, bottom)
+    mask = upsample_alpha(alpha, (right - left, bottom - top), _mask_box(region, image.size, alpha))
+    return composite_array(image, mask, region)
+
+def _mask_box(region, size, alpha):
+    """A pixel box of an image of `size` in the coordinates of its mask"""
+    scale_x = size[0] / alpha.shape[1]
+    scale_y = size[1] / alpha.shape[0]
+    return (region[0] / scale_x, region[1] / scale_y, region[2] / scale_x, region[3] / scale_y)
+
+def _grow(low, high, amount, limit):
+    # Widen [low, high) by `amount`, centred, shifting it to stay within [0, limit)
+    low -= amount / 2
+    high += amount / 2
+    if low < 0:
+        low, high = 0.0, min(float(limit), high - low)
+    if high > limit:
+        low, high = max(0.0, low - (high - limit)), float(limit)
+    return low, high
+
+def subject_region(size, alpha, margin):
+    """
+    Pixel box (left, top, right, bottom) of an image of `size` around the
+    subject in its mask, widened toward a square as far as the image
+    allows; the whole image if the mask is empty.
+    """
+    width, height = size
+    box = subject_bbox(alpha, margin)
+    if box is None:
+        return 0, 0, width, height
+    scale_x = width / alpha.shape[1]
+    scale_y = height / alpha.shape[0]
+    left, right = box[0] * scale_x, box[2] * scale_x
+    top, bottom = box[1] * scale_y, box[3] * scale_y
+    # More of the surroundings is better than more letterbox
+    if right - left < bottom - top:
+        left, right = _grow(left, right, min(width, bottom - top) - (right - left), width)
     else:
-        # If it's already RGB, save directly
-        output_image.save(output_image_path, 'JPEG', quality=95)
+        top, bottom = _grow(top, bottom, min(height, right - left) - (bottom - top), height)
+    left, top = int(left), int(top)
+    return left, top, max(left + 1, round(right)), max(top + 1, round(bottom))
+
+def crop_to_subject(image, alpha, size, margin):
+    """
+    Cut the subject's region out of `image` and scale it to fit a `size`
+    square (never enlarging). Returns (crop, region).
+    """
+    region = subject_region(image.size, alpha, margin)
+    width, height = region[2] - region[0], region[3] - region[1]
+    scale = min(1.0, size / max(width, height))
+    fitted = (max(1, round(width * scale)), max(1, round(height * scale)))
+    # resize with a box crops and scales in one pass
+    return image.resize(fitted, Image.Resampling.BILINEAR, box=region, reducing_gap=2.0), region
+
+def letterbox(composite, size):
+    """Centre a uint8 (h, w, 3) composite on a white `size` square"""
+    height, width = composite.shape[:2]
+    out = np.full((size, size, 3), 255, dtype=np.uint8)
+    top, left = (size - height) // 2, (size - width) // 2
+    out[top:top + height, left:left + width] = composite
+    return out
+
+def _smart_crop_settings():
+    if os.getenv('SMART_CROP', 'false').lower() != 'true':
+        return None
+    return {
+        'size': int(os.getenv('SMART_CROP_SIZE', '768')),
+        'margin': float(os.getenv('SMART_CROP_MARGIN', '0.1')),
+        'refine': os.getenv('SMART_CROP_REFINE', 'false').lower() == 'true',
+    }
+
+def smart_crop_prediction(image, prediction, size, margin):
+    """
+    Smart-crop composite of an RGB PIL image from its 320x320 U2NetP
+    prediction: the subject's region, composited and letterboxed onto a
+    white `size` square. Returns a uint8 (size, size, 3) array.
+    """
+    alpha = refine_mask(prediction, **_mask_settings())
+    crop, region = crop_to_subject(image, alpha, size, margin)
+    mask = upsample_alpha(alpha, crop.size, _mask_box(region, image.size, alpha))
+    return letterbox(composite_array(crop, mask), size)
+
+def smart_crop_arrays(input_images, size, margin, refine=False):
+    """
+    smart_crop_prediction for a batch of PIL images, with every subject
+    found in one U2NetP run. With refine, the crops go through a second
+    run and its masks are used for the composites instead.
+    Returns uint8 (size, size, 3) arrays in input order.
+    """
+    pool = get_segmenter()
+    with STAGE_SECONDS.time(stage='resize'):
+        images = [normalize_image(image) for image in input_images]
+        thumbnails = [resize_for_segmentation(image) for image in images]
+    predictions = pool.predict_mask_arrays(thumbnails)
+    if not refine:
+        with STAGE_SECONDS.time(stage='composite'):
+            return [smart_crop_prediction(image, prediction, size, margin)
+                    for image, prediction in zip(images, predictions)]
+
+    settings = _mask_settings()
+    with STAGE_SECONDS.time(stage='resize'):
+        crops = [crop_to_subject(image, refine_mask(prediction, **settings), size, margin)[0]
+                 for image, prediction in zip(images, predictions)]
+    refined = pool.predict_mask_arrays([resize_for_segmentation(crop) for crop in crops])
+    with STAGE_SECONDS.time(stage='composite'):
+        return [letterbox(composite_array(crop, upsample_alpha(refine_mask(prediction, **settings), crop.size)), size)
+                for crop, prediction in zip(crops, refined)]
+
+def remove_background_array(input_image, max_side=None, crop=None):
+    """
+    Segment the subject of a PIL image and composite it onto white.
+    The image is first shrunk to the vision model's effective resolution
+    (max_side overrides VISION_MAX_SIDE, 0 keeps full size); U2NetP sees a
+    320px thumbnail and its mask is upsampled only for the composite.
+    Returns an RGB uint8 array; nothing touches the disk.
+    With SMART_CROP on, the result is the letterboxed subject instead, and
+    max_side and crop don't apply.
+    """
+    smart_crop = _smart_crop_settings()
+    if smart_crop is not None:
+        return smart_crop_arrays([input_image], **smart_crop)[0]
+    with STAGE_SECONDS.time(stage='resize'):
+        image = resize_for_vision(normalize_image(input_image), max_side)
+        thumbnail = resize_for_segmentation(image)
+    prediction = get_segmenter().predict_mask_arrays([thumbnail])[0]
+    with STAGE_SECONDS.time(stage='composite'):
+        return composite_prediction(image, prediction, crop)
+
+def remove_background_image(input_image, max_side=None, crop=None):
+    """remove_background_array as an RGB PIL image"""
+    return Image.fromarray(remove_background_array(input_image, max_side, crop))
+
+def remove_background_images(input_images, max_side=None, crop=None):
+    """
+    Batch version of remove_background_image: every image is segmented in a
+    single U2NetP run. Returns RGB images in input order.
+    """
+    smart_crop = _smart_crop_settings()
+    if smart_crop is not None:
+        return [Image.fromarray(array) for array in smart_crop_arrays(input_images, **smart_crop)]
+    images = [resize_for_vision(normalize_image(image), max_side) for image in input_images]
+    predictions = get_segmenter().predict_mask_arrays([resize_for_segmentation(image) for image in images])
+    return [Image.fromarray(composite_prediction(image, prediction, crop))
+            for image, prediction in zip(images, predictions)]
+
+def composite_on_white(image, mask):
+    """PIL path: composite with white background, using the (possibly smaller) L-mode mask as alpha"""
+    if mask.size != image.size:
+        mask = mask.resize(image.size, Image.Resampling.BILINEAR)
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    return Image.composite(image, background, mask)
+
+def encode_jpeg(image, quality=95):
+    """Encode a PIL image to JPEG bytes in memory"""
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+def remove_background_jpeg(image_source, quality=95):
+    """
+    Decode an image from a path or file-like object (e.g. the upload stream),
+    remove its background and return the result as JPEG bytes.
+    """
+    with Image.open(image_source) as input_image:
+        input_image.load()
+        return encode_jpeg(remove_background_image(input_image), quality=quality)
+
+def remove_background_bytes(image_data):
+    """Bytes in, JPEG bytes out"""
+    return remove_background_jpeg(io.BytesIO(image_data))
+
+def remove_background(input_image_path, output_image_path):
+    """File-path wrapper kept for scripts such as predict_pipeline.py"""
+    image_bytes = remove_background_jpeg(input_image_path)
+    with open(output_image_path, 'wb') as output_file:
+        output_file.write(image_bytes)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Admission control under overload: the same open-loop load with and without
+the controller.
+
+Requests arrive at --rate per second for --duration seconds, each on its own
+thread, whether or not earlier ones have finished (the way users keep
+uploading). Each one runs a stand-in for the pipeline:
+
+  segmentation  --cpu-ms of work on one of --cpu-slots slots (waiting for a
+                free one, like U2NetP sessions), or skipped in degraded mode
+  analysis      a chat completion against the local fake OpenAI server with
+                --latency seconds of delay
+
+With admission off every request is let in; with it on, requests go through
+AdmissionController.acquire() and refused ones count as shed (429/503),
+which is what the endpoints answer. Reported: completions, shed requests,
+latency percentiles of completed requests, the most requests in flight at
+once and where the adaptive limit ended up.
+
+    python benchmarks/bench_admission.py --rate 40 --latency 1.0
+    python benchmarks/bench_admission.py --rate 40 --cpu-ms 120 --cpu-slots 2 -o admission.json
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+import requests
+
+import results
+from admission import AdmissionController, Overloaded
+from fake_openai import FakeOpenAIServer
+
+
+class Workload:
+    def __init__(self, base_url, cpu_slots, cpu_seconds, degrade_seconds):
+        self.base_url = base_url
+        self.cpu_seconds = cpu_seconds
+        self.degrade_seconds = degrade_seconds
+        self._slots = threading.Semaphore(cpu_slots)
+        self.cpu_slots = cpu_slots
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.degraded = 0
+
+    def backlog_seconds(self):
+        # Same estimate as SessionPool.backlog_seconds
+        return (self.waiting // self.cpu_slots + 1) * self.cpu_seconds if self.waiting else 0.0
+
+    def run(self, session):
+        """Seconds of segmentation plus analysis, or None for a degraded run (as the app samples it)"""
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        degraded = False
+        try:
+            if self.degrade_seconds and self.backlog_seconds() > self.degrade_seconds:
+                degraded = True
+                with self._lock:
+                    self.degraded += 1
+            else:
+                with self._lock:
+                    self.waiting += 1
+                self._slots.acquire()
+                with self._lock:
+                    self.waiting -= 1
+                try:
+                    time.sleep(self.cpu_seconds)
+                finally:
+                    self._slots.release()
+            response = session.post(f'{self.base_url}/chat/completions', timeout=120,
+                                    json={'model': 'gpt-4o', 'messages': [{'role': 'user', 'content': 'hi'}]})
+            response.raise_for_status()
+            return None if degraded else time.perf_counter() - start
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def drive(args, base_url, controller):
+    workload = Workload(base_url, args.cpu_slots, args.cpu_ms / 1000,
+                        args.degrade_seconds if controller is not None else 0)
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    local = threading.local()
+
+    def request():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        ticket = None
+        try:
+            if controller is not None:
+                ticket = controller.acquire()
+            sample = workload.run(local.session)
+            if ticket is not None:
+                ticket.sample = sample
+            status = '200'
+        except Overloaded as e:
+            status = str(e.status)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        finally:
+            if ticket is not None:
+                ticket.release()
+        with lock:
+            statuses[status] += 1
+            if status == '200':
+                latencies.append(time.perf_counter() - start)
+
+    threads = []
+    start = time.perf_counter()
+    for number in range(int(args.rate * args.duration)):
+        # Open loop: the next arrival doesn't wait for earlier requests
+        delay = start + number / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=request, daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = sum(statuses.values())
+    metrics = {
+        'requests': total,
+        'goodput_rps': statuses['200'] / elapsed,
+        'error_rate': (total - statuses['200']) / total if total else 0.0,
+        'latency': results.percentiles(latencies),
+        'status': dict(statuses),
+        'max_in_flight': workload.max_in_flight,
+        'degraded': workload.degraded,
+    }
+    if controller is not None:
+        metrics['final_limit'] = controller.stats()['limit']
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=40, help='arrivals per second (default 40)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of arrivals (default 10)')
+    parser.add_argument('--cpu-ms', type=float, default=80, help='segmentation work per request (default 80)')
+    parser.add_argument('--cpu-slots', type=int, default=2, help='requests segmented at once (default 2)')
+    parser.add_argument('--latency', type=float, default=1.0, help='fake vision latency in seconds (default 1)')
+    parser.add_argument('--initial-limit', type=int, default=4)
+    parser.add_argument('--max-limit', type=int, default=16)
+    parser.add_argument('--queue', type=int, default=8)
+    parser.add_argument('--queue-timeout', type=float, default=2.0)
+    parser.add_argument('--degrade-seconds', type=float, default=1.0, help='0 = never skip segmentation')
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(('127.0.0.1', 0), latency=args.latency).start()
+    metrics = {}
+    try:
+        for mode in ('off', 'on'):
+            controller = None
+            if mode == 'on':
+                controller = AdmissionController(initial_limit=args.initial_limit, max_limit=args.max_limit,
+                                                 max_queue=args.queue, queue_timeout=args.queue_timeout)
+            metrics[mode] = drive(args, server.base_url, controller)
+    finally:
+        server.shutdown()
+
+    print(f"{args.rate:g} req/s for {args.duration:g}s; segmentation {args.cpu_ms:g}ms on {args.cpu_slots} slots, "
+          f"vision {args.latency:g}s")
+    print(f"{'admission':10} {'ok/s':>6} {'shed':>6} {'p50 ms':>8} {'p99 ms':>8} {'in flight':>10} {'degraded':>9} "
+          f"{'limit':>6}")
+    for mode in ('off', 'on'):
+        result = metrics[mode]
+        shed = result['status'].get('429', 0) + result['status'].get('503', 0)
+        latency = result['latency']
+        print(f"{mode:10} {result['goodput_rps']:6.1f} {shed:6d} {latency.get('p50_ms', 0):8.0f} "
+              f"{latency.get('p99_ms', 0):8.0f} {result['max_in_flight']:10d} {result['degraded']:9d} "
+              f"{result.get('final_limit', '-')!s:>6}")
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance')}
+    return results.finish(args, 'admission', config, metrics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
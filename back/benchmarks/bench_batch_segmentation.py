@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Segmentation throughput (images/sec) as a function of U2NetP batch size.
+
+    python benchmarks/bench_batch_segmentation.py --batch-sizes 1 2 4 8 16 --rounds 3
+
+Runs remove_background_images over the samples in image/ on a warm session
+pool; the vision call is not involved.
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+from PIL import Image
+from background_remover import remove_background_images
+from pipeline import iter_image_files
+from session_pool import get_session_pool
+
+IMAGE_DIR = os.path.join(BACK_DIR, '..', 'image')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=IMAGE_DIR)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    images = []
+    for _, data in iter_image_files([args.images]):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        images.append(image)
+
+    pool = get_session_pool().warm_up()
+    print(f"{len(images)} images, pool size {pool.size}, "
+          f"intra-op threads {pool.intra_op_threads or 'default'}")
+
+    for batch_size in args.batch_sizes:
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for offset in range(0, len(images), batch_size):
+                remove_background_images(images[offset:offset + batch_size])
+        elapsed = time.perf_counter() - start
+        total = len(images) * args.rounds
+        print(f"batch {batch_size:3d}: {total / elapsed:7.2f} images/sec")
+
+    if not pool.metrics()['batching']:
+        print("note: model has a fixed batch dimension; batches ran image by image")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Mask post-processing and compositing: the PIL paste path vs the NumPy path.
+
+  pil:        8-bit mask resized with LANCZOS, then Image.composite onto a new white image
+  numpy:      8-bit mask upsampled once, integer composite in reused scratch buffers
+  numpy+crop: as numpy, but only the subject's bounding box is upsampled and kept
+
+For each path: per-image time (best of --rounds), peak resident memory above the starting
+point and the JPEG size handed downstream. Peak memory is measured in a
+fresh process per path (Linux, via /proc/self/clear_refs), since freed
+buffers would otherwise be recycled between paths and hide allocations. The U2NetP forward pass
+is run once per image up front and isn't timed.
+
+    python benchmarks/bench_composite.py --rounds 5
+    python benchmarks/bench_composite.py --max-side 0      # full-resolution composites
+    python benchmarks/bench_composite.py --mask synthetic  # without the model: an elliptical subject
+"""
+import argparse
+import io
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+import numpy as np
+from PIL import Image
+from background_remover import composite_on_white, composite_prediction, encode_jpeg
+from pipeline import iter_image_files
+from preprocess import normalize_image, resize_for_vision, resize_for_segmentation
+
+IMAGE_DIR = os.path.join(BACK_DIR, '..', 'image')
+
+
+def synthetic_prediction(size=320):
+    """An ellipse covering the middle of the frame, with a soft edge like U2NetP's"""
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    distance = ((x - 0.5) / 0.3) ** 2 + ((y - 0.55) / 0.4) ** 2
+    return np.clip((1.0 - distance) * 6, 0.0, 1.0).astype(np.float32)
+
+
+def pil_path(image, thumbnail_size, prediction):
+    mask = Image.fromarray((prediction * 255).astype('uint8'), mode='L')
+    mask = mask.resize(thumbnail_size, Image.Resampling.LANCZOS)
+    return composite_on_white(image, mask)
+
+
+def numpy_path(image, thumbnail_size, prediction, crop=False):
+    return Image.fromarray(composite_prediction(image, prediction, crop=crop))
+
+
+def _status_kb(field):
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+
+def peak_memory_mb(fn):
+    """Peak RSS growth while fn runs, or None where the kernel can't reset the high-water mark"""
+    try:
+        baseline = _status_kb('VmRSS:')
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        fn()
+        return None
+    fn()
+    return (_status_kb('VmHWM:') - baseline) / 1024
+
+
+def measure_in_subprocess(label, argv):
+    """Run one path in a fresh interpreter and return its peak memory, or None"""
+    # A fixed glibc mmap threshold returns large freed buffers to the OS
+    # instead of recycling them, so the high-water mark sees every allocation
+    env = dict(os.environ, MALLOC_MMAP_THRESHOLD_='131072')
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, '--memory-of', label],
+                            capture_output=True, text=True, check=True, env=env).stdout.strip()
+    return float(output) if output != 'n/a' else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=IMAGE_DIR)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--max-side', type=int, default=None, help='VISION_MAX_SIDE override (0 = full size)')
+    parser.add_argument('--mask', choices=('model', 'synthetic'), default='model')
+    parser.add_argument('--memory-of', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    argv = ['--images', args.images, '--mask', args.mask]
+    if args.max_side is not None:
+        argv += ['--max-side', str(args.max_side)]
+
+    samples = []
+    for name, data in iter_image_files([args.images]):
+        with Image.open(io.BytesIO(data)) as image:
+            image = resize_for_vision(normalize_image(image), args.max_side)
+        thumbnail = resize_for_segmentation(image)
+        samples.append([name, image, thumbnail, None])
+
+    if args.mask == 'model':
+        from session_pool import get_session_pool
+        predictions = get_session_pool().predict_mask_arrays([sample[2] for sample in samples])
+    else:
+        predictions = [synthetic_prediction()] * len(samples)
+    for sample, prediction in zip(samples, predictions):
+        sample[3] = prediction
+
+    paths = [
+        ('pil', pil_path),
+        ('numpy', numpy_path),
+        ('numpy+crop', lambda image, size, prediction: numpy_path(image, size, prediction, crop=True)),
+    ]
+    if args.memory_of:
+        path = dict(paths)[args.memory_of]
+        def run_all():
+            for _, image, thumbnail, prediction in samples:
+                path(image, thumbnail.size, prediction)
+
+        peak = peak_memory_mb(run_all)
+        print(f"{peak:.1f}" if peak is not None else 'n/a')
+        return
+
+    pixels = statistics.mean(sample[1].size[0] * sample[1].size[1] for sample in samples) / 1e6
+    print(f"{len(samples)} images, mean {pixels:.2f} MP, {args.mask} masks")
+    print(f"{'path':12} {'ms/image':>9} {'peak MB':>8} {'JPEG KB':>8}")
+    for label, path in paths:
+        def run_once():
+            for _, image, thumbnail, prediction in samples:
+                path(image, thumbnail.size, prediction)
+
+        peak = measure_in_subprocess(label, argv)
+        run_once()  # warm-up
+        # Best round, to keep scheduler noise out of the comparison
+        rounds = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            run_once()
+            rounds.append(time.perf_counter() - start)
+        per_image = min(rounds) / len(samples) * 1000
+        jpeg_kb = statistics.mean(
+            len(encode_jpeg(path(image, thumbnail.size, prediction))) for _, image, thumbnail, prediction in samples
+        ) / 1024
+        peak_text = f"{peak:8.1f}" if peak is not None else f"{'n/a':>8}"
+        print(f"{label:12} {per_image:9.2f} {peak_text} {jpeg_kb:8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Tail latency of the vision call with and without hedging.
+
+The fake server answers most requests in `--latency` seconds but a
+`--tail-fraction` of them take `--tail-latency`. Each policy runs the same
+number of analyses with a few in flight at once; the table shows latency
+percentiles, provider requests per analysis and how often a hedge won.
+
+    python benchmarks/bench_hedging.py --requests 200 --tail-fraction 0.05
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import FakeOpenAIServer
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(analysis, openai_client, requests, concurrency):
+    durations = []
+
+    async def timed():
+        start = time.perf_counter()
+        await analysis.analyze_animal_async(b'fake-image')
+        durations.append(time.perf_counter() - start)
+
+    pending = []
+    for _ in range(requests):
+        pending.append(openai_client.submit(timed()))
+        if len(pending) >= concurrency:
+            pending.pop(0).result()
+    for future in pending:
+        future.result()
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hedged vs serial vision attempts')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--tail-latency', type=float, default=2.0)
+    parser.add_argument('--tail-fraction', type=float, default=0.05)
+    parser.add_argument('--rate', type=float, default=20.0, help='hedges per second (OPENAI_HEDGE_RATE)')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(('127.0.0.1', 0), latency=args.latency, tail_latency=args.tail_latency,
+                              tail_fraction=args.tail_fraction).start()
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+    import analysis
+    import hedging
+    import openai_client
+
+    policies = [
+        ('serial', hedging.HedgePolicy('off')),
+        ('p95 hedge', hedging.HedgePolicy('delay', rate=args.rate)),
+        ('parallel 2', hedging.HedgePolicy('parallel', parallel=2, rate=args.rate)),
+    ]
+    print(f"{'policy':12} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'calls/req':>10} {'hedge wins':>11}")
+    for name, policy in policies:
+        hedging._policy = policy
+        # Learn the p95 first, so the delay policy isn't measured on its default
+        if policy.mode == 'delay':
+            for _ in range(3 * hedging.MIN_SAMPLES):
+                openai_client.run(analysis.analyze_animal_async(b'fake-image'))
+        requests_before = server.requests
+        launched_before = hedging.HEDGES.value(outcome='launched')
+        won_before = hedging.HEDGES.value(outcome='won')
+        durations = run(analysis, openai_client, args.requests, args.concurrency)
+        calls = (server.requests - requests_before) / args.requests
+        launched = hedging.HEDGES.value(outcome='launched') - launched_before
+        won = hedging.HEDGES.value(outcome='won') - won_before
+        print(f"{name:12} {percentile(durations, 0.5) * 1000:8.0f} {percentile(durations, 0.95) * 1000:8.0f} "
+              f"{percentile(durations, 0.99) * 1000:8.0f} {max(durations) * 1000:8.0f} {calls:10.2f} "
+              f"{f'{won}/{launched}':>11}")
+
+
+if __name__ == '__main__':
+    main()
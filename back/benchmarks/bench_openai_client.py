@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Throughput of the shared OpenAI client layer under concurrent uploads,
+measured against the local fake server (no network access needed).
+
+    python benchmarks/bench_openai_client.py --requests 200 --concurrency 50 --latency 0.5
+
+Each request is driven from its own thread, like a Flask worker thread calling
+analyze_animal_bytes. The report includes how many TCP connections the fake
+server saw, which shows whether connections are being reused.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+from fake_openai import FakeOpenAIServer
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.5)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(('127.0.0.1', 0), latency=args.latency).start()
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+    os.environ.setdefault('OPENAI_MAX_CONCURRENCY', str(args.concurrency))
+
+    from analysis import analyze_animal_bytes
+    import openai_client
+    openai_client.warm_up()
+
+    image_bytes = b'\xff\xd8' + b'\x00' * 50_000  # payload size is what matters here
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda _: analyze_animal_bytes(image_bytes), range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    ok = sum(1 for result in results if result and result.startswith('**animal:**'))
+    print(f"requests:      {args.requests} ({ok} ok)")
+    print(f"concurrency:   {args.concurrency}")
+    print(f"elapsed:       {elapsed:.2f} s")
+    print(f"throughput:    {args.requests / elapsed:.1f} req/s "
+          f"(ideal {args.concurrency / args.latency:.1f} req/s)")
+    print(f"server saw:    {server.requests} requests over {len(server.connections)} connections")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Cost of the payment checks, and of creating intents, against a local fake
+Stripe (benchmarks/fake_stripe.py); no network needed.
+
+  verify       checking a usage token's signature and expiry
+  redeem       verify plus spending it in the sqlite store (a fresh token each time)
+  intents      PaymentIntent creation from --threads threads, the old way
+               (stripe.PaymentIntent.create on the global, synchronous client)
+               vs payments.create_intent (pooled async client, idempotency key)
+
+Also checks that a repeated idempotency key gets the same intent back.
+
+    python benchmarks/bench_payments.py --latency 0.2 --threads 8 --intents 64
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+import results
+from fake_stripe import FakeStripeServer
+
+
+def per_call(function, count):
+    start = time.perf_counter()
+    for number in range(count):
+        function(number)
+    return (time.perf_counter() - start) / count
+
+
+def create_concurrently(create, threads, count):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(share):
+        for _ in range(share):
+            start = time.perf_counter()
+            create()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=client, args=(count // threads,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return {'intents_per_sec': len(latencies) / elapsed, 'latency': results.percentiles(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.2, help='fake Stripe latency in seconds (default 0.2)')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--intents', type=int, default=64, help='intents created per mode')
+    parser.add_argument('--tokens', type=int, default=20000, help='tokens verified and redeemed')
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeStripeServer(('127.0.0.1', 0), latency=args.latency).start()
+    os.environ.update(STRIPE_API_BASE=server.base_url, STRIPE_SECRET_KEY='sk_test_bench')
+    import payments
+    import stripe
+
+    with tempfile.TemporaryDirectory() as directory:
+        service = payments.Payments(payments.PaymentStore(os.path.join(directory, 'payments.sqlite3')),
+                                    payments.UsageTokens('bench-secret'))
+        token, _ = service.tokens.issue('pi_bench')
+        tokens = [service.tokens.issue(f'pi_{number}')[0] for number in range(args.tokens)]
+        metrics = {
+            'verify_us': per_call(lambda number: service.tokens.verify(token), args.tokens) * 1e6,
+            'redeem_us': per_call(lambda number: service.redeem(tokens[number]), args.tokens) * 1e6,
+        }
+
+    stripe.api_key = 'sk_test_bench'
+    stripe.api_base = server.base_url
+    modes = {
+        'global_sync': lambda: stripe.PaymentIntent.create(
+            amount=payments.PRICE_CENTS, currency=payments.CURRENCY, automatic_payment_methods={'enabled': True},
+            metadata={'product_id': 'prod_bench', 'service': payments.SERVICE}),
+        'pooled_async': lambda: payments.create_intent('prod_bench'),
+    }
+    for label, create in modes.items():
+        create()  # Import and client setup aren't what's being compared
+        with server.lock:
+            server.connections.clear()
+        metrics[label] = create_concurrently(create, args.threads, args.intents)
+        metrics[label]['connections'] = len(server.connections)
+
+    first = payments.create_intent('prod_bench', idempotency_key='bench-retry')
+    again = payments.create_intent('prod_bench', idempotency_key='bench-retry')
+    metrics['idempotent_retry_same_intent'] = first.id == again.id
+    server.shutdown()
+
+    print(f"token verify {metrics['verify_us']:.1f} us, verify + redeem {metrics['redeem_us']:.1f} us")
+    print(f"{args.intents} intents from {args.threads} threads, fake Stripe latency {args.latency:g}s")
+    print(f"{'client':13} {'intents/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'connections':>11}")
+    for label in modes:
+        result = metrics[label]
+        print(f"{label:13} {result['intents_per_sec']:9.1f} {result['latency'].get('p50_ms', 0):8.1f} "
+              f"{result['latency'].get('p99_ms', 0):8.1f} {result['connections']:11d}")
+    print(f"retry with the same idempotency key returned the same intent: {metrics['idempotent_retry_same_intent']}")
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance')}
+    return results.finish(args, 'payments', config, metrics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
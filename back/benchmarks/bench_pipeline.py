@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Stage-by-stage timings of the prediction pipeline on the images in image/.
+
+  segmentation  remove_background(path, output_path): decode, U2NetP, composite, JPEG to disk
+  analysis      analyze_animal_api(segmented_path): the vision call, against the local fake
+                OpenAI server (configurable latency and error injection; no network needed)
+
+Each stage is timed cold (its first call in this process: session loading
+or client creation included) and warm (--rounds passes over every image),
+with p50/p95/p99 per call, plus this process's peak RSS after each stage.
+Results can be written as JSON and checked against an earlier run, see
+benchmarks/results.py.
+
+    python benchmarks/bench_pipeline.py --rounds 3 -o pipeline.json
+    python benchmarks/bench_pipeline.py --latency 0.5 --error-rate 0.1 --baseline pipeline.json
+    python benchmarks/bench_pipeline.py --stages analysis   # originals straight to the vision call
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+import results
+from fake_openai import FakeOpenAIServer
+
+IMAGE_DIR = os.path.join(BACK_DIR, '..', 'image')
+STAGES = ('segmentation', 'analysis')
+
+
+def time_calls(fn, inputs):
+    """Seconds per call, in input order"""
+    samples = []
+    for item in inputs:
+        start = time.perf_counter()
+        fn(item)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_stage(fn, inputs, rounds):
+    cold = time_calls(fn, inputs[:1])[0]
+    warm = []
+    for _ in range(rounds):
+        warm.extend(time_calls(fn, inputs))
+    return {'cold_ms': cold * 1000, 'warm': results.percentiles(warm), 'peak_rss_mb': results.peak_rss_mb()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=IMAGE_DIR)
+    parser.add_argument('--rounds', type=int, default=3, help='warm passes over the images (default 3)')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma-separated subset of: ' + ', '.join(STAGES))
+    parser.add_argument('--latency', type=float, default=0.2, help='fake vision latency in seconds')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='seconds between streamed chunks')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of vision calls that fail')
+    parser.add_argument('--error-status', type=int, default=500)
+    results.add_arguments(parser)
+    args = parser.parse_args()
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    from pipeline import IMAGE_EXTENSIONS
+    paths = [os.path.join(args.images, name) for name in sorted(os.listdir(args.images))
+             if name.lower().endswith(IMAGE_EXTENSIONS)]
+    if not paths:
+        parser.error(f"no images in {args.images}")
+
+    metrics = {'images': len(paths), 'baseline_rss_mb': results.peak_rss_mb()}
+    analysis_inputs = paths
+    with tempfile.TemporaryDirectory() as output_dir:
+        if 'segmentation' in stages:
+            from background_remover import remove_background
+            outputs = {path: os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + '.jpg')
+                       for path in paths}
+            metrics['segmentation'] = run_stage(lambda path: remove_background(path, outputs[path]),
+                                                paths, args.rounds)
+            analysis_inputs = [outputs[path] for path in paths]
+
+        if 'analysis' in stages:
+            server = FakeOpenAIServer(('127.0.0.1', 0), latency=args.latency, chunk_delay=args.chunk_delay,
+                                      error_rate=args.error_rate, error_status=args.error_status).start()
+            os.environ['OPENAI_BASE_URL'] = server.base_url
+            os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+            from analysis import analyze_animal_api
+            from metrics import FALLBACKS
+
+            failures = []
+
+            def analyze(path):
+                reply = analyze_animal_api(path)
+                if not reply or reply.startswith('Error'):
+                    failures.append(path)
+
+            fallbacks = FALLBACKS.value()
+            metrics['analysis'] = run_stage(analyze, analysis_inputs, args.rounds)
+            calls = len(analysis_inputs) * args.rounds + 1
+            metrics['analysis']['error_rate'] = len(failures) / calls
+            metrics['analysis']['fallbacks'] = FALLBACKS.value() - fallbacks
+            metrics['analysis']['provider_requests'] = server.requests
+            metrics['analysis']['provider_errors'] = server.errors_sent
+            server.shutdown()
+
+    print(f"{len(paths)} images, {args.rounds} warm rounds")
+    print(f"{'stage':13} {'cold ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak MB':>8}")
+    for stage in stages:
+        result = metrics[stage]
+        warm = result['warm']
+        print(f"{stage:13} {result['cold_ms']:9.1f} {warm['p50_ms']:8.1f} {warm['p95_ms']:8.1f} "
+              f"{warm['p99_ms']:8.1f} {result['peak_rss_mb']:8.1f}")
+    if 'analysis' in stages:
+        print(f"analysis errors: {metrics['analysis']['error_rate']:.1%}, "
+              f"{metrics['analysis']['provider_errors']} injected by the fake server")
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance')}
+    return results.finish(args, 'pipeline', config, metrics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Before/after comparison of the preprocessing stage over the samples in image/.
+
+  before: full-resolution image, JPEG quality 95 (the old payload)
+  after:  resized to the vision model's effective resolution, encoded for the
+          VISION_MAX_BYTES budget in VISION_FORMAT
+
+    python benchmarks/bench_preprocess.py               # encode bytes + latency
+    python benchmarks/bench_preprocess.py --segment     # + U2NetP full-res vs 320px input
+    python benchmarks/bench_preprocess.py --labels      # + label agreement (needs OPENAI_API_KEY)
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+from PIL import Image
+from preprocess import normalize_image, resize_for_vision, resize_for_segmentation, encode_for_budget, vision_tiles
+
+IMAGE_DIR = os.path.join(BACK_DIR, '..', 'image')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp')
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    return value, time.perf_counter() - start
+
+def encode_baseline(image):
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+def encode_preprocessed(image):
+    return encode_for_budget(resize_for_vision(image))
+
+def label_of(image_bytes, mime_type):
+    from analysis import analyze_animal_bytes
+    from animal_analyzer import extract_and_validate_animal
+    animal_name, _, _ = extract_and_validate_animal(analyze_animal_bytes(image_bytes, mime_type))
+    return animal_name
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=IMAGE_DIR)
+    parser.add_argument('--segment', action='store_true', help='also time U2NetP at full size vs 320px')
+    parser.add_argument('--labels', action='store_true', help='also compare vision labels (calls the API)')
+    args = parser.parse_args()
+
+    if args.segment:
+        from session_pool import get_session_pool
+        pool = get_session_pool().warm_up()
+
+    rows = []
+    for name in sorted(os.listdir(args.images)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with Image.open(os.path.join(args.images, name)) as source:
+            image = normalize_image(source)
+
+        before, before_time = timed(encode_baseline, image)
+        (after, mime_type, quality), after_time = timed(encode_preprocessed, image)
+        row = {
+            'name': name, 'size': image.size, 'tiles': vision_tiles(image.size),
+            'before_bytes': len(before), 'after_bytes': len(after), 'quality': quality,
+            'before_ms': before_time * 1000, 'after_ms': after_time * 1000,
+        }
+
+        if args.segment:
+            _, full_time = timed(pool.predict_mask, image)
+            _, small_time = timed(pool.predict_mask, resize_for_segmentation(resize_for_vision(image)))
+            row['segment_full_ms'] = full_time * 1000
+            row['segment_320_ms'] = small_time * 1000
+
+        if args.labels:
+            row['before_label'] = label_of(before, 'image/jpeg')
+            row['after_label'] = label_of(after, mime_type)
+
+        rows.append(row)
+        print(f"{name[:40]:40s} {row['size'][0]:5d}x{row['size'][1]:<5d} "
+              f"{row['before_bytes'] / 1024:8.1f} KB -> {row['after_bytes'] / 1024:7.1f} KB (q{quality}) "
+              f"{row['before_ms']:7.1f} -> {row['after_ms']:6.1f} ms")
+
+    print()
+    total_before = sum(row['before_bytes'] for row in rows)
+    total_after = sum(row['after_bytes'] for row in rows)
+    print(f"payload bytes:   {total_before / 1024:.0f} KB -> {total_after / 1024:.0f} KB "
+          f"({100 * (1 - total_after / total_before):.0f}% smaller)")
+    print(f"encode median:   {statistics.median(r['before_ms'] for r in rows):.1f} ms -> "
+          f"{statistics.median(r['after_ms'] for r in rows):.1f} ms")
+    if args.segment:
+        print(f"segment median:  {statistics.median(r['segment_full_ms'] for r in rows):.1f} ms -> "
+              f"{statistics.median(r['segment_320_ms'] for r in rows):.1f} ms")
+    if args.labels:
+        agree = sum(1 for r in rows if r['before_label'] == r['after_label'])
+        print(f"label agreement: {agree}/{len(rows)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Prompt size and static share of the vision request, old layout vs new.
+
+  legacy      free-text prompt with the animal list, markdown reply (before prompts.py)
+  markdown    prompts.py with OPENAI_STRUCTURED_OUTPUT=false
+  structured  prompts.py with the JSON-schema reply (the default)
+
+For each layout and image detail: estimated prompt tokens per request (the
+fake server's estimate: about four characters a token, 85 tokens for a low
+detail image, 765 for a 768x768 high detail one), how much of that is a
+static prefix, how many bytes of the prompt as the model sees it (response
+schema, then the messages) are the same for two different images, and the
+completion tokens of the same answer in the layout's reply format. No
+network needed.
+
+    python benchmarks/bench_prompt.py
+"""
+import json
+import os
+import sys
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+import prompts
+from fake_openai import DEFAULT_REPLY, as_json, estimate_usage
+
+LEGACY_ANIMALS = """
+    leopard, lion, tiger, elephant, panda, bear, koala, gorilla, orangutan, dog, poodle, wolf, fox, raccoon, cat, cow, ox, buffalo, pig, boar, goat, sheep, ram, deer, horse, zebra, giraffe, camel, llama, hippopotamus, rhinoceros, kangaroo, bat, mouse, rat, rabbit, chipmunk, hedgehog,chick, rooster, chicken, turkey, duck, swan, eagle, dove, flamingo, peacock, parrot, penguin,fish, tropical_fish, blowfish, shark, whale, octopus, crab, lobster, shrimp, squid,snail, butterfly, bug, ant, honeybee, cricket, spider, scorpion, mosquito,turtle, crocodile, lizard, snake, frog,dragon, unicorn,dinosaur
+"""
+
+LEGACY_PROMPT = f"""
+VIBE ANIMAL MATCH
+
+What animal best represents this energy and style? You MUST choose from the following predefined animals only:
+
+{LEGACY_ANIMALS}
+
+Please respond in the following format:
+
+**animal:** [ANIMAL_NAME_FROM_THE_LIST_ABOVE]
+**Explanation:** [Explanation of the vibe represented by the input]
+**Connection:** [With simplified bullet points, Connection of the vibe and visual elements to the chosen animal. Elaborate on why this animal *feels right* for this aesthetic.]
+
+IMPORTANT: You must choose an animal name that exactly matches one from the list above. Do not use variations or similar names.
+"""
+
+
+def legacy_request(image_url, detail):
+    image = {'url': image_url}
+    if detail != 'auto':
+        image['detail'] = detail
+    return dict(model='gpt-4o', messages=[{'role': 'user', 'content': [
+        {'type': 'text', 'text': LEGACY_PROMPT},
+        {'type': 'image_url', 'image_url': image},
+    ]}], max_tokens=300)
+
+
+def model_view(request):
+    # The schema goes in front of the messages in the prompt the model sees
+    return json.dumps([request.get('response_format'), request['messages']])
+
+
+def common_prefix(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def main():
+    layouts = [
+        ('legacy', legacy_request),
+        ('markdown', lambda url, detail: prompts.vision_request(url, structured=False, detail=detail)),
+        ('structured', lambda url, detail: prompts.vision_request(url, structured=True, detail=detail)),
+    ]
+    first, second = 'data:image/jpeg;base64,AAAA', 'data:image/jpeg;base64,BBBB'
+    print(f"{'layout':11} {'detail':6} {'prompt tok':>10} {'static tok':>10} {'same bytes':>10} {'reply tok':>9}")
+    for label, build in layouts:
+        for detail in ('auto', 'low'):
+            request = build(first, detail)
+            reply = DEFAULT_REPLY
+            if 'response_format' in request:
+                reply = as_json(DEFAULT_REPLY, request['response_format']['json_schema']['schema'])
+            prompt, static, completion = estimate_usage(request, reply)
+            if label == 'legacy':
+                # One message, but everything before the image is the same on every call
+                static = len(LEGACY_PROMPT) // 4
+            same = common_prefix(model_view(request), model_view(build(second, detail)))
+            print(f"{label:11} {detail:6} {prompt:10d} {static:10d} {same:10d} {completion:9d}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of response parsing: the current single-pass parser against
+the previous line-splitting implementation, over a corpus of vision replies
+in the shapes gpt-4o actually produces (exact names, plurals, two-word names,
+typos, apologies), after checking the current parser's labels for answers
+that are easy to get wrong.
+
+    python benchmarks/bench_response_parser.py --rounds 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+from animal_analyzer import AVAILABLE_ANIMALS, extract_and_validate_animal, normalize_animal_name
+
+BODY = """**Explanation:** Calm confidence with a playful streak; the styling is bold but relaxed.
+**Connection:**
+- Warm tones and a steady gaze suggest quiet strength
+- The relaxed posture reads as someone comfortable leading
+- Small playful details keep it approachable"""
+
+CORPUS = [
+    f"**animal:** lion\n{BODY}",
+    f"**Animal:** Tigers\n{BODY}",
+    f"**animal:** polar bear\n{BODY}",
+    f"**animal:** [fox]\n{BODY}",
+    f"Here is your match!\n\n**animal:** Wolves\n{BODY}",
+    f"**animal:** elefant\n{BODY}",
+    f"Spirit animal: Hippo\n{BODY}",
+    f"**animal:** tropical fish\n{BODY}",
+    f"**animal:** butterflies\n{BODY}",
+    f"**animal:** bird\n{BODY}",
+    "I'm sorry, I can't help with identifying people in images.",
+    f"Penguin\n{BODY}",
+]
+
+# Answer -> the label it must resolve to (None: no valid label)
+CHECKS = {
+    'Koala Bear': 'koala',
+    'majestic koala bear': 'koala',
+    'polar bear': 'bear',
+    'majestic lion': 'lion',
+    'puppy dog': 'dog',
+    'cat or dog': None,
+    'cats and dogs': None,
+    'sea lion': None,
+    'baby sea lions': None,
+    'guinea pig': None,
+    'hog': None,
+    'gnat': None,
+    'moose': None,
+    'beaver': None,
+    'elephnt': 'elephant',
+    'pengiun': 'penguin',
+}
+
+# The implementation this parser replaced, kept here for comparison
+def legacy_normalize_animal_name(animal_name):
+    if not animal_name:
+        return None
+    normalized = animal_name.lower().strip()
+    if normalized in AVAILABLE_ANIMALS:
+        return normalized
+    variations = {
+        'tiger': ['tiger', 'tigers'], 'lion': ['lion', 'lions'], 'elephant': ['elephant', 'elephants'],
+        'bear': ['bear', 'bears', 'grizzly', 'polar_bear'], 'cat': ['cat', 'cats', 'kitten', 'kitty'],
+        'dog': ['dog', 'dogs', 'puppy', 'pup'], 'fox': ['fox', 'foxes'], 'wolf': ['wolf', 'wolves'],
+        'deer': ['deer', 'deers'], 'horse': ['horse', 'horses', 'pony'], 'bird': ['bird', 'birds'],
+        'fish': ['fish', 'fishes'], 'butterfly': ['butterfly', 'butterflies'], 'dragon': ['dragon', 'dragons'],
+        'unicorn': ['unicorn', 'unicorns'], 'dinosaur': ['dinosaur', 'dinosaurs', 't-rex', 'trex'],
+    }
+    for standard_name, variants in variations.items():
+        if normalized in variants and standard_name in AVAILABLE_ANIMALS:
+            return standard_name
+    return None
+
+def legacy_extract_and_validate_animal(response_text):
+    if not response_text:
+        return None, False, response_text
+    lines = response_text.split('\n')
+    animal_name = None
+    for line in lines:
+        line = line.strip()
+        if '**animal:**' in line.lower() or 'animal:' in line.lower():
+            parts = line.split(':', 1)
+            if len(parts) > 1:
+                animal_name = parts[1].strip().replace('**', '').replace('*', '').strip()
+                break
+    if not animal_name and lines:
+        animal_name = lines[0].strip().replace('**', '').replace('*', '').strip()
+    normalized_name = legacy_normalize_animal_name(animal_name)
+    return normalized_name, normalized_name is not None, response_text
+
+def bench(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for response in CORPUS:
+            fn(response)
+    return (time.perf_counter() - start) / (rounds * len(CORPUS)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    wrong = {answer: normalize_animal_name(answer) for answer, expected in CHECKS.items()
+             if normalize_animal_name(answer) != expected}
+    for answer, label in wrong.items():
+        print(f"label check failed: {answer!r} -> {label!r}, expected {CHECKS[answer]!r}")
+    print(f"label checks: {len(CHECKS) - len(wrong)}/{len(CHECKS)} passed")
+    print()
+
+    print(f"{'response':34s} {'legacy':>10s} {'current':>14s}")
+    for response in CORPUS:
+        first_line = next(line for line in response.split('\n') if line.strip())
+        print(f"{first_line[:34]:34s} {str(legacy_extract_and_validate_animal(response)[0]):>10s} "
+              f"{str(extract_and_validate_animal(response)[0]):>14s}")
+
+    legacy_valid = sum(legacy_extract_and_validate_animal(r)[1] for r in CORPUS)
+    current_valid = sum(extract_and_validate_animal(r)[1] for r in CORPUS)
+    print()
+    print(f"valid labels:  legacy {legacy_valid}/{len(CORPUS)}, current {current_valid}/{len(CORPUS)}")
+    print(f"per response:  legacy {bench(legacy_extract_and_validate_animal, args.rounds):.1f} us, "
+          f"current {bench(extract_and_validate_animal, args.rounds):.1f} us")
+    return 1 if wrong else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
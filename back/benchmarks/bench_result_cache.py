@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Benchmark the result cache: run every sample in image/ through the pipeline
+twice and compare first-pass (miss) and second-pass (hit) latency.
+
+    python benchmarks/bench_result_cache.py
+    python benchmarks/bench_result_cache.py --offline 1.5   # no model/API needed
+
+--offline replaces background removal + the vision call with a fixed delay,
+so the cache effect can be measured on a laptop without credentials.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+import pipeline
+from result_cache import get_result_cache
+
+IMAGE_DIR = os.path.join(BACK_DIR, '..', 'image')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp')
+
+def load_samples(image_dir):
+    samples = []
+    for name in sorted(os.listdir(image_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(image_dir, name), 'rb') as f:
+                samples.append((name, f.read()))
+    return samples
+
+def run_pass(samples):
+    timings = []
+    for name, data in samples:
+        start = time.perf_counter()
+        output = pipeline.predict_image_bytes(data)
+        timings.append(time.perf_counter() - start)
+        print(f"  {name[:50]:50s} {output['cache']:8s} {timings[-1] * 1000:9.1f} ms")
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=IMAGE_DIR)
+    parser.add_argument('--offline', type=float, metavar='SECONDS',
+                        help='simulate the uncached stages with a fixed delay')
+    args = parser.parse_args()
+
+    if args.offline is not None:
+        pipeline.remove_background_image = lambda image: image.convert('RGB')
+        def fake_analyze(image_bytes, *_, **__):
+            time.sleep(args.offline)
+            return "**animal:** cat\n**Explanation:** offline benchmark\n**Connection:** -"
+        pipeline.analyze_animal_bytes = fake_analyze
+
+    samples = load_samples(args.images)
+    print(f"{len(samples)} images from {os.path.abspath(args.images)}")
+
+    print("Pass 1 (cold cache)")
+    cold = run_pass(samples)
+    print("Pass 2 (warm cache)")
+    warm = run_pass(samples)
+
+    print()
+    print(f"cold median: {statistics.median(cold) * 1000:9.1f} ms")
+    print(f"warm median: {statistics.median(warm) * 1000:9.1f} ms")
+    for tier, stats in get_result_cache().stats().items():
+        print(f"{tier:10s} hit_rate={stats['hit_rate']:.2f} entries={stats['entries']} bytes={stats['bytes']}")
+
+if __name__ == '__main__':
+    main()
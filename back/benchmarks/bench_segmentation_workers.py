@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Background removal with U2NetP in-process (the session pool) vs in worker
+processes (SEGMENTATION_WORKERS), under concurrent request threads.
+
+Each of --threads threads runs remove_background_array over the samples in
+image/ and then --json-kb of JSON encoding and decoding, a stand-in for the
+GIL-bound work request threads do besides segmentation. Reported:
+images/sec, latency percentiles per image and, for the workers, how much
+of the segmentation time was hand-off (shared memory copies and the pipe)
+rather than inference.
+
+    python benchmarks/bench_segmentation_workers.py --threads 8 --workers 2 4
+    python benchmarks/bench_segmentation_workers.py --rounds 5 -o segmentation_workers.json
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+from PIL import Image
+
+import results
+from background_remover import remove_background_array
+from pipeline import iter_image_files
+
+IMAGE_DIR = os.path.join(BACK_DIR, '..', 'image')
+
+
+def run(images, threads, rounds, json_kb):
+    document = {'items': [{'label': f'item {number}', 'score': number / 7} for number in range(json_kb * 20)]}
+    latencies = []
+    lock = threading.Lock()
+
+    def client(offset):
+        for number in range(rounds * len(images)):
+            image = images[(offset + number) % len(images)]
+            start = time.perf_counter()
+            remove_background_array(image)
+            json.loads(json.dumps(document))
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=client, args=(offset,)) for offset in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return {'images_per_sec': len(latencies) / elapsed, 'latency': results.percentiles(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=IMAGE_DIR)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--workers', type=int, nargs='+', default=[2], help='worker process counts to try')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--json-kb', type=int, default=64, help='JSON work per image, roughly in KB')
+    results.add_arguments(parser)
+    args = parser.parse_args()
+
+    images = []
+    for _, data in iter_image_files([args.images]):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        images.append(image)
+
+    import segmentation_service
+    metrics = {}
+    for workers in [0] + args.workers:
+        os.environ['SEGMENTATION_WORKERS'] = str(workers)
+        segmenter = segmentation_service.get_segmenter().warm_up()
+        label = f'workers_{workers}' if workers else 'in_process'
+        metrics[label] = run(images, args.threads, args.rounds, args.json_kb)
+        if workers:
+            stats = segmenter.metrics()['workers']
+            busy = sum(worker['busy_seconds_total'] for worker in stats)
+            inference = sum(worker['inference_seconds_total'] for worker in stats)
+            metrics[label]['handoff_share'] = (busy - inference) / busy if busy else 0.0
+            segmenter.close()
+            segmentation_service._service = None
+
+    print(f"{len(images)} images x {args.rounds} rounds on {args.threads} threads")
+    print(f"{'segmentation':14} {'img/s':>7} {'p50 ms':>8} {'p99 ms':>8} {'hand-off':>9}")
+    for label, result in metrics.items():
+        handoff = f"{result['handoff_share']:.1%}" if 'handoff_share' in result else '-'
+        print(f"{label:14} {result['images_per_sec']:7.2f} {result['latency'].get('p50_ms', 0):8.1f} "
+              f"{result['latency'].get('p99_ms', 0):8.1f} {handoff:>9}")
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance')}
+    return results.finish(args, 'segmentation_workers', config, metrics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
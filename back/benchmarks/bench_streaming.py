@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Streamed vs buffered vision replies against the local fake server.
+
+Every other reply names an animal that isn't in the dataset, so half the
+attempts are doomed. Buffered mode reads each of them to the end before
+validating; streamed mode cancels them at the animal line and hands the
+valid label over while the explanation is still arriving.
+
+    python benchmarks/bench_streaming.py --rounds 10 --chunk-delay 0.02
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import FakeOpenAIServer, DEFAULT_REPLY
+
+INVALID_REPLY = """**animal:** griffin
+**Explanation:** Regal and a little mythical, equal parts lion and eagle.
+**Connection:**
+- Sharp focus and a commanding stance
+- A touch of the fantastic in the styling"""
+
+
+def measure(analysis, openai_client, server, rounds, stream):
+    os.environ['OPENAI_STREAM'] = 'true' if stream else 'false'
+    label_times, total_times = [], []
+    chars_before = server.sent_chars
+    for _ in range(rounds):
+        start = time.perf_counter()
+        labelled = []
+        openai_client.run(analysis.analyze_animal_async(
+            b'fake-image', on_label=lambda animal: labelled.append(time.perf_counter())))
+        total_times.append(time.perf_counter() - start)
+        label_times.append((labelled[0] if labelled else time.perf_counter()) - start)
+    return {
+        'label_ms': statistics.mean(label_times) * 1000,
+        'total_ms': statistics.mean(total_times) * 1000,
+        'sent_chars': (server.sent_chars - chars_before) / rounds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streamed vs buffered vision replies')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds before the first chunk')
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help='seconds between 4-character chunks')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(('127.0.0.1', 0), latency=args.latency, chunk_delay=args.chunk_delay,
+                              reply=[INVALID_REPLY, DEFAULT_REPLY]).start()
+    os.environ['OPENAI_BASE_URL'] = server.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+    import analysis
+    import openai_client
+
+    print(f"{'mode':10} {'label ms':>10} {'total ms':>10} {'chars/req':>10}")
+    for stream in (False, True):
+        result = measure(analysis, openai_client, server, args.rounds, stream)
+        print(f"{'streamed' if stream else 'buffered':10} {result['label_ms']:10.1f} "
+              f"{result['total_ms']:10.1f} {result['sent_chars']:10.1f}")
+    print(f"cancelled streams: {server.cancelled_streams}")
+
+
+if __name__ == '__main__':
+    main()
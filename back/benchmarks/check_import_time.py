@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Startup regression check: how long `import app` takes, and what it pulls in.
+
+Imports the app in fresh interpreters, with warm-up off (under python -X
+importtime) and in the default background mode, and fails (exit status 1)
+if the best time in either mode exceeds the budget or if, with warm-up off,
+any of the libraries that are meant to load lazily (warmup.HEAVY_MODULES,
+minus numpy) got imported. Prints the slowest modules either way. In
+background mode the warm-up thread is loading those libraries while the
+import runs, so only its time is checked; each of those runs waits for the
+warm-up to finish before exiting.
+
+    python benchmarks/check_import_time.py --budget-ms 600 --runs 3
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+from warmup import HEAVY_MODULES
+
+# numpy is needed by the pipeline's own modules and is cheap next to the rest
+LAZY_MODULES = tuple(name for name in HEAVY_MODULES if name != 'numpy')
+
+PROBE = f"""
+import sys
+import time
+start = time.perf_counter()
+import app
+print('SECONDS', time.perf_counter() - start)
+print('LOADED', ','.join(name for name in {LAZY_MODULES!r} if name in sys.modules))
+"""
+
+
+def time_import(mode):
+    """Wall-clock seconds `import app` takes with STARTUP_WARMUP=mode"""
+    env = dict(os.environ, STARTUP_WARMUP=mode)
+    result = subprocess.run([sys.executable, '-c', PROBE],
+                            cwd=BACK_DIR, env=env, capture_output=True, text=True, check=True)
+    return float(result.stdout.split('SECONDS', 1)[1].split()[0])
+
+
+def profile_import():
+    """With warm-up off: (total seconds, [(cumulative seconds, module)], eagerly loaded lazy modules)"""
+    env = dict(os.environ, STARTUP_WARMUP='off')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE],
+                            cwd=BACK_DIR, env=env, capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative) / 1e6, name.strip()))
+    loaded = result.stdout.split('LOADED', 1)[1].strip()
+    total = next(seconds for seconds, name in reversed(modules) if name == 'app')
+    return total, modules, [name for name in loaded.split(',') if name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=600)
+    parser.add_argument('--runs', type=int, default=3, help='fresh interpreters; the fastest counts')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [profile_import() for _ in range(args.runs)]
+    total, modules, loaded = min(runs, key=lambda run: run[0])
+    background = min(time_import('background') for _ in range(args.runs))
+
+    print(f"import app: {total * 1000:.0f} ms with warm-up off, {background * 1000:.0f} ms in background mode "
+          f"(budget {args.budget_ms:.0f} ms)")
+    print("slowest top-level imports:")
+    top_level = [(seconds, name) for seconds, name in modules if '.' not in name and name != 'app']
+    for seconds, name in sorted(top_level, reverse=True)[:args.top]:
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+    failed = False
+    for mode, seconds in (('off', total), ('background', background)):
+        if seconds * 1000 > args.budget_ms:
+            print(f"FAIL: import with warm-up {mode} took {seconds * 1000:.0f} ms, "
+                  f"over the {args.budget_ms:.0f} ms budget")
+            failed = True
+    if loaded:
+        print(f"FAIL: imported eagerly, should load lazily: {', '.join(loaded)}")
+        failed = True
+    if not failed:
+        print("OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Answers POST /v1/chat/completions with a canned spirit-animal reply after a
+configurable delay, so the client layer can be exercised without network
+access. Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Requests with "stream": true get the reply as chunked server-sent events,
+`chunk_size` characters every `chunk_delay` seconds, like the real API's
+token stream; non-streaming replies take the same total time. When several
+replies are given they are served in turn.
+
+Requests with a json_schema response_format get the reply as the JSON
+object the schema asks for (markdown replies are converted). Usage is
+estimated (about four characters a token, gpt-4o's image pricing) and
+reported like the real API's, including in the last chunk of streams that
+ask for it; a prompt prefix of 1024+ tokens seen before counts as cached, in
+128-token steps, the way OpenAI's prompt cache bills.
+
+Faults can be injected: an `error_rate` fraction of requests is answered
+with `error_status` (500 by default; 429 also sends Retry-After) after the
+usual latency, and a `tail_fraction` of requests waits `tail_latency`.
+
+    python benchmarks/fake_openai.py --port 8089 --latency 0.8 --chunk-delay 0.02
+    python benchmarks/fake_openai.py --error-rate 0.05 --error-status 429 --tail-latency 5 --tail-fraction 0.01
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = """**animal:** lion
+**Explanation:** Confident, warm and unmistakably in charge of the frame.
+**Connection:**
+- Bold posture reads as a natural leader
+- Golden tones echo a lion's mane"""
+
+_FIELD = re.compile(r'^\*\*(animal|Explanation|Connection):\*\*[ \t]*(.*)$', re.MULTILINE)
+
+CHARS_PER_TOKEN = 4
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+
+
+def as_json(reply, schema):
+    """A markdown reply as the object `schema` describes (fields it doesn't have are dropped)"""
+    fields = {}
+    matches = list(_FIELD.finditer(reply))
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(reply)
+        fields[match.group(1).lower()] = (match.group(2) + reply[match.end():end]).strip()
+    connection = [line.strip().lstrip('- ').strip() for line in fields.get('connection', '').splitlines()]
+    fields['connection'] = [line for line in connection if line]
+    return json.dumps({name: fields.get(name, '') for name in schema.get('properties', {})})
+
+
+def _message_tokens(message):
+    content = message.get('content')
+    parts = [{'type': 'text', 'text': content}] if isinstance(content, str) else content or []
+    tokens = 0
+    for part in parts:
+        if part.get('type') == 'text':
+            tokens += len(part['text']) // CHARS_PER_TOKEN
+        elif part.get('type') == 'image_url':
+            # Low detail is a flat 85; take high as a 768x768 image, 4 tiles
+            tokens += 85 if part['image_url'].get('detail') == 'low' else 85 + 4 * 170
+    return tokens
+
+
+def estimate_usage(body, reply):
+    """
+    (prompt tokens, tokens of the static prefix, completion tokens), roughly.
+    The prefix is the response format plus every message but the last.
+    """
+    messages = body.get('messages', [])
+    prefix = sum(_message_tokens(message) for message in messages[:-1])
+    if body.get('response_format'):
+        prefix += len(json.dumps(body['response_format'])) // CHARS_PER_TOKEN
+    prompt = prefix + sum(_message_tokens(message) for message in messages[-1:])
+    return prompt, prefix, -(-len(reply) // CHARS_PER_TOKEN)
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, reply=DEFAULT_REPLY, chunk_delay=0.0, chunk_size=4,
+                 tail_latency=0.0, tail_fraction=0.0, error_rate=0.0, error_status=500):
+        super().__init__(address, FakeOpenAIHandler)
+        self.latency = latency
+        # A `tail_fraction` of requests take `tail_latency` instead, for a heavy tail
+        self.tail_latency = tail_latency
+        self.tail_fraction = tail_fraction
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.replies = [reply] if isinstance(reply, str) else list(reply)
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = set()
+        self.sent_chars = 0  # reply characters actually written to clients
+        self.cancelled_streams = 0  # streams the client hung up on
+        self.errors_sent = 0  # injected error responses
+        self.seen_prefixes = set()  # static prompt prefixes, for the simulated prompt cache
+        self.usage = {'prompt': 0, 'cached_prompt': 0, 'completion': 0}
+
+    def next_latency(self):
+        return self.tail_latency if random.random() < self.tail_fraction else self.latency
+
+    def next_error(self):
+        """True if the current request should fail"""
+        return random.random() < self.error_rate
+
+    def next_reply(self):
+        with self.lock:
+            return self.replies[(self.requests - 1) % len(self.replies)]
+
+    def usage_for(self, body, reply):
+        """The usage block for a reply, counting it towards self.usage"""
+        prompt, prefix, completion = estimate_usage(body, reply)
+        key = json.dumps([body.get('model'), body.get('response_format'), body.get('messages', [])[:-1]])
+        with self.lock:
+            cached = prefix >= CACHE_MIN_TOKENS and key in self.seen_prefixes
+            self.seen_prefixes.add(key)
+            cached_tokens = prefix // CACHE_STEP_TOKENS * CACHE_STEP_TOKENS if cached else 0
+            self.usage['prompt'] += prompt
+            self.usage['cached_prompt'] += cached_tokens
+            self.usage['completion'] += completion
+        return {'prompt_tokens': prompt, 'completion_tokens': completion, 'total_tokens': prompt + completion,
+                'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Serve from a daemon thread and return self"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.connections.add(self.client_address)
+
+        time.sleep(self.server.next_latency())
+        if self.server.next_error():
+            self._send_error()
+            return
+        reply = self.server.next_reply()
+        response_format = body.get('response_format') or {}
+        if response_format.get('type') == 'json_schema' and not reply.lstrip().startswith('{'):
+            reply = as_json(reply, response_format['json_schema'].get('schema', {}))
+        if body.get('stream'):
+            self._send_stream(body, reply)
+        else:
+            self._send_completion(body, reply)
+
+    def _send_error(self):
+        status = self.server.error_status
+        with self.server.lock:
+            self.server.errors_sent += 1
+        payload = json.dumps({'error': {
+            'message': 'Injected failure from the fake server',
+            'type': 'rate_limit_error' if status == 429 else 'server_error',
+            'param': None,
+            'code': None,
+        }}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_stream(self, body, reply):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def event(payload):
+            data = f"data: {payload}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None, usage=None):
+            return json.dumps({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body.get('model', 'gpt-4o'),
+                'choices': [] if usage else [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+                'usage': usage,
+            })
+
+        size = self.server.chunk_size
+        try:
+            event(chunk({'role': 'assistant', 'content': ''}))
+            for offset in range(0, len(reply), size):
+                time.sleep(self.server.chunk_delay)
+                event(chunk({'content': reply[offset:offset + size]}))
+                with self.server.lock:
+                    self.server.sent_chars += len(reply[offset:offset + size])
+            event(chunk({}, 'stop'))
+            if (body.get('stream_options') or {}).get('include_usage'):
+                event(chunk({}, usage=self.server.usage_for(body, reply)))
+            event('[DONE]')
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            with self.server.lock:
+                self.server.cancelled_streams += 1
+            self.close_connection = True
+
+    def _send_completion(self, body, reply):
+        # Same generation time as the streamed reply, delivered all at once
+        time.sleep(self.server.chunk_delay * -(-len(reply) // self.server.chunk_size))
+        with self.server.lock:
+            self.server.sent_chars += len(reply)
+        payload = json.dumps({
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': reply},
+                'finish_reason': 'stop',
+            }],
+            'usage': self.server.usage_for(body, reply),
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # The client gave up, e.g. a cancelled hedge
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake OpenAI server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds per completion')
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help='seconds between streamed chunks')
+    parser.add_argument('--tail-latency', type=float, default=0.0, help='latency of the slow tail')
+    parser.add_argument('--tail-fraction', type=float, default=0.0, help='fraction of requests in the slow tail')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP status of injected failures')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer((args.host, args.port), latency=args.latency, chunk_delay=args.chunk_delay,
+                              tail_latency=args.tail_latency, tail_fraction=args.tail_fraction,
+                              error_rate=args.error_rate, error_status=args.error_status)
+    print(f"Fake OpenAI listening on {server.base_url}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the bits of the Stripe API the payment flow uses.
+
+  POST /v1/payment_intents               create an intent (honours Idempotency-Key)
+  GET  /v1/payment_intents/<id>          retrieve it
+  POST /v1/payment_intents/<id>/confirm  mark it succeeded and, with a webhook
+                                         URL, deliver a signed payment_intent.succeeded
+
+Replies come after a configurable delay. A request repeating an
+Idempotency-Key gets the first reply again; with different parameters it
+gets Stripe's idempotency_error. Point the app at it with
+STRIPE_API_BASE=http://127.0.0.1:<port> and give it the app's webhook
+endpoint and signing secret:
+
+    python benchmarks/fake_stripe.py --port 12112 --latency 0.3 \\
+        --webhook-url http://127.0.0.1:5000/stripe-webhook --webhook-secret whsec_test
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """The Stripe-Signature header for a webhook body"""
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    signed = f'{timestamp}.'.encode() + payload
+    return f't={timestamp},v1={hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()}'
+
+
+def succeeded_event(intent):
+    """A payment_intent.succeeded event body for `intent`"""
+    intent = dict(intent, status='succeeded', amount_received=intent['amount'])
+    return json.dumps({
+        'id': f'evt_{uuid.uuid4().hex[:24]}',
+        'object': 'event',
+        'type': 'payment_intent.succeeded',
+        'created': int(time.time()),
+        'data': {'object': intent},
+    }).encode()
+
+
+def _form(body):
+    """Stripe's form encoding (metadata[key]=value, a[b]=c) as nested dicts"""
+    params = {}
+    for key, value in parse_qsl(body.decode()):
+        target = params
+        parts = key.replace(']', '').split('[')
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return params
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, webhook_url=None, webhook_secret=None):
+        super().__init__(address, FakeStripeHandler)
+        self.latency = latency
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.lock = threading.Lock()
+        self.intents = {}
+        self.idempotent = {}  # key -> (params, response)
+        self.requests = 0
+        self.connections = set()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a daemon thread and return self"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def deliver(self, intent):
+        """POST a signed payment_intent.succeeded for `intent` to the webhook URL; returns the status"""
+        payload = succeeded_event(intent)
+        request = urllib.request.Request(self.webhook_url, data=payload, headers={
+            'Content-Type': 'application/json',
+            'Stripe-Signature': sign_payload(payload, self.webhook_secret),
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _begin(self):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.connections.add(self.client_address)
+        time.sleep(self.server.latency)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Request-Id', f'req_{uuid.uuid4().hex[:14]}')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self):
+        self._send(404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL ({self.path})'}})
+
+    def do_GET(self):
+        self._begin()
+        parts = self.path.strip('/').split('/')
+        with self.server.lock:
+            intent = self.server.intents.get(parts[-1]) if parts[:2] == ['v1', 'payment_intents'] else None
+        if intent is None:
+            return self._not_found()
+        self._send(200, intent)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._begin()
+        parts = self.path.strip('/').split('/')
+        if parts == ['v1', 'payment_intents']:
+            return self._create(_form(body))
+        if len(parts) == 4 and parts[:2] == ['v1', 'payment_intents'] and parts[3] == 'confirm':
+            return self._confirm(parts[2])
+        self._not_found()
+
+    def _create(self, params):
+        key = self.headers.get('Idempotency-Key')
+        with self.server.lock:
+            if key in self.server.idempotent:
+                previous, response = self.server.idempotent[key]
+                if previous != params:
+                    return self._send(400, {'error': {
+                        'type': 'idempotency_error',
+                        'message': 'Keys for idempotent requests can only be used with the same parameters '
+                                   'they were first used with.',
+                    }})
+                return self._send(200, response)
+            intent_id = f'pi_{uuid.uuid4().hex[:24]}'
+            intent = {
+                'id': intent_id,
+                'object': 'payment_intent',
+                'amount': int(params.get('amount', 0)),
+                'amount_received': 0,
+                'currency': params.get('currency'),
+                'metadata': params.get('metadata', {}),
+                'status': 'requires_payment_method',
+                'client_secret': f'{intent_id}_secret_{uuid.uuid4().hex[:24]}',
+                'created': int(time.time()),
+            }
+            self.server.intents[intent_id] = intent
+            if key:
+                self.server.idempotent[key] = (params, intent)
+        self._send(200, intent)
+
+    def _confirm(self, intent_id):
+        with self.server.lock:
+            intent = self.server.intents.get(intent_id)
+            if intent is not None:
+                intent.update(status='succeeded', amount_received=intent['amount'])
+                intent = dict(intent)
+        if intent is None:
+            return self._not_found()
+        if self.server.webhook_url:
+            self.server.deliver(intent)
+        self._send(200, intent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake Stripe API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=12112)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds per API request')
+    parser.add_argument('--webhook-url', help="the app's /stripe-webhook, to deliver payment_intent.succeeded")
+    parser.add_argument('--webhook-secret', help='signing secret the app expects (STRIPE_WEBHOOK_SECRET)')
+    args = parser.parse_args()
+
+    server = FakeStripeServer((args.host, args.port), latency=args.latency,
+                              webhook_url=args.webhook_url, webhook_secret=args.webhook_secret)
+    print(f"Fake Stripe listening on {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Concurrent load against /predict and /predict_path, with the vision calls
+answered by the local fake OpenAI server.
+
+The app is started under gunicorn with the production config (or the
+Flask development server with --server flask) with the result cache off,
+so every request runs the whole pipeline. Once /ready answers, --concurrency
+clients send --requests requests in total, cycling through the images in
+image/ and alternating between the endpoints. The fake server's latency,
+slow tail and error injection are configurable, to see how the app behaves
+when the provider misbehaves. With --same-image every client sends the
+first image, the thundering herd that single-flight coalescing absorbs.
+
+Reported per endpoint: latency percentiles, throughput, error rate and
+status codes, plus the peak RSS of the busiest server process and what each
+server process holds at the end (RSS, and PSS, which splits pages shared
+with the gunicorn master or other workers between them). Results can
+be written as JSON and checked against an earlier run, see
+benchmarks/results.py.
+
+    python benchmarks/load_test.py --requests 200 --concurrency 16 -o load.json
+    python benchmarks/load_test.py --latency 1.5 --error-rate 0.05 --error-status 429
+    python benchmarks/load_test.py --same-image --concurrency 32 --endpoints predict
+    python benchmarks/load_test.py --url http://127.0.0.1:5000 --endpoints predict   # an app already running
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+BACK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK_DIR)
+
+import requests
+
+import results
+from fake_openai import FakeOpenAIServer
+
+IMAGE_DIR = os.path.join(BACK_DIR, '..', 'image')
+ENDPOINTS = ('predict', 'predict_path')
+MIME_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.gif': 'image/gif',
+              '.bmp': 'image/bmp', '.webp': 'image/webp'}
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_app(server, port, workers, openai_base_url):
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        WEB_CONCURRENCY=str(workers),
+        OPENAI_BASE_URL=openai_base_url,
+        OPENAI_API_KEY=os.getenv('OPENAI_API_KEY', 'sk-fake'),
+        RESULT_CACHE_ENABLED='false',
+        STARTUP_WARMUP='background',
+    )
+    if server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}', 'app:app']
+    else:
+        command = [sys.executable, '-c',
+                   f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    return subprocess.Popen(command, cwd=BACK_DIR, env=env, stdout=subprocess.DEVNULL, start_new_session=True)
+
+
+def wait_until_ready(base_url, timeout):
+    """True once /ready answers 200; False if it is still warming up (or failing) after `timeout`"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f'{base_url}/ready', timeout=10).status_code == 200:
+                return True
+        except requests.ConnectionError:
+            pass  # Not listening yet
+        time.sleep(0.5)
+    return False
+
+
+def process_tree(pid):
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f'/proc/{parent}/task/{parent}/children') as children:
+                pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def peak_rss_mb(pids):
+    """Largest VmHWM among the given processes (Linux), or None"""
+    peaks = []
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        peaks.append(int(line.split()[1]) / 1024)
+        except OSError:
+            pass
+    return max(peaks) if peaks else None
+
+
+def process_memory_mb(pid):
+    """{'rss_mb', 'pss_mb'} of one process (Linux), or None"""
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as rollup:
+            for line in rollup:
+                if line.startswith(('Rss:', 'Pss:')):
+                    key, value = line.split()[:2]
+                    memory[f'{key[:-1].lower()}_mb'] = int(value) / 1024
+    except OSError:
+        return None
+    return memory if len(memory) == 2 else None
+
+
+class LoadGenerator:
+    def __init__(self, base_url, images, endpoints, timeout):
+        self.base_url = base_url
+        self.images = images  # [(path, bytes)]
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.samples = defaultdict(list)  # endpoint -> seconds, successful requests only
+        self.statuses = defaultdict(Counter)  # endpoint -> status -> count
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def session(self):
+        # One keep-alive connection per load thread
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def send(self, number):
+        endpoint = self.endpoints[number % len(self.endpoints)]
+        path, data = self.images[number % len(self.images)]
+        start = time.perf_counter()
+        try:
+            if endpoint == 'predict':
+                mime_type = MIME_TYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+                response = self.session().post(f'{self.base_url}/predict', timeout=self.timeout,
+                                               files={'image': (os.path.basename(path), data, mime_type)})
+            else:
+                response = self.session().post(f'{self.base_url}/predict_path', timeout=self.timeout,
+                                               json={'image_path': path})
+            ok = response.status_code == 200 and response.json().get('success') is True
+            status = str(response.status_code)
+        except requests.RequestException as e:
+            ok = False
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.statuses[endpoint][status] += 1
+            if ok:
+                self.samples[endpoint].append(elapsed)
+
+    def run(self, requests, concurrency):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(self.send, range(requests)))
+        return time.perf_counter() - start
+
+    def metrics(self, elapsed):
+        metrics = {}
+        for endpoint in self.endpoints:
+            total = sum(self.statuses[endpoint].values())
+            succeeded = len(self.samples[endpoint])
+            metrics[endpoint] = {
+                'requests': total,
+                'throughput_rps': succeeded / elapsed if elapsed else 0.0,
+                'error_rate': (total - succeeded) / total if total else 0.0,
+                'latency': results.percentiles(self.samples[endpoint]),
+                'status': dict(self.statuses[endpoint]),
+            }
+        return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=IMAGE_DIR)
+    parser.add_argument('--same-image', action='store_true', help='send only the first image')
+    parser.add_argument('--requests', type=int, default=100, help='requests in total (default 100)')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients (default 8)')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='comma-separated subset of: ' + ', '.join(ENDPOINTS))
+    parser.add_argument('--server', choices=('gunicorn', 'flask'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes (default 2)')
+    parser.add_argument('--url', help='load an app that is already running instead of starting one')
+    parser.add_argument('--ready-timeout', type=float, default=180, help='seconds to wait for /ready')
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--latency', type=float, default=0.5, help='fake vision latency in seconds')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='seconds between streamed chunks')
+    parser.add_argument('--tail-latency', type=float, default=0.0)
+    parser.add_argument('--tail-fraction', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of vision calls that fail')
+    parser.add_argument('--error-status', type=int, default=500)
+    results.add_arguments(parser)
+    args = parser.parse_args()
+    endpoints = [endpoint.strip() for endpoint in args.endpoints.split(',') if endpoint.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    from pipeline import iter_image_files
+    images = [(os.path.abspath(path), data) for path, data in iter_image_files([args.images])]
+    if not images:
+        parser.error(f"no images in {args.images}")
+    if args.same_image:
+        images = images[:1]
+
+    fake = None
+    app_process = None
+    base_url = args.url
+    if base_url is None:
+        fake = FakeOpenAIServer(('127.0.0.1', 0), latency=args.latency, chunk_delay=args.chunk_delay,
+                                tail_latency=args.tail_latency, tail_fraction=args.tail_fraction,
+                                error_rate=args.error_rate, error_status=args.error_status).start()
+        port = free_port()
+        app_process = start_app(args.server, port, args.workers, fake.base_url)
+        base_url = f'http://127.0.0.1:{port}'
+
+    try:
+        start = time.perf_counter()
+        if not wait_until_ready(base_url, args.ready_timeout):
+            print(f"Warning: {base_url}/ready did not answer 200 within {args.ready_timeout:.0f}s; "
+                  "loading it anyway")
+        ready_seconds = time.perf_counter() - start
+
+        generator = LoadGenerator(base_url, images, endpoints, args.request_timeout)
+        elapsed = generator.run(args.requests, args.concurrency)
+        metrics = generator.metrics(elapsed)
+        metrics['ready_ms'] = ready_seconds * 1000
+        metrics['elapsed_s'] = elapsed
+        if app_process is not None:
+            pids = process_tree(app_process.pid)
+            metrics['server_peak_rss_mb'] = peak_rss_mb(pids)
+            memory = {str(pid): process_memory_mb(pid) for pid in pids}
+            metrics['server_memory'] = {pid: usage for pid, usage in memory.items() if usage is not None}
+            # PSS adds up to what the server really holds, shared pages counted once
+            metrics['server_pss_total_mb'] = sum(usage['pss_mb'] for usage in metrics['server_memory'].values())
+        if fake is not None:
+            metrics['provider'] = {'requests': fake.requests, 'errors': fake.errors_sent}
+    finally:
+        if app_process is not None:
+            os.killpg(app_process.pid, signal.SIGTERM)
+            try:
+                app_process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                os.killpg(app_process.pid, signal.SIGKILL)
+        if fake is not None:
+            fake.shutdown()
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent, {elapsed:.1f}s")
+    print(f"{'endpoint':13} {'req/s':>7} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  status")
+    for endpoint in endpoints:
+        result = metrics[endpoint]
+        latency = result['latency']
+        print(f"{endpoint:13} {result['throughput_rps']:7.2f} {result['error_rate']:7.1%} "
+              f"{latency.get('p50_ms', 0):8.1f} {latency.get('p95_ms', 0):8.1f} {latency.get('p99_ms', 0):8.1f}  "
+              + ' '.join(f'{status}x{count}' for status, count in sorted(result['status'].items())))
+    if metrics.get('server_peak_rss_mb') is not None:
+        print(f"server peak RSS: {metrics['server_peak_rss_mb']:.1f} MB")
+    for pid, usage in metrics.get('server_memory', {}).items():
+        print(f"  pid {pid}: RSS {usage['rss_mb']:.1f} MB, PSS {usage['pss_mb']:.1f} MB")
+    if metrics.get('server_memory'):
+        print(f"server total PSS: {metrics['server_pss_total_mb']:.1f} MB")
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'tolerance')}
+    return results.finish(args, 'load_test', config, metrics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+JSON results for benchmarks whose numbers are tracked between releases.
+
+A results file holds the benchmark name, when and where it ran (git commit,
+Python, CPUs) and its configuration, plus a flat {metric: value} dict.
+Given a baseline file from an earlier run, metrics that got worse by more
+than the tolerance are reported as regressions and the script exits 1, so
+a deploy can be gated on it:
+
+    python benchmarks/bench_pipeline.py -o new.json --baseline release.json
+
+Metric names carry their direction: *_ms, *_mb and *error_rate are lower
+is better, *_rps is higher is better, anything else is informational.
+"""
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+# Changes smaller than this (in the metric's own unit) are noise, whatever the ratio
+MIN_DELTA = 1.0
+
+
+def percentiles(samples):
+    """Summary of a list of seconds, in milliseconds (nearest-rank percentiles)"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(fraction):
+        return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)] * 1000
+
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'min_ms': ordered[0] * 1000,
+        'p50_ms': rank(0.50),
+        'p95_ms': rank(0.95),
+        'p99_ms': rank(0.99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+def peak_rss_mb():
+    """This process's peak resident set size so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def flatten(metrics, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}"""
+    flat = {}
+    for name, value in metrics.items():
+        key = f'{prefix}{name}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, key + '.'))
+        else:
+            flat[key] = round(value, 3) if isinstance(value, float) else value
+    return flat
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def _direction(name):
+    if name.endswith(('_ms', '_mb', 'error_rate')):
+        return -1
+    if name.endswith('_rps'):
+        return 1
+    return 0
+
+
+def compare(metrics, baseline, tolerance):
+    """Human-readable lines for metrics that regressed against `baseline` by more than `tolerance`"""
+    regressions = []
+    for name, old in sorted(baseline.items()):
+        new = metrics.get(name)
+        direction = _direction(name)
+        if not direction or not isinstance(new, (int, float)) or not isinstance(old, (int, float)):
+            continue
+        worse = (new - old) * -direction
+        if worse > MIN_DELTA and worse > abs(old) * tolerance:
+            regressions.append(f"{name}: {old:g} -> {new:g}")
+    return regressions
+
+
+def add_arguments(parser):
+    parser.add_argument('-o', '--output', help='write the results here as JSON')
+    parser.add_argument('--baseline', help='results file from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown allowed before a metric counts as a regression (default 0.2)')
+
+
+def finish(args, benchmark, config, metrics):
+    """Write the results and check them against the baseline; returns the exit code"""
+    metrics = flatten(metrics)
+    results = {
+        'benchmark': benchmark,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'environment': environment(),
+        'config': config,
+        'metrics': metrics,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+            output.write('\n')
+        print(f"Wrote {len(metrics)} metrics to {args.output}")
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get('benchmark') != benchmark:
+        print(f"Warning: Baseline is from '{baseline.get('benchmark')}', not '{benchmark}'")
+    regressions = compare(metrics, baseline.get('metrics', {}), args.tolerance)
+    if regressions:
+        print(f"{len(regressions)} regressions against {args.baseline} (tolerance {args.tolerance:.0%}):")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"No regressions against {args.baseline}")
+    return 0
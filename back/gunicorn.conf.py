@@ -0,0 +1,102 @@
+"""
+Production server configuration:  gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload_app), and the master also
+imports the heavy libraries the app itself loads lazily (onnxruntime, rembg,
+numpy, the OpenAI SDK, stripe), so they are loaded a single time and shared
+copy-on-write by every worker. onnxruntime thread pools and the OpenAI
+client's event-loop thread don't survive fork(), so each worker warms up its
+own U2NetP sessions and client in the background right after forking;
+/ready turns 200 once that is done. The model weights are not shared:
+onnxruntime copies them into each session it builds, so reading the model
+in the master first would save nothing. benchmarks/load_test.py reports
+what each worker ends up holding (RSS and PSS).
+
+With SEGMENTATION_WORKERS set, U2NetP runs in that many separate processes
+per web worker instead (see segmentation_service.py); the web workers then
+only do I/O, so a single one is started by default and the segmentation
+workers get the cores.
+
+Sizing (environment):
+  WEB_CONCURRENCY        worker processes (default: usable CPUs, or 1 with SEGMENTATION_WORKERS)
+  GUNICORN_THREADS       request threads per worker (default 16); admission control
+                         (admission.py) admits fewer predictions than that, so the
+                         spare threads can refuse overload quickly and answer probes
+  ORT_INTRA_OP_THREADS   onnxruntime threads per session (default: CPUs / workers)
+  GUNICORN_TIMEOUT       request timeout in seconds (default 120)
+  GUNICORN_GRACEFUL_TIMEOUT  seconds to drain on shutdown (default 30)
+  JOB_STORE              defaults to sqlite with more than one worker, so any worker
+                         can answer /jobs/<id> (see jobs.py)
+  SINGLEFLIGHT_DIR       defaults to <tmp>/vibe-singleflight with more than one worker,
+                         so identical uploads are coalesced across workers (see singleflight.py)
+"""
+import os
+import tempfile
+
+
+def _cpu_count():
+    # Respect container CPU affinity where available
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+cpus = _cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+segmentation_workers = int(os.getenv('SEGMENTATION_WORKERS', '0'))
+workers = int(os.getenv('WEB_CONCURRENCY', '1' if segmentation_workers else str(cpus)))
+# Requests mostly wait on the vision API, so a few threads per worker keep it busy
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+preload_app = True
+
+# Split the cores between workers so onnxruntime doesn't oversubscribe them.
+# Set before the app is imported, since session options are read from here.
+os.environ.setdefault('ORT_INTRA_OP_THREADS', str(max(1, cpus // workers)))
+os.environ.setdefault('ORT_INTER_OP_THREADS', '1')
+os.environ.setdefault('OMP_NUM_THREADS', os.environ['ORT_INTRA_OP_THREADS'])
+# Sessions are built per worker in post_fork, not in the master at import time
+os.environ['STARTUP_WARMUP'] = 'off'
+# A job can be polled on any worker, so with more than one the job store must be shared
+if workers > 1:
+    os.environ.setdefault('JOB_STORE', 'sqlite')
+    if os.environ['JOB_STORE'].lower() != 'sqlite':
+        print(f"Warning: JOB_STORE={os.environ['JOB_STORE']} is per worker; "
+              f"/jobs/<id> will 404 on the other {workers - 1} workers")
+    # Duplicates of an upload can land on different workers
+    os.environ.setdefault('SINGLEFLIGHT_DIR', os.path.join(tempfile.gettempdir(), 'vibe-singleflight'))
+# Leave threads for the admission queue plus two to refuse requests and answer /ready
+os.environ.setdefault('ADMISSION_QUEUE', str(max(1, threads // 4)))
+os.environ.setdefault('ADMISSION_MAX_LIMIT', str(max(1, threads - int(os.environ['ADMISSION_QUEUE']) - 2)))
+
+
+def when_ready(server):
+    # Runs in the master before the first fork
+    from warmup import preload_modules
+    preload_modules()
+
+
+def post_fork(server, worker):
+    from session_pool import get_session_pool
+    from warmup import start_warm_up
+
+    start_warm_up('background')
+    if segmentation_workers:
+        server.log.info(f"Worker {worker.pid} starting {segmentation_workers} segmentation workers")
+        return
+    server.log.info(
+        f"Worker {worker.pid} warming up: {get_session_pool().size} sessions x "
+        f"{os.environ['ORT_INTRA_OP_THREADS']} onnxruntime threads"
+    )
+
+
+def worker_exit(server, worker):
+    # Draining requests has already used part of graceful_timeout; queued jobs
+    # get half of it, and those still waiting after that are cancelled
+    from jobs import shutdown_job_queue
+    shutdown_job_queue(wait=True, timeout=server.cfg.graceful_timeout / 2)
@@ -0,0 +1,216 @@
+"""
+Hedged vision attempts.
+
+By default attempts run one after another: a retry only starts once the
+previous attempt has failed. With hedging on, a slow attempt gets company
+instead of a timeout: after the hedge delay (the p95 time-to-label of recent
+attempts, unless fixed) a second attempt is launched alongside it, or in
+parallel mode several start together. The first attempt whose reply passes
+validation wins and the rest are cancelled.
+
+Every hedge counts against the request's attempt budget, and hedges across
+the whole process are rate limited by a token bucket so a slow provider
+isn't answered with a stampede of duplicate requests.
+
+Configuration (environment):
+  OPENAI_HEDGE           off, delay or parallel (default off)
+  OPENAI_HEDGE_DELAY     seconds before hedging (default: p95 of recent time-to-label)
+  OPENAI_HEDGE_PARALLEL  attempts started together in parallel mode (default 2)
+  OPENAI_HEDGE_RATE      hedges per second allowed for this process (default 2)
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import REGISTRY
+
+HEDGES = REGISTRY.counter(
+    'openai_hedges_total', 'Hedged vision attempts: launched, won (answered first) or throttled by the rate cap')
+
+# Hedge delay used until enough attempts have been seen to estimate the p95
+DEFAULT_HEDGE_DELAY = 5.0
+MIN_SAMPLES = 20
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class HedgePolicy:
+    """When to start extra attempts, and how many the process may start"""
+
+    def __init__(self, mode='off', delay=None, parallel=2, rate=2.0, window=200):
+        self.mode = mode
+        self.delay = delay
+        self.parallel = max(1, parallel)
+        self.bucket = TokenBucket(rate)
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """Record how long an attempt took to produce a valid label"""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self):
+        """Seconds to wait on in-flight attempts before hedging, or None when hedging is off"""
+        if self.mode == 'off':
+            return None
+        if self.delay is not None:
+            return self.delay
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        return samples[min(len(samples) - 1, math.ceil(0.95 * len(samples)) - 1)]
+
+    def initial_attempts(self, budget):
+        return min(self.parallel, budget) if self.mode == 'parallel' else 1
+
+    def allow_hedge(self):
+        if self.bucket.try_acquire():
+            return True
+        HEDGES.inc(outcome='throttled')
+        return False
+
+
+async def run_hedged(attempt, budget, policy, backoff, on_label=None, on_delta=None):
+    """
+    Run up to `budget` attempts under `policy`. Returns (text, won): the
+    winning attempt's text, or the last failed attempt's text if none won.
+
+    attempt(number, on_label, on_delta) is a coroutine returning
+    (text, status) with status 'ok', 'retry' or 'fatal'. It must call its
+    on_label once its label is settled; only the first attempt to do so is
+    passed through to the caller's callbacks, and the others are cancelled
+    at that point. A failed attempt with nothing else in flight is retried
+    after backoff(attempts_so_far - 1) seconds, as in the serial loop.
+    """
+    tasks = {}  # task -> (number, hedge)
+    started = {}
+    winner = None
+    launched = 0
+    hedging = True
+    last = None
+
+    def callbacks(number):
+        def label(animal):
+            nonlocal winner
+            if winner is not None:
+                return
+            winner = number
+            policy.observe(time.perf_counter() - started[number])
+            for task, (other, _) in tasks.items():
+                if other != number:
+                    task.cancel()
+            if on_label:
+                on_label(animal)
+
+        def delta(text):
+            if winner == number and on_delta:
+                on_delta(text)
+
+        return label, delta
+
+    def launch(hedge):
+        nonlocal launched
+        number = launched
+        launched += 1
+        started[number] = time.perf_counter()
+        task = asyncio.ensure_future(attempt(number, *callbacks(number)))
+        tasks[task] = (number, hedge)
+        if hedge:
+            HEDGES.inc(outcome='launched')
+
+    launch(hedge=False)
+    for _ in range(policy.initial_attempts(budget) - 1):
+        if policy.allow_hedge():
+            launch(hedge=True)
+
+    try:
+        while tasks:
+            timeout = None
+            if hedging and winner is None and launched < budget:
+                timeout = policy.hedge_delay()
+            done, _ = await asyncio.wait(list(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if policy.allow_hedge():
+                    launch(hedge=True)
+                else:
+                    hedging = False  # Don't keep knocking on the rate cap for this request
+                continue
+
+            for task in done:
+                number, hedge = tasks.pop(task)
+                if task.cancelled():
+                    continue
+                text, status = task.result()
+                if status == 'ok':
+                    if hedge:
+                        HEDGES.inc(outcome='won')
+                    return text, True
+                last = text
+                if winner == number:
+                    winner = None  # Failed after committing its label; let the next attempt take over
+                if status == 'fatal':
+                    return last, False
+
+            if not tasks and launched < budget:
+                await asyncio.sleep(backoff(launched - 1))
+                launch(hedge=False)
+        return last, False
+    finally:
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Each worker process gets its own rate cap and latency window
+    global _policy, _policy_lock
+    _policy = None
+    _policy_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_hedge_policy():
+    """The process-wide hedge policy, configured from the environment on first use"""
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                delay = os.getenv('OPENAI_HEDGE_DELAY')
+                _policy = HedgePolicy(
+                    mode=os.getenv('OPENAI_HEDGE', 'off').lower(),
+                    delay=float(delay) if delay else None,
+                    parallel=int(os.getenv('OPENAI_HEDGE_PARALLEL', '2')),
+                    rate=float(os.getenv('OPENAI_HEDGE_RATE', '2')),
+                )
+    return _policy
@@ -0,0 +1,347 @@
+"""
+Asynchronous prediction jobs.
+
+Submitting a job returns an id straight away; a pool of worker threads runs
+the pipeline and writes the outcome, with per-stage timings, to a job store
+that clients poll (/jobs/<id>) or stream (/jobs/<id>/events).
+
+Threads rather than processes: segmentation runs inside onnxruntime and the
+vision call waits on the network, both of which release the GIL.
+
+Configuration (environment):
+  JOB_WORKERS          worker threads (default 4)
+  JOB_QUEUE_MAX        queued jobs before submit() refuses with QueueFull (default 64)
+  JOB_STORE            memory or sqlite (default memory; sqlite under gunicorn with several workers)
+  JOB_STORE_PATH       sqlite file for JOB_STORE=sqlite, relative to this directory (default jobs.sqlite3)
+  JOB_TTL              seconds finished jobs are kept (default 3600)
+  JOB_WEBHOOKS_ENABLED allow callback_url on submit (default false)
+  JOB_WEBHOOK_HOSTS    comma-separated hosts callback_url may point at; unset = any host
+                       that resolves only to public addresses
+
+Callback URLs must be http(s). Without JOB_WEBHOOK_HOSTS, a host that
+resolves to a loopback, private, link-local or otherwise reserved address is
+refused, so a job can't be used to reach the internal network. The host is
+checked again when the callback is sent, and redirects are not followed.
+"""
+import ipaddress
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from pipeline import predict_image_bytes, PipelineError
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = (DONE, FAILED)
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class InvalidCallback(Exception):
+    """A callback_url the job queue won't send to"""
+
+
+class QueueFull(Exception):
+    """The job queue is at capacity; the caller should retry later"""
+
+    def __init__(self, retry_after):
+        super().__init__('Job queue is full')
+        self.retry_after = retry_after
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        raise urllib.error.HTTPError(req.full_url, code, f'redirect to {newurl} not followed', headers, fp)
+
+
+_webhook_opener = urllib.request.build_opener(_NoRedirects)
+
+
+def check_callback_url(url):
+    """Raise InvalidCallback unless `url` is an http(s) URL to an allowed host"""
+    try:
+        parsed = urllib.parse.urlsplit(url)
+        parsed.port  # Raises ValueError when out of range
+    except ValueError:
+        raise InvalidCallback('callback_url is not a valid URL')
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise InvalidCallback('callback_url must be an http or https URL')
+    host = parsed.hostname.lower()
+    allowed = [name.strip().lower() for name in os.getenv('JOB_WEBHOOK_HOSTS', '').split(',') if name.strip()]
+    if allowed:
+        if host not in allowed:
+            raise InvalidCallback(f'callback_url host {host} is not in JOB_WEBHOOK_HOSTS')
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        raise InvalidCallback(f'callback_url host {host} does not resolve')
+    for address in addresses:
+        if not ipaddress.ip_address(address.split('%', 1)[0]).is_global:
+            raise InvalidCallback(f'callback_url host {host} is not a public address')
+
+
+class MemoryJobStore:
+    """Job records in a dict; lost on restart"""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def put(self, job):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+                job['updated'] = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def purge(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job['status'] in FINISHED and job['updated'] < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+
+class SqliteJobStore:
+    """Job records in a local sqlite file, shared by every process on the host"""
+
+    def __init__(self, path, ttl=3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs '
+                '(id TEXT PRIMARY KEY, status TEXT NOT NULL, updated REAL NOT NULL, data TEXT NOT NULL)'
+            )
+
+    def put(self, job):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO jobs (id, status, updated, data) VALUES (?, ?, ?, ?)',
+                (job['id'], job['status'], job['updated'], json.dumps(job)),
+            )
+
+    def update(self, job_id, **fields):
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return
+            job = json.loads(row[0])
+            job.update(fields)
+            job['updated'] = time.time()
+            self._conn.execute(
+                'UPDATE jobs SET status = ?, updated = ?, data = ? WHERE id = ?',
+                (job['status'], job['updated'], json.dumps(job), job_id),
+            )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def purge(self):
+        cutoff = time.time() - self.ttl
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?', (DONE, FAILED, cutoff)
+            )
+
+
+class JobQueue:
+    """Bounded queue of prediction jobs drained by worker threads"""
+
+    def __init__(self, store, workers=4, max_queued=64, webhooks=False):
+        self.store = store
+        self.webhooks = webhooks
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._workers = []
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0}
+        self._avg_seconds = 5.0  # moving average of job duration, for Retry-After
+
+        for index in range(max(1, workers)):
+            worker = threading.Thread(target=self._work, name=f'job-worker-{index}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, image_data, callback_url=None):
+        """Queue a prediction; returns the job record or raises QueueFull (or InvalidCallback)"""
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': QUEUED,
+            'created': now,
+            'updated': now,
+            'timings': {},
+        }
+        if callback_url and self.webhooks:
+            check_callback_url(callback_url)
+            job['callback_url'] = callback_url
+
+        self.store.put(job)
+        try:
+            self._queue.put_nowait((job['id'], image_data))
+        except queue.Full:
+            self.store.update(job['id'], status=FAILED, error='Queue full')
+            with self._stats_lock:
+                self._stats['rejected'] += 1
+            raise QueueFull(retry_after=self.retry_after())
+
+        with self._stats_lock:
+            self._stats['submitted'] += 1
+            purge = self._stats['submitted'] % 100 == 0
+        if purge:
+            self.store.purge()
+        return job
+
+    def retry_after(self):
+        """Seconds until a queue slot is likely to free up"""
+        workers = len(self._workers)
+        return max(1, int(self._avg_seconds * self._queue.qsize() / workers + 0.5))
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job_id, image_data = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._run(job_id, image_data)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id, image_data):
+        started = time.time()
+        job = self.store.get(job_id)
+        queued_seconds = started - job['created'] if job else 0.0
+        self.store.update(job_id, status=RUNNING, started=started)
+
+        timings = {'queued': round(queued_seconds, 4)}
+        try:
+            output = predict_image_bytes(image_data, timings=timings)
+        except PipelineError as e:
+            fields = {'status': FAILED, 'error': e.error, 'message': e.message}
+        except Exception as e:
+            fields = {'status': FAILED, 'error': 'Internal server error', 'message': str(e)}
+        else:
+            fields = {'status': DONE, 'result': output['result'], 'cache': output['cache']}
+
+        finished = time.time()
+        timings['total'] = round(finished - started, 4)
+        self.store.update(job_id, finished=finished, timings=timings, **fields)
+
+        with self._stats_lock:
+            self._stats['completed' if fields['status'] == DONE else 'failed'] += 1
+            self._avg_seconds = 0.9 * self._avg_seconds + 0.1 * (finished - started)
+
+        if job and job.get('callback_url'):
+            self._notify(job['callback_url'], self.store.get(job_id))
+
+    def _notify(self, url, job):
+        """POST the finished job record to its webhook; failures are only logged"""
+        payload = json.dumps({key: value for key, value in job.items() if key != 'callback_url'}).encode('utf-8')
+        request = urllib.request.Request(url, data=payload, headers={'Content-Type': 'application/json'})
+        try:
+            # The host may resolve differently by now
+            check_callback_url(url)
+            _webhook_opener.open(request, timeout=5).close()
+        except Exception as e:
+            print(f"Warning: Job webhook to {url} failed: {e}")
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['capacity'] = self._queue.maxsize
+        stats['workers'] = len(self._workers)
+        return stats
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stop taking work; optionally wait up to `timeout` seconds (None: no
+        limit) for queued jobs to finish. Jobs still queued after that are
+        marked failed, so their clients stop polling.
+        """
+        if wait:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with self._queue.all_tasks_done:
+                while self._queue.unfinished_tasks:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._queue.all_tasks_done.wait(remaining)
+        self._stopping.set()
+        while True:
+            try:
+                job_id, _ = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.store.update(job_id, status=FAILED, finished=time.time(),
+                              error='Cancelled', message='The server shut down before the job ran')
+            self._queue.task_done()
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Worker threads don't survive fork(); each process gets its own queue
+    global _job_queue, _job_queue_lock
+    _job_queue = None
+    _job_queue_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_job_queue():
+    """Return the process-wide job queue, starting its workers on first use"""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                ttl = float(os.getenv('JOB_TTL', '3600'))
+                if os.getenv('JOB_STORE', 'memory').lower() == 'sqlite':
+                    path = os.path.join(APP_DIR, os.getenv('JOB_STORE_PATH', 'jobs.sqlite3'))
+                    store = SqliteJobStore(path, ttl=ttl)
+                else:
+                    store = MemoryJobStore(ttl=ttl)
+                _job_queue = JobQueue(
+                    store,
+                    workers=int(os.getenv('JOB_WORKERS', '4')),
+                    max_queued=int(os.getenv('JOB_QUEUE_MAX', '64')),
+                    webhooks=os.getenv('JOB_WEBHOOKS_ENABLED', 'false').lower() == 'true',
+                )
+    return _job_queue
+
+
+def shutdown_job_queue(wait=True, timeout=None):
+    """Drain and stop this process's job queue, if one was started (see JobQueue.shutdown)"""
+    if _job_queue is not None:
+        _job_queue.shutdown(wait=wait, timeout=timeout)
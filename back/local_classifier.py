@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Optional local fast path for choosing the animal.
+
+A small ONNX image-embedding model (any backbone whose first output is a
+feature vector or feature map, e.g. a MobileNet or CLIP image tower) runs on
+the onnxruntime we already ship for U2NetP. The embedding is scored against
+one prototype vector per animal by cosine similarity; when the softmax
+confidence clears the threshold, the label is used directly and the vision
+call is skipped.
+
+Configuration (environment):
+  LOCAL_CLASSIFIER_MODEL       path to the embedding .onnx (unset = disabled)
+  LOCAL_CLASSIFIER_PROTOTYPES  .npz built by `python local_classifier.py build`
+  LOCAL_CLASSIFIER_THRESHOLD   minimum confidence to skip the vision call (default 0.6)
+  LOCAL_CLASSIFIER_TEMPERATURE softmax temperature over cosine scores (default 0.05)
+
+Build prototypes offline from a folder with one sub-folder per animal:
+
+    python local_classifier.py build labelled/ --model model/embedder.onnx -o model/prototypes.npz
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from animal_analyzer import AVAILABLE_ANIMALS
+from metrics import REGISTRY
+
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+# Seconds before a classifier that failed to load is tried again
+LOAD_RETRY_SECONDS = 300
+
+DECISIONS = REGISTRY.counter(
+    'local_classifier_decisions_total', 'Local classifier outcomes: confident (vision call skipped) or deferred')
+
+
+class LocalClassifier:
+    """Embedding model + per-animal prototype matrix"""
+
+    def __init__(self, model_path, prototypes_path=None, threshold=0.6, temperature=0.05):
+        import onnxruntime as ort
+        sess_opts = ort.SessionOptions()
+        sess_opts.intra_op_num_threads = int(os.getenv('ORT_INTRA_OP_THREADS', '0'))
+        sess_opts.inter_op_num_threads = int(os.getenv('ORT_INTER_OP_THREADS', '0'))
+        self.session = ort.InferenceSession(model_path, sess_options=sess_opts, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Fall back to 224x224 when the model has dynamic spatial dimensions
+        height, width = model_input.shape[2:4]
+        self.input_size = (width if isinstance(width, int) else 224, height if isinstance(height, int) else 224)
+        self.threshold = threshold
+        self.temperature = temperature
+
+        self.labels = []
+        self.prototypes = None
+        if prototypes_path:
+            data = np.load(prototypes_path)
+            self.labels = [str(label) for label in data['labels']]
+            self.prototypes = data['vectors'].astype(np.float32)
+
+    def _preprocess(self, images):
+        batch = []
+        for image in images:
+            image = ImageOps.exif_transpose(image).convert('RGB').resize(self.input_size, Image.Resampling.BILINEAR)
+            pixels = (np.asarray(image, dtype=np.float32) / 255.0 - IMAGENET_MEAN) / IMAGENET_STD
+            batch.append(pixels.transpose(2, 0, 1))
+        return np.stack(batch)
+
+    def embed(self, images):
+        """L2-normalized embeddings, one row per image"""
+        features = self.session.run(None, {self.input_name: self._preprocess(images)})[0]
+        if features.ndim == 4:
+            # Feature map: global average pool
+            features = features.mean(axis=(2, 3))
+        features = features.reshape(len(images), -1).astype(np.float32)
+        return features / np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-12)
+
+    def classify(self, image):
+        """Return (animal, confidence) for the best-matching prototype"""
+        scores = self.prototypes @ self.embed([image])[0]
+        logits = scores / self.temperature
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        best = int(np.argmax(probabilities))
+        return self.labels[best], float(probabilities[best])
+
+    def confident_label(self, image):
+        """The animal if confidence clears the threshold, otherwise None"""
+        animal, confidence = self.classify(image)
+        if confidence >= self.threshold:
+            DECISIONS.inc(outcome='confident')
+            return animal
+        DECISIONS.inc(outcome='deferred')
+        return None
+
+
+def build_prototypes(classifier, image_dir, batch_size=16):
+    """
+    Average the embeddings of each <image_dir>/<animal>/ folder into a
+    prototype. Folder names must be animals from AVAILABLE_ANIMALS; raises
+    ValueError if no folder yields a prototype.
+    """
+    labels, vectors = [], []
+    for animal in sorted(os.listdir(image_dir)):
+        folder = os.path.join(image_dir, animal)
+        if not os.path.isdir(folder):
+            continue
+        if animal not in AVAILABLE_ANIMALS:
+            print(f"Skipping '{animal}': not in AVAILABLE_ANIMALS", file=sys.stderr)
+            continue
+
+        paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                 if name.lower().endswith(IMAGE_EXTENSIONS)]
+        embeddings = []
+        for offset in range(0, len(paths), batch_size):
+            images = []
+            for path in paths[offset:offset + batch_size]:
+                with Image.open(path) as image:
+                    images.append(image.convert('RGB'))
+            embeddings.append(classifier.embed(images))
+        if not embeddings:
+            continue
+
+        prototype = np.concatenate(embeddings).mean(axis=0)
+        labels.append(animal)
+        vectors.append(prototype / max(np.linalg.norm(prototype), 1e-12))
+        print(f"{animal}: {len(paths)} images")
+
+    if not vectors:
+        raise ValueError(f"No prototypes built from {image_dir}: it has no sub-folder of images "
+                         f"named after an animal in AVAILABLE_ANIMALS")
+    return labels, np.stack(vectors).astype(np.float32)
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+_load_failed_at = None
+
+
+def _reset_after_fork():
+    # onnxruntime thread pools don't survive fork()
+    global _classifier, _classifier_lock, _load_failed_at
+    _classifier = None
+    _classifier_lock = threading.Lock()
+    _load_failed_at = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_local_classifier():
+    """
+    The process-wide classifier, or None when LOCAL_CLASSIFIER_MODEL isn't
+    set or it failed to load less than LOAD_RETRY_SECONDS ago
+    """
+    global _classifier, _load_failed_at
+    model_path = os.getenv('LOCAL_CLASSIFIER_MODEL')
+    prototypes_path = os.getenv('LOCAL_CLASSIFIER_PROTOTYPES')
+    if not model_path or not prototypes_path:
+        return None
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                if _load_failed_at is not None and time.monotonic() - _load_failed_at < LOAD_RETRY_SECONDS:
+                    return None
+                try:
+                    _classifier = LocalClassifier(
+                        model_path,
+                        prototypes_path,
+                        threshold=float(os.getenv('LOCAL_CLASSIFIER_THRESHOLD', '0.6')),
+                        temperature=float(os.getenv('LOCAL_CLASSIFIER_TEMPERATURE', '0.05')),
+                    )
+                except Exception as e:
+                    _load_failed_at = time.monotonic()
+                    print(f"Warning: Local classifier failed to load, retrying in {LOAD_RETRY_SECONDS}s: {e}")
+                    return None
+                _load_failed_at = None
+    return _classifier
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local animal classifier tools')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+
+    build = subcommands.add_parser('build', help='build the prototype matrix from a labelled folder')
+    build.add_argument('image_dir', help='folder with one sub-folder of images per animal')
+    build.add_argument('--model', required=True, help='embedding model (.onnx)')
+    build.add_argument('-o', '--output', required=True, help='prototype file to write (.npz)')
+
+    classify = subcommands.add_parser('classify', help='score images against a prototype file')
+    classify.add_argument('images', nargs='+')
+    classify.add_argument('--model', required=True)
+    classify.add_argument('--prototypes', required=True)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        try:
+            labels, vectors = build_prototypes(LocalClassifier(args.model), args.image_dir)
+        except ValueError as e:
+            parser.error(str(e))
+        np.savez(args.output, labels=np.array(labels), vectors=vectors)
+        print(f"Wrote {len(labels)} prototypes ({vectors.shape[1]}-d) to {args.output}")
+    else:
+        classifier = LocalClassifier(args.model, args.prototypes)
+        for path in args.images:
+            with Image.open(path) as image:
+                animal, confidence = classifier.classify(image)
+            print(f"{path}: {animal} ({confidence:.2f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Lightweight in-process metrics with Prometheus text exposition.
+
+Counters and fixed-bucket histograms, cheap enough to leave on in production:
+observing a value is a bisect plus a few additions under a lock (about
+two microseconds). Metrics are per process; under gunicorn each worker
+reports its own numbers.
+"""
+import bisect
+import threading
+import time
+
+# Seconds; spans from sub-millisecond hashing up to multi-second vision calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _label_key(labels):
+    # Sorting only matters when there is more than one label
+    return tuple(sorted(labels.items())) if len(labels) > 1 else tuple(labels.items())
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(labels), 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # label key -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        index = bisect.bisect_left(self.buckets, value)
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block"""
+        return _Span(self, labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(key, {"le": bound})} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{_format_labels(key, {"le": "+Inf"})} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {series[-1]!r}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+class _Span:
+    # A plain class rather than @contextmanager: half the overhead per span
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Gauge:
+    """A value read from a callback at scrape time"""
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+
+    def render(self):
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge',
+                f'{self.name} {_format_value(value)}']
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name, help_text, callback):
+        return self._register(Gauge(name, help_text, callback))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Pipeline-wide series shared by the modules that record into them
+STAGE_SECONDS = REGISTRY.histogram(
+    'predict_stage_seconds', 'Time spent in each prediction stage')
+OPENAI_ATTEMPT_SECONDS = REGISTRY.histogram(
+    'openai_attempt_seconds', 'Duration of each vision-model attempt, by attempt number and outcome')
+VALIDATION_FAILURES = REGISTRY.counter(
+    'animal_validation_failures_total', 'Vision replies whose animal failed validation')
+FALLBACKS = REGISTRY.counter(
+    'animal_fallback_total', 'Requests answered with the default cat fallback')
+REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_seconds', 'Request latency by endpoint and status')
+
+# Token counts; prompt includes cached_prompt, the part served from the provider's prompt cache
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+OPENAI_TOKENS = REGISTRY.counter(
+    'openai_tokens_total', 'Tokens billed by the provider, by model and kind (prompt, cached_prompt, completion)')
+OPENAI_REQUEST_TOKENS = REGISTRY.histogram(
+    'openai_request_tokens', 'Tokens per provider request, by model and kind', buckets=TOKEN_BUCKETS)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def server_timing(timings):
+    """Format a {stage: seconds} dict as a Server-Timing header value"""
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in timings.items())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Prepare faster U2NetP variants ahead of deployment.
+
+From the stock FP32 model (or --source) this writes, into model/:
+
+  u2netp.opt.onnx   FP32 with all of onnxruntime's graph optimizations
+                    (constant folding, Conv+BatchNorm/activation fusion,
+                    blocked memory layouts, ...) already applied, so
+                    sessions load it with optimization off
+  u2netp.int8.onnx  INT8 weights and activations (static QDQ quantization
+                    calibrated on sample images, or dynamic weight-only
+                    with --quantization dynamic), also pre-optimized
+  u2netp.prep.json  manifest: onnxruntime version, CPU model, per-variant
+                    session load time, latency, size, memory and mask IoU
+                    against FP32
+
+Every variant's masks are compared with FP32's on held-out sample images
+(thresholded at 0.5); a variant whose mean IoU is under --min-iou is marked
+as failed, the runtime won't load it, and the command exits 1. Select a
+variant with U2NETP_VARIANT=optimized|int8 (see session_pool.py). Re-run
+after upgrading onnxruntime or moving to another CPU model: optimized
+graphs are tied to the version and the CPU that wrote them.
+
+Quantization needs the `onnx` package, which the service itself doesn't.
+
+    python model_prep.py
+    python model_prep.py --images ../image --calibration-images 16 --min-iou 0.95
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from pipeline import iter_image_files
+from session_pool import (INPUT_MEAN, INPUT_STD, INPUT_SIZE, MANIFEST_NAME, MODEL_VARIANTS, host_cpu, model_dir,
+                          session_options)
+
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'image')
+# Mask level counted as subject for IoU, as in background_remover
+SUBJECT_LEVEL = 0.5
+
+
+def model_input(image):
+    """U2NetP's input for a PIL image, normalized the way rembg does it"""
+    pixels = np.asarray(image.convert('RGB').resize(INPUT_SIZE, Image.Resampling.LANCZOS), dtype=np.float32)
+    pixels = pixels / max(float(pixels.max()), 1e-6)
+    pixels = (pixels - np.array(INPUT_MEAN, dtype=np.float32)) / np.array(INPUT_STD, dtype=np.float32)
+    return pixels.transpose(2, 0, 1)[np.newaxis].astype(np.float32)
+
+
+def stock_model_path():
+    """The FP32 model rembg uses, downloading it if necessary"""
+    from rembg.sessions.u2netp import U2netpSession
+    return U2netpSession.download_models()
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as model_file:
+        for block in iter(lambda: model_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def load(path, optimized_path=None, variant='fp32'):
+    """
+    A CPU session for `path` with the options the runtime uses for `variant`;
+    with optimized_path, the fully optimized graph is written there
+    """
+    import onnxruntime as ort
+    options = session_options(variant, int(os.getenv('ORT_INTRA_OP_THREADS', '0')))
+    if optimized_path:
+        # All, layout transformations included: the runtime loads prepared graphs
+        # with optimization off, and without them inference runs ~2x slower. They
+        # are specific to this CPU, which the manifest records (onnxruntime warns)
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.optimized_model_filepath = optimized_path
+        options.log_severity_level = 3
+    return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def quantize(source, destination, calibration_inputs, mode):
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_dynamic, quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Shape inference and basic cleanup first, as the quantizer recommends
+        preprocessed = os.path.join(work_dir, 'preprocessed.onnx')
+        quant_pre_process(source, preprocessed, skip_symbolic_shape=True)
+        if mode == 'dynamic':
+            quantize_dynamic(preprocessed, destination, weight_type=QuantType.QInt8)
+            return
+
+        class ImageReader(CalibrationDataReader):
+            # Feeds the sample images to the calibrator
+            def __init__(self, input_name, inputs):
+                self.input_name = input_name
+                self.inputs = iter(inputs)
+
+            def get_next(self):
+                batch = next(self.inputs, None)
+                return None if batch is None else {self.input_name: batch}
+
+        reader = ImageReader(load(preprocessed).get_inputs()[0].name, calibration_inputs)
+        quantize_static(preprocessed, destination, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+
+
+def predict(session, inputs):
+    """0..1 masks, min-max scaled like SessionPool.predict_mask_arrays"""
+    input_name = session.get_inputs()[0].name
+    masks = []
+    for batch in inputs:
+        prediction = session.run(None, {input_name: batch})[0][0, 0]
+        low, high = prediction.min(), prediction.max()
+        masks.append((prediction - low) / max(high - low, 1e-8))
+    return masks
+
+
+def mask_iou(reference, candidate):
+    reference = reference >= SUBJECT_LEVEL
+    candidate = candidate >= SUBJECT_LEVEL
+    union = np.logical_or(reference, candidate).sum()
+    return float(np.logical_and(reference, candidate).sum() / union) if union else 1.0
+
+
+def measure(path, inputs, variant='fp32', rounds=3):
+    """(session, ms to load it, ms per inference, MB of RSS the session added)"""
+    before = _rss_mb()
+    start = time.perf_counter()
+    session = load(path, variant=variant)
+    load_ms = (time.perf_counter() - start) * 1000
+    predict(session, inputs[:1])  # first run allocates the arenas
+    memory = _rss_mb() - before
+    start = time.perf_counter()
+    for _ in range(rounds):
+        predict(session, inputs)
+    latency = (time.perf_counter() - start) / (rounds * len(inputs)) * 1000
+    return session, load_ms, latency, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', help='FP32 model to start from (default: the stock u2netp.onnx)')
+    parser.add_argument('--images', default=IMAGE_DIR, help='sample images for calibration and the IoU check')
+    parser.add_argument('--calibration-images', type=int, default=16,
+                        help='images used for calibration; the rest are held out for the IoU check (default 16)')
+    parser.add_argument('--quantization', choices=('static', 'dynamic'), default='static')
+    parser.add_argument('--min-iou', type=float, default=0.95, help='lowest mean mask IoU against FP32 (default 0.95)')
+    parser.add_argument('--output-dir', default=model_dir, help='where to write the variants (default model/)')
+    args = parser.parse_args()
+
+    import onnxruntime as ort
+    source = args.source or stock_model_path()
+    inputs = []
+    for _, data in iter_image_files([args.images]):
+        with Image.open(io.BytesIO(data)) as image:
+            inputs.append(model_input(image))
+    if len(inputs) < 2:
+        parser.error(f"need at least two sample images in {args.images}")
+    # Every other image calibrates, up to the limit; the IoU check uses the others
+    calibration = inputs[::2][:args.calibration_images]
+    held_out = [batch for index, batch in enumerate(inputs) if index % 2 or index // 2 >= args.calibration_images]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    fp32_session, fp32_load, fp32_latency, fp32_memory = measure(source, held_out)
+    reference = predict(fp32_session, held_out)
+    manifest = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'source': os.path.basename(source),
+        'source_md5': file_md5(source),
+        'fp32': {'load_ms': round(fp32_load, 1), 'latency_ms': round(fp32_latency, 2),
+                 'memory_mb': round(fp32_memory, 1), 'size_mb': round(os.path.getsize(source) / 1e6, 2)},
+        'variants': {},
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        artifacts = {'optimized': source}
+        quantized = os.path.join(work_dir, 'quantized.onnx')
+        print(f"Quantizing ({args.quantization}, {len(calibration)} calibration images)...")
+        quantize(source, quantized, calibration, args.quantization)
+        artifacts['int8'] = quantized
+
+        failed = []
+        print(f"{'variant':10} {'load ms':>8} {'ms/image':>9} {'memory MB':>10} {'size MB':>8} "
+              f"{'IoU mean':>9} {'IoU min':>8}")
+        print(f"{'fp32':10} {fp32_load:8.1f} {fp32_latency:9.1f} {fp32_memory:10.1f} "
+              f"{manifest['fp32']['size_mb']:8.2f}")
+        for variant, graph in artifacts.items():
+            destination = os.path.join(args.output_dir, MODEL_VARIANTS[variant])
+            staged = os.path.join(work_dir, MODEL_VARIANTS[variant])
+            load(graph, optimized_path=staged)
+            session, load_ms, latency, memory = measure(staged, held_out, variant)
+            ious = [mask_iou(expected, mask) for expected, mask in zip(reference, predict(session, held_out))]
+            passed = float(np.mean(ious)) >= args.min_iou
+            shutil.move(staged, destination)
+            manifest['variants'][variant] = {
+                'file': MODEL_VARIANTS[variant],
+                'onnxruntime': ort.__version__,
+                'cpu': host_cpu(),
+                'quantization': args.quantization if variant == 'int8' else None,
+                'load_ms': round(load_ms, 1),
+                'latency_ms': round(latency, 2),
+                'memory_mb': round(memory, 1),
+                'size_mb': round(os.path.getsize(destination) / 1e6, 2),
+                'iou_mean': round(float(np.mean(ious)), 4),
+                'iou_min': round(float(np.min(ious)), 4),
+                'passed': passed,
+            }
+            if not passed:
+                failed.append(variant)
+            entry = manifest['variants'][variant]
+            print(f"{variant:10} {load_ms:8.1f} {latency:9.1f} {memory:10.1f} {entry['size_mb']:8.2f} "
+                  f"{entry['iou_mean']:9.4f} {entry['iou_min']:8.4f}{'' if passed else '  FAILED'}")
+
+    with open(os.path.join(args.output_dir, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+        manifest_file.write('\n')
+    if failed:
+        print(f"Mean IoU under {args.min_iou} for: {', '.join(failed)}; the runtime will keep using fp32 for them",
+              file=sys.stderr)
+        return 1
+    print(f"Wrote {', '.join(MODEL_VARIANTS[variant] for variant in artifacts)} to {args.output_dir}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+Shared, long-lived OpenAI client for the API.
+
+A single AsyncOpenAI client lives on a background event loop thread, so its
+HTTP connection pool (and TLS sessions) are reused across requests. Calls go
+through a semaphore that bounds in-flight requests to the provider, and retry
+backoff uses asyncio.sleep, so a waiting retry doesn't hold a thread.
+
+Sync code (Flask handlers) uses run() to wait for a coroutine, or submit() to
+get a concurrent.futures.Future back.
+
+The SDK takes most of a second to import, so it is loaded with the client
+(or by warm_up()), not when this module is imported.
+"""
+import asyncio
+import importlib
+import os
+import random
+import threading
+
+from metrics import OPENAI_REQUEST_TOKENS, OPENAI_TOKENS
+
+
+def transient_errors():
+    """Errors worth retrying: the request may succeed if sent again"""
+    import openai
+    return (
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+    )
+
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+_semaphore = None
+
+
+def _reset_after_fork():
+    # The loop thread doesn't exist in a forked child; start over there
+    global _loop, _loop_lock, _client, _semaphore
+    _loop = None
+    _loop_lock = threading.Lock()
+    _client = None
+    _semaphore = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_loop():
+    """Start the background event loop on first use"""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='openai-client-loop', daemon=True)
+                thread.start()
+                _loop = loop
+    return _loop
+
+
+def submit(coro):
+    """Schedule a coroutine on the client loop; returns a concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+def run(coro, timeout=None):
+    """Run a coroutine on the client loop and wait for its result; it is cancelled if the wait times out"""
+    future = submit(coro)
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+def get_client():
+    """
+    Return the shared AsyncOpenAI client. Must be called on the client loop.
+      OPENAI_TIMEOUT          per-request timeout in seconds (default 60)
+      OPENAI_MAX_CONCURRENCY  max in-flight requests to the provider (default 16)
+      OPENAI_BASE_URL         read by the SDK, e.g. to point at a local stub server
+    """
+    global _client, _semaphore
+    if _client is None:
+        from openai import AsyncOpenAI
+        # SDK-level retries are disabled; hedging.run_hedged owns the policy
+        _client = AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            timeout=float(os.getenv('OPENAI_TIMEOUT', '60')),
+            max_retries=0,
+        )
+        _semaphore = asyncio.Semaphore(int(os.getenv('OPENAI_MAX_CONCURRENCY', '16')))
+    return _client
+
+
+def record_usage(model, usage):
+    """Count a response's token usage, if the provider reported it"""
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    counts = {
+        'prompt': usage.prompt_tokens or 0,
+        'cached_prompt': (getattr(details, 'cached_tokens', None) or 0) if details else 0,
+        'completion': usage.completion_tokens or 0,
+    }
+    for kind, tokens in counts.items():
+        OPENAI_TOKENS.inc(tokens, model=model, kind=kind)
+        OPENAI_REQUEST_TOKENS.observe(tokens, model=model, kind=kind)
+
+
+async def create_chat_completion(**kwargs):
+    """chat.completions.create on the shared client, bounded by the concurrency semaphore"""
+    client = get_client()
+    async with _semaphore:
+        response = await client.chat.completions.create(**kwargs)
+    record_usage(kwargs.get('model'), response.usage)
+    return response
+
+
+async def stream_chat_completion(**kwargs):
+    """
+    Streaming chat.completions.create: an async generator of content deltas.
+    The semaphore slot is held until the stream ends or the generator is
+    closed; closing it early drops the HTTP response, which stops generation.
+    Usage arrives in a last, choice-less chunk, so streams closed early
+    aren't counted in the token metrics.
+    """
+    client = get_client()
+    async with _semaphore:
+        stream = await client.chat.completions.create(stream=True, stream_options={'include_usage': True}, **kwargs)
+        try:
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    record_usage(kwargs.get('model'), chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def warm_up():
+    """Import the SDK and create the loop, and the client if a key is configured, ahead of the first request"""
+    importlib.import_module('openai')
+
+    async def _init():
+        if os.getenv('OPENAI_API_KEY'):
+            get_client()
+    run(_init())
@@ -0,0 +1,312 @@
+"""
+Payments: Stripe intents and webhooks, and locally verifiable usage tokens.
+
+Paying for an analysis never puts Stripe on the /predict path. Stripe
+reports a completed payment by webhook (payment_intent.succeeded, checked
+against STRIPE_WEBHOOK_SECRET) and it is recorded locally; the browser
+then exchanges the intent id for a usage token: the intent id and an
+expiry, signed with HMAC-SHA256 under PAYMENT_TOKEN_SECRET. Checking one is
+a hash and a clock comparison. Each token is spent once: redeeming it
+inserts its id into a small sqlite table shared by every worker on the
+host, and rows go once the token would have expired anyway, so the table
+only ever holds live tokens.
+
+Intents are created on one StripeClient with an httpx connection pool,
+run on the background event loop the OpenAI client uses (see
+openai_client.py), with a timeout and an idempotency key: a checkout the
+browser retries with the same Idempotency-Key gets the same intent back
+instead of a second charge, and the SDK's own network retries reuse it.
+
+Point STRIPE_API_BASE at stripe-mock (http://localhost:12111) or at
+benchmarks/fake_stripe.py to run all of it without Stripe.
+
+Configuration (environment):
+  STRIPE_SECRET_KEY       API key
+  STRIPE_WEBHOOK_SECRET   signing secret of the webhook endpoint (whsec_...)
+  STRIPE_API_BASE         API base URL (default Stripe's)
+  STRIPE_TIMEOUT          seconds per API request (default 10)
+  STRIPE_MAX_RETRIES      network retries per request (default 2)
+  PAYMENT_REQUIRED        require a usage token for analyses (default false)
+  PAYMENT_TOKEN_SECRET    HMAC key for usage tokens
+  PAYMENT_TOKEN_TTL       seconds a token is valid once issued (default 900)
+  PAYMENT_STORE_PATH      sqlite file for payments and redeemed tokens (default payments.sqlite3)
+  INTERNAL_API_TOKEN      X-Internal-Token for /predict_path and /predict_batch, which take no usage
+                          token; without it they are closed while PAYMENT_REQUIRED is on
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import openai_client
+from metrics import REGISTRY
+
+PRICE_CENTS = 99
+CURRENCY = 'usd'
+SERVICE = 'image_analysis'
+TOKEN_VERSION = 'v1'
+# Payments are remembered for longer than Stripe retries a webhook delivery (3 days),
+# so a late redelivery can't record a spent payment again
+PAYMENT_RETENTION = 7 * 24 * 3600
+
+PAYMENT_EVENTS = REGISTRY.counter(
+    'payment_events_total', 'Payment events by kind (paid, token_issued, redeemed, refunded, rejected)')
+
+
+class PaymentError(Exception):
+    """A payment step failed; `status` is the HTTP status to answer with"""
+
+    def __init__(self, status, error, message):
+        super().__init__(message)
+        self.status = status
+        self.error = error
+        self.message = message
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class UsageTokens:
+    """Issues and checks `v1.<claims>.<signature>` tokens; claims are the intent id and expiry"""
+
+    def __init__(self, secret, ttl=900):
+        self._key = secret.encode() if isinstance(secret, str) else secret
+        self.ttl = ttl
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self._key, f'{TOKEN_VERSION}.{payload}'.encode(), hashlib.sha256).digest())
+
+    def issue(self, subject, issued=None):
+        """A token for `subject`; the same issue time gives the same token"""
+        expires = int((issued if issued is not None else time.time()) + self.ttl)
+        payload = _b64encode(json.dumps({'sub': subject, 'exp': expires}, separators=(',', ':')).encode())
+        return f'{TOKEN_VERSION}.{payload}.{self._sign(payload)}', expires
+
+    def verify(self, token, now=None):
+        """The token's claims if it is genuine and unexpired; raises PaymentError otherwise"""
+        try:
+            version, payload, signature = token.split('.')
+            # As bytes: compare_digest refuses non-ASCII str, and headers can carry anything
+            genuine = version == TOKEN_VERSION and hmac.compare_digest(
+                signature.encode('utf-8', 'surrogateescape'), self._sign(payload).encode('ascii'))
+        except (AttributeError, ValueError):
+            raise PaymentError(402, 'Invalid usage token', 'The usage token is malformed')
+        if not genuine:
+            raise PaymentError(402, 'Invalid usage token', 'The usage token signature does not match')
+        try:
+            claims = json.loads(_b64decode(payload))
+            subject, expires = str(claims['sub']), float(claims['exp'])
+        except (ValueError, KeyError, TypeError):
+            raise PaymentError(402, 'Invalid usage token', 'The usage token claims are malformed')
+        if expires <= (now if now is not None else time.time()):
+            raise PaymentError(402, 'Usage token expired', 'The usage token has expired, please pay again')
+        return {'sub': subject, 'exp': expires}
+
+
+class PaymentStore:
+    """Paid intents and redeemed tokens in a local sqlite file, shared by every process on the host"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS payments '
+                '(intent TEXT PRIMARY KEY, amount INTEGER NOT NULL, paid REAL NOT NULL, issued REAL) WITHOUT ROWID'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS redeemed (token TEXT PRIMARY KEY, expires REAL NOT NULL) WITHOUT ROWID'
+            )
+
+    def record_payment(self, intent, amount):
+        """Remember a completed payment; repeated webhook deliveries are ignored"""
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR IGNORE INTO payments (intent, amount, paid) VALUES (?, ?, ?)',
+                               (intent, amount, time.time()))
+
+    def claim(self, intent):
+        """When the token for a paid intent was (or is now) issued; None if no payment is recorded"""
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE payments SET issued = ? WHERE intent = ? AND issued IS NULL',
+                               (time.time(), intent))
+            row = self._conn.execute('SELECT issued FROM payments WHERE intent = ?', (intent,)).fetchone()
+        return row[0] if row is not None else None
+
+    def redeem(self, token_id, expires):
+        """True the first time a token is spent, False after that"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute('INSERT OR IGNORE INTO redeemed (token, expires) VALUES (?, ?)',
+                                        (token_id, expires))
+        return cursor.rowcount == 1
+
+    def refund(self, token_id):
+        """Make a redeemed token spendable again"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM redeemed WHERE token = ?', (token_id,))
+
+    def purge(self):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM redeemed WHERE expires < ?', (now,))
+            self._conn.execute('DELETE FROM payments WHERE paid < ?', (now - PAYMENT_RETENTION,))
+
+
+class Payments:
+    def __init__(self, store, tokens, webhook_secret=None):
+        self.store = store
+        self.tokens = tokens
+        self.webhook_secret = webhook_secret
+
+    def handle_webhook(self, payload, signature):
+        """Verify a Stripe webhook delivery and record the payment it reports; returns the event type"""
+        import stripe
+        if not self.webhook_secret:
+            raise PaymentError(500, 'Webhook not configured', 'STRIPE_WEBHOOK_SECRET is not set')
+        try:
+            stripe.WebhookSignature.verify_header(payload.decode('utf-8'), signature, self.webhook_secret,
+                                                  tolerance=stripe.Webhook.DEFAULT_TOLERANCE)
+            event = json.loads(payload)
+        except (ValueError, stripe.SignatureVerificationError) as e:
+            PAYMENT_EVENTS.inc(kind='rejected')
+            raise PaymentError(400, 'Invalid webhook', str(e))
+
+        event_type = event.get('type') if isinstance(event, dict) else None
+        if event_type == 'payment_intent.succeeded':
+            data = event.get('data')
+            intent = data.get('object') if isinstance(data, dict) else None
+            if not isinstance(intent, dict) or not intent.get('id'):
+                PAYMENT_EVENTS.inc(kind='rejected')
+                raise PaymentError(400, 'Invalid webhook', 'payment_intent.succeeded event has no payment intent')
+            metadata = intent.get('metadata') or {}
+            if metadata.get('service') == SERVICE and intent.get('amount_received', 0) >= PRICE_CENTS:
+                self.store.record_payment(intent['id'], intent['amount_received'])
+                PAYMENT_EVENTS.inc(kind='paid')
+        return event_type
+
+    def issue_token(self, intent):
+        """(token, expires) for a paid intent, or None while its webhook hasn't arrived"""
+        issued = self.store.claim(intent)
+        if issued is None:
+            return None
+        self.store.purge()
+        PAYMENT_EVENTS.inc(kind='token_issued')
+        return self.tokens.issue(intent, issued)
+
+    def redeem(self, token):
+        """Spend a usage token; returns its id (for refund) or raises PaymentError"""
+        if not token:
+            raise PaymentError(402, 'Payment required', 'A usage token is required for this request')
+        claims = self.tokens.verify(token)
+        if not self.store.redeem(claims['sub'], claims['exp']):
+            raise PaymentError(402, 'Usage token already used', 'This usage token has already been spent')
+        PAYMENT_EVENTS.inc(kind='redeemed')
+        return claims['sub']
+
+    def refund(self, token_id):
+        self.store.refund(token_id)
+        PAYMENT_EVENTS.inc(kind='refunded')
+
+
+_stripe_client = None
+
+
+def get_stripe_client():
+    """The shared StripeClient; must be called on the client loop"""
+    global _stripe_client
+    if _stripe_client is None:
+        import stripe
+        base = os.getenv('STRIPE_API_BASE')
+        _stripe_client = stripe.StripeClient(
+            os.getenv('STRIPE_SECRET_KEY'),
+            base_addresses={'api': base} if base else None,
+            max_network_retries=int(os.getenv('STRIPE_MAX_RETRIES', '2')),
+            http_client=stripe.HTTPXClient(timeout=float(os.getenv('STRIPE_TIMEOUT', '10'))),
+        )
+    return _stripe_client
+
+
+async def create_intent_async(product_id, idempotency_key):
+    client = get_stripe_client()
+    return await client.v1.payment_intents.create_async(
+        params={
+            'amount': PRICE_CENTS,
+            'currency': CURRENCY,
+            'automatic_payment_methods': {'enabled': True},
+            'metadata': {'product_id': product_id, 'service': SERVICE},
+        },
+        options={'idempotency_key': idempotency_key},
+    )
+
+
+def create_intent(product_id, idempotency_key=None):
+    """
+    Create the PaymentIntent for one analysis; the same idempotency key
+    returns the same intent. Raises PaymentError.
+    """
+    import stripe
+    key = f'intent-{idempotency_key[:200]}' if idempotency_key else f'intent-{uuid.uuid4()}'
+    # A backstop behind the SDK's own timeout, retries and their backoff
+    timeout = (float(os.getenv('STRIPE_TIMEOUT', '10')) + 2) * (int(os.getenv('STRIPE_MAX_RETRIES', '2')) + 1)
+    try:
+        return openai_client.run(create_intent_async(product_id, key), timeout=timeout)
+    except stripe.IdempotencyError as e:
+        raise PaymentError(409, 'Idempotency key reused', str(e))
+    except stripe.StripeError as e:
+        raise PaymentError(502, 'Payment intent creation failed', str(e))
+    except TimeoutError:
+        raise PaymentError(504, 'Payment intent creation failed', f'Stripe did not answer within {timeout}s')
+
+
+def warm_up():
+    """Create the Stripe client (and its HTTP pool) ahead of the first checkout, if a key is configured"""
+    async def _init():
+        if os.getenv('STRIPE_SECRET_KEY'):
+            get_stripe_client()
+    openai_client.run(_init())
+
+
+def payment_required():
+    return os.getenv('PAYMENT_REQUIRED', 'false').lower() == 'true'
+
+
+_payments = None
+_payments_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # sqlite connections must not cross fork(); the client lives on the loop, which is rebuilt too
+    global _payments, _payments_lock, _stripe_client
+    _payments = None
+    _payments_lock = threading.Lock()
+    _stripe_client = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_payments():
+    """The process-wide Payments; raises PaymentError if PAYMENT_TOKEN_SECRET is missing"""
+    global _payments
+    if _payments is None:
+        with _payments_lock:
+            if _payments is None:
+                secret = os.getenv('PAYMENT_TOKEN_SECRET')
+                if not secret:
+                    raise PaymentError(500, 'Payments not configured', 'PAYMENT_TOKEN_SECRET is not set')
+                _payments = Payments(
+                    PaymentStore(os.getenv('PAYMENT_STORE_PATH', 'payments.sqlite3')),
+                    UsageTokens(secret, ttl=int(os.getenv('PAYMENT_TOKEN_TTL', '900'))),
+                    webhook_secret=os.getenv('STRIPE_WEBHOOK_SECRET'),
+                )
+    return _payments
@@ -0,0 +1,359 @@
+"""
+End-to-end prediction: raw upload bytes in, analysis result out.
+Shared by the Flask endpoints and the CLI so they all go through the same cache.
+"""
+import os
+import queue
+import time
+from contextlib import contextmanager
+from concurrent.futures import wait, FIRST_COMPLETED
+import openai_client
+from background_remover import remove_background_image, remove_background_images
+from preprocess import encode_for_budget, normalize_image, resize_for_vision
+from analysis import analyze_animal_bytes, analyze_animal_async
+from animal_analyzer import parse_response
+from result_cache import get_result_cache
+from metrics import STAGE_SECONDS
+from local_classifier import get_local_classifier
+from upload import decode_image, UploadRejected
+from singleflight import get_single_flight, CoalescedError
+from admission import should_skip_segmentation
+
+class PipelineError(Exception):
+    """A pipeline stage failed; `error` is the user-facing summary, `status` the HTTP status"""
+
+    def __init__(self, error, message, status=500):
+        super().__init__(message)
+        self.error = error
+        self.message = message
+        self.status = status
+
+def _lookup_bytes(cache, image_data):
+    """
+    Exact-tier lookup, done before decoding so byte-identical re-uploads cost one hash.
+    Returns (output or None, keys).
+    """
+    if cache is None:
+        return None, {}
+    keys = cache.keys_for(image_bytes=image_data)
+    result, tier = cache.lookup(keys)
+    if result is not None:
+        return {'result': result, 'cache': 'hit', 'cache_tier': tier}, keys
+    return None, keys
+
+def _lookup_image(cache, image, keys):
+    """Perceptual-tier lookup on the decoded image; adds its key to `keys`"""
+    if cache is None:
+        return None
+    perceptual_keys = cache.keys_for(image=image)
+    keys.update(perceptual_keys)
+    result, tier = cache.lookup(perceptual_keys)
+    if result is not None:
+        return {'result': result, 'cache': 'hit', 'cache_tier': tier}
+    return None
+
+def _local_label(composite, timings=None):
+    """
+    The animal from the local classifier when it is confident, otherwise None.
+    Timed as the 'local_classifier' stage only when a classifier is configured.
+    """
+    classifier = get_local_classifier()
+    if classifier is None:
+        return None
+    try:
+        with timed_stage(timings, 'local_classifier'):
+            return classifier.confident_label(composite)
+    except Exception as e:
+        print(f"Warning: Local classifier failed, using the vision model: {e}")
+        return None
+
+def _miss(cache, keys, result, degraded=False):
+    # Only successful, full-quality analyses are worth remembering
+    if cache is not None and result and not result.startswith('Error') and not degraded:
+        cache.store(keys, result)
+    output = {'result': result, 'cache': 'miss' if cache is not None else 'disabled', 'cache_tier': None}
+    if degraded:
+        output['degraded'] = True
+    return output
+
+@contextmanager
+def timed_stage(timings, name):
+    """Record the duration of the block in the stage histogram and in timings[name], if given"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        if timings is not None:
+            timings[name] = round(elapsed, 4)
+
+def _prepare(cache, image_data, timings):
+    """
+    Every stage before the vision call.
+    Returns (output, keys, None, False) on a cache hit, otherwise
+    (None, keys, analysis_args, degraded) where analysis_args are
+    (image_bytes, mime_type, known_animal); degraded is True if background
+    removal was skipped because segmentation is backed up (see admission.py).
+    """
+    with timed_stage(timings, 'cache_exact'):
+        output, keys = _lookup_bytes(cache, image_data)
+    if output is not None:
+        return output, keys, None, False
+
+    # Step 1: Decode the image and remove background
+    try:
+        with timed_stage(timings, 'decode'):
+            input_image = decode_image(image_data)
+        with timed_stage(timings, 'cache_perceptual'):
+            output = _lookup_image(cache, input_image, keys)
+        if output is not None:
+            return output, keys, None, False
+        if should_skip_segmentation():
+            # The whole picture goes to the vision model; no local classifier, it expects cut-outs
+            with timed_stage(timings, 'encode'):
+                image_bytes, mime_type, _ = encode_for_budget(resize_for_vision(normalize_image(input_image)))
+            return None, keys, (image_bytes, mime_type, None), True
+        with timed_stage(timings, 'segmentation'):
+            composite = remove_background_image(input_image)
+        with timed_stage(timings, 'encode'):
+            image_bytes, mime_type, _ = encode_for_budget(composite)
+    except UploadRejected as e:
+        raise PipelineError(e.error, e.message, e.status)
+    except Exception as e:
+        raise PipelineError('Background removal failed', str(e))
+
+    # The vision call can be skipped when the local classifier is sure
+    known_animal = _local_label(composite, timings)
+    return None, keys, (image_bytes, mime_type, known_animal), False
+
+class _Alone:
+    # Stands in for a Flight when coalescing is off
+    output = None
+    coalesced = False
+
+    def resolve(self, output):
+        self.output = output
+
+@contextmanager
+def coalesced(image_data):
+    """
+    Single-flight section for one upload (see singleflight.py). The flight's
+    `output` is set if a concurrent identical upload answered for us;
+    otherwise do the work and resolve() it.
+    """
+    single_flight = get_single_flight()
+    if single_flight is None:
+        yield _Alone()
+        return
+    try:
+        with single_flight.flight(image_data) as flight:
+            yield flight
+    except CoalescedError as e:
+        raise PipelineError(e.error, e.message)
+
+def _coalesced_output(output):
+    return dict(output, cache='coalesced')
+
+def predict_image_bytes(image_data, timings=None):
+    """
+    Run background removal and animal analysis on an encoded image.
+    Returns {'result': str, 'cache': 'hit'|'miss'|'disabled'|'coalesced', 'cache_tier': str|None};
+    'coalesced' means a concurrent upload of the same bytes did the work.
+    If a `timings` dict is given, per-stage durations in seconds are added to it.
+    """
+    with coalesced(image_data) as flight:
+        if flight.output is None:
+            flight.resolve(_predict_image_bytes(image_data, timings))
+        elif flight.coalesced:
+            return _coalesced_output(flight.output)
+    return flight.output
+
+def _predict_image_bytes(image_data, timings):
+    cache = get_result_cache()
+    output, keys, analysis_args, degraded = _prepare(cache, image_data, timings)
+    if output is not None:
+        return output
+
+    # Step 2: Analyze animal
+    try:
+        with timed_stage(timings, 'analysis'):
+            result = analyze_animal_bytes(*analysis_args)
+    except Exception as e:
+        raise PipelineError('Animal analysis failed', str(e))
+
+    return _miss(cache, keys, result, degraded)
+
+def _replay(output):
+    # A finished result as the events a stream would have sent
+    yield 'label', parse_response(output['result']).animal
+    yield 'delta', output['result']
+    yield 'result', output
+
+def stream_image_bytes(image_data, timings=None):
+    """
+    Streaming variant of predict_image_bytes: a generator of (event, data) pairs.
+      ('label', animal)  as soon as the animal is settled
+      ('delta', text)    pieces of the reply as the explanation generates
+      ('result', output) the same dict predict_image_bytes returns, last
+    Raises PipelineError like predict_image_bytes. Closing the generator early
+    (e.g. the client disconnected) cancels the vision call, and concurrent
+    duplicates waiting on this upload take over.
+    """
+    with coalesced(image_data) as flight:
+        if flight.output is not None:
+            yield from _replay(_coalesced_output(flight.output) if flight.coalesced else flight.output)
+            return
+        for event, data in _stream_image_bytes(image_data, timings):
+            if event == 'result':
+                flight.resolve(data)
+            yield event, data
+
+def _stream_image_bytes(image_data, timings):
+    cache = get_result_cache()
+    output, keys, analysis_args, degraded = _prepare(cache, image_data, timings)
+    if output is not None:
+        yield from _replay(output)
+        return
+
+    # Callbacks fire on the client loop; hand their events over to this thread
+    events = queue.Queue()
+    start = time.perf_counter()
+    future = openai_client.submit(analyze_animal_async(
+        *analysis_args,
+        on_label=lambda animal: events.put(('label', animal)),
+        on_delta=lambda text: events.put(('delta', text)),
+    ))
+    future.add_done_callback(lambda _: events.put(None))
+    try:
+        for event in iter(events.get, None):
+            yield event
+        try:
+            result = future.result()
+        except Exception as e:
+            raise PipelineError('Animal analysis failed', str(e))
+    finally:
+        future.cancel()
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage='analysis')
+        if timings is not None:
+            timings['analysis'] = round(elapsed, 4)
+
+    yield 'result', _miss(cache, keys, result, degraded)
+
+def _record(name, start, output):
+    return {
+        'name': name,
+        'success': True,
+        'result': output['result'],
+        'cache': output['cache'],
+        'seconds': round(time.perf_counter() - start, 4),
+    }
+
+def _error_record(name, start, error, message):
+    return {
+        'name': name,
+        'success': False,
+        'error': error,
+        'message': message,
+        'seconds': round(time.perf_counter() - start, 4),
+    }
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.avif')
+
+def iter_image_files(paths):
+    """
+    Yield (name, image_bytes) for image files, expanding directories
+    (non-recursively, sorted by name). Files are read lazily.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+            files = [os.path.join(path, name) for name in names]
+        else:
+            files = [path]
+        for file_path in files:
+            with open(file_path, 'rb') as image_file:
+                yield file_path, image_file.read()
+
+def predict_batch(items, batch_size=8, parallelism=4):
+    """
+    Run the pipeline over many images.
+
+    `items` is an iterable of (name, image_bytes). Images are segmented
+    `batch_size` at a time in a single U2NetP run, and at most `parallelism`
+    vision calls from this batch are in flight at once. Yields one record per
+    image, in completion order, as soon as it is done.
+    """
+    cache = get_result_cache()
+    pending = {}  # future -> (name, keys, start)
+
+    def finish(block):
+        done, _ = wait(list(pending), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            name, keys, start = pending.pop(future)
+            try:
+                output = _miss(cache, keys, future.result())
+            except Exception as e:
+                yield _error_record(name, start, 'Animal analysis failed', str(e))
+            else:
+                yield _record(name, start, output)
+
+    try:
+        for batch in _chunks(items, batch_size):
+            to_segment = []
+            for name, image_data in batch:
+                start = time.perf_counter()
+                try:
+                    output, keys = _lookup_bytes(cache, image_data)
+                    if output is None:
+                        input_image = decode_image(image_data)
+                        output = _lookup_image(cache, input_image, keys)
+                except UploadRejected as e:
+                    yield _error_record(name, start, e.error, e.message)
+                    continue
+                except Exception as e:
+                    yield _error_record(name, start, 'Background removal failed', str(e))
+                    continue
+                if output is not None:
+                    yield _record(name, start, output)
+                else:
+                    to_segment.append((name, keys, input_image, start))
+
+            if not to_segment:
+                continue
+
+            try:
+                composites = remove_background_images([entry[2] for entry in to_segment])
+            except Exception as e:
+                for name, _, _, start in to_segment:
+                    yield _error_record(name, start, 'Background removal failed', str(e))
+                continue
+
+            for (name, keys, _, start), composite in zip(to_segment, composites):
+                image_bytes, mime_type, _ = encode_for_budget(composite)
+                known_animal = _local_label(composite)
+                while len(pending) >= parallelism:
+                    yield from finish(block=True)
+                future = openai_client.submit(analyze_animal_async(image_bytes, mime_type, known_animal))
+                pending[future] = (name, keys, start)
+
+            # Hand back whatever already finished before segmenting the next batch
+            yield from finish(block=False)
+
+        while pending:
+            yield from finish(block=True)
+    finally:
+        # The consumer went away (e.g. client disconnected); don't leave calls running
+        for future in pending:
+            future.cancel()
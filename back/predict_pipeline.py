@@ -1,9 +1,44 @@
-from background_remover import remove_background
-from animal_analyzer import analyze_animal
+#!/usr/bin/env python3
+"""
+Command-line prediction over files and directories.
 
-input_image_path = 'image/suit.png'
-output_image_path = 'image/suit_no.png'
+Segments images in batches, runs the vision calls with bounded parallelism
+and writes one NDJSON record per image as soon as it finishes.
 
-remove_background(input_image_path, output_image_path)
+    python predict_pipeline.py image/
+    python predict_pipeline.py image/ other.jpg --batch-size 16 --parallelism 8 -o results.ndjson
+"""
+import argparse
+import json
+import sys
+import time
+from pipeline import predict_batch, iter_image_files
 
-analyze_animal(output_image_path)
+def main():
+    parser = argparse.ArgumentParser(description='Spirit animal prediction for many images')
+    parser.add_argument('paths', nargs='+', help='image files or directories')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per U2NetP run (default 8)')
+    parser.add_argument('--parallelism', type=int, default=4, help='concurrent vision calls (default 4)')
+    parser.add_argument('-o', '--output', help='write NDJSON here instead of stdout')
+    args = parser.parse_args()
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    start = time.perf_counter()
+    count = failed = 0
+    try:
+        for record in predict_batch(iter_image_files(args.paths), args.batch_size, args.parallelism):
+            count += 1
+            failed += not record['success']
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{count} images ({failed} failed) in {elapsed:.1f}s, "
+          f"{count / elapsed if elapsed else 0:.2f} images/sec", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Image preprocessing for segmentation and the vision call.
+
+Nothing downstream benefits from full-resolution pixels: U2NetP runs at
+320x320 and gpt-4o rescales high-detail images to fit 2048x2048 with the
+short side at 768px, then bills them in 512px tiles. This module shrinks the
+image once, up front, and encodes it to fit a byte budget.
+
+Configuration (environment):
+  VISION_MAX_SIDE        cap on the long side sent to the vision model (default 1024, 0 = no cap)
+  VISION_DETAIL          auto, low or high (default auto); low is billed a flat 85
+                         tokens and looked at as 512x512, so images are capped at 512px
+  VISION_FORMAT          jpeg or webp (default jpeg)
+  VISION_MAX_BYTES       target encoded size in bytes (default 300000)
+  VISION_MIN_QUALITY     lowest quality tried to meet the budget (default 50)
+  SEGMENTATION_MAX_SIDE  long side fed to U2NetP (default 320)
+"""
+import io
+import math
+import os
+
+from PIL import Image, ImageOps
+
+# gpt-4o high-detail scaling rules
+VISION_FIT_SIDE = 2048
+VISION_SHORT_SIDE = 768
+VISION_TILE = 512
+# Low detail: one fixed-size look, billed at the base cost only
+VISION_LOW_DETAIL_SIDE = 512
+VISION_BASE_TOKENS = 85
+VISION_TILE_TOKENS = 170
+VISION_DETAILS = ('auto', 'low', 'high')
+
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+QUALITY_STEPS = (90, 85, 80, 75, 70, 65, 60, 55, 50, 45, 40)
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+def vision_detail():
+    detail = os.getenv('VISION_DETAIL', 'auto').lower()
+    return detail if detail in VISION_DETAILS else 'auto'
+
+
+def vision_target_size(size, max_side=None):
+    """
+    The size the vision model would actually look at, optionally capped further.
+    Never upscales.
+    """
+    if max_side is None:
+        max_side = _env_int('VISION_MAX_SIDE', 1024)
+        if vision_detail() == 'low':
+            max_side = min(max_side or VISION_LOW_DETAIL_SIDE, VISION_LOW_DETAIL_SIDE)
+    width, height = size
+    scale = min(1.0, VISION_FIT_SIDE / max(width, height))
+    short_side = min(width, height) * scale
+    if short_side > VISION_SHORT_SIDE:
+        scale *= VISION_SHORT_SIDE / short_side
+    if max_side:
+        scale = min(scale, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def vision_tiles(size):
+    """Number of 512px tiles gpt-4o bills for an image of this size"""
+    width, height = vision_target_size(size, max_side=0)
+    return math.ceil(width / VISION_TILE) * math.ceil(height / VISION_TILE)
+
+
+def vision_image_tokens(size, detail=None):
+    """Prompt tokens gpt-4o bills for an image of this size"""
+    if (detail or vision_detail()) == 'low':
+        return VISION_BASE_TOKENS
+    return VISION_BASE_TOKENS + VISION_TILE_TOKENS * vision_tiles(size)
+
+
+def normalize_image(image):
+    """Apply EXIF orientation and convert to RGB"""
+    return ImageOps.exif_transpose(image).convert('RGB')
+
+
+def downscale(image, max_side):
+    """Shrink so the long side is at most max_side; returns a new image or the input"""
+    if not max_side or max(image.size) <= max_side:
+        return image
+    scale = max_side / max(image.size)
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    # reducing_gap lets Pillow shrink big photos with a cheap box reduce first
+    return image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+
+def resize_for_vision(image, max_side=None):
+    target = vision_target_size(image.size, max_side)
+    if target == image.size:
+        return image
+    return image.resize(target, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+
+def resize_for_segmentation(image):
+    return downscale(image, _env_int('SEGMENTATION_MAX_SIDE', 320))
+
+
+def encode_for_budget(image, max_bytes=None, image_format=None, min_quality=None):
+    """
+    Encode at the highest quality step that fits max_bytes.
+    Returns (bytes, mime_type, quality). If nothing fits, the min-quality
+    encoding is returned anyway.
+    """
+    if max_bytes is None:
+        max_bytes = _env_int('VISION_MAX_BYTES', 300000)
+    if image_format is None:
+        image_format = os.getenv('VISION_FORMAT', 'jpeg').lower()
+    if min_quality is None:
+        min_quality = _env_int('VISION_MIN_QUALITY', 50)
+    pil_format, mime_type = FORMATS[image_format]
+
+    qualities = [q for q in QUALITY_STEPS if q >= min_quality] or [min_quality]
+
+    def encode(quality):
+        buffer = io.BytesIO()
+        image.save(buffer, pil_format, quality=quality)
+        return buffer.getvalue()
+
+    # Size shrinks as quality drops, so binary search for the first step that fits
+    best = None
+    low, high = 0, len(qualities) - 1
+    while low <= high:
+        middle = (low + high) // 2
+        data = encode(qualities[middle])
+        if len(data) <= max_bytes:
+            best = (data, mime_type, qualities[middle])
+            high = middle - 1
+        else:
+            low = middle + 1
+
+    if best is None:
+        best = (encode(qualities[-1]), mime_type, qualities[-1])
+    return best
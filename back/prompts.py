@@ -0,0 +1,369 @@
+"""
+Prompts and response formats for the vision and explanation calls.
+
+Everything that is the same on every call (the instructions, the response
+schema with the animal list, the model settings) is built once, from
+AVAILABLE_ANIMALS in sorted order, and sent first; the per-request part
+(the image, or the animal the local classifier picked) comes last. The
+static part is about 400 tokens, short of the 1024 OpenAI needs before it
+caches a prompt prefix, so these requests are not prompt-cached; the fixed
+order keeps them identical between processes (and PROMPT_VERSION stable).
+benchmarks/bench_prompt.py prints the sizes.
+
+With structured output on, the reply is JSON constrained by a strict JSON
+schema whose `animal` field is an enum of the dataset names, so the label is
+always valid and the list doesn't need repeating in the prompt text. Replies
+are rendered back into the markdown layout the frontend, the result cache
+and animal_analyzer.parse_response already understand:
+
+    **animal:** lion
+    **Explanation:** ...
+    **Connection:**
+    - ...
+
+Configuration (environment):
+  OPENAI_STRUCTURED_OUTPUT  JSON-schema replies (default true); false asks for
+                            markdown, for OpenAI-compatible servers without it
+  VISION_DETAIL             image detail sent with the picture: auto, low or high
+                            (default auto; see preprocess.vision_detail)
+"""
+import hashlib
+import json
+import os
+
+from animal_analyzer import AVAILABLE_ANIMALS
+from preprocess import vision_detail
+
+VISION_MODEL = 'gpt-4o'
+VISION_MAX_TOKENS = 300
+EXPLAIN_MAX_TOKENS = 250
+
+# Sorted so the schema, and with it PROMPT_VERSION, never changes between processes
+ANIMAL_NAMES = tuple(sorted(AVAILABLE_ANIMALS))
+
+_EXPLANATION = {'type': 'string'}
+_CONNECTION = {'type': 'array', 'items': {'type': 'string'}}
+
+
+def _json_schema(name, properties):
+    return {
+        'type': 'json_schema',
+        'json_schema': {
+            'name': name,
+            'strict': True,
+            'schema': {
+                'type': 'object',
+                'properties': properties,
+                'required': list(properties),
+                'additionalProperties': False,
+            },
+        },
+    }
+
+
+# Field order is the order the model writes them in: the label first, so a
+# streamed reply can be committed before the explanation has been generated
+VISION_RESPONSE_FORMAT = _json_schema('spirit_animal', {
+    'animal': {'type': 'string', 'enum': list(ANIMAL_NAMES)},
+    'explanation': _EXPLANATION,
+    'connection': _CONNECTION,
+})
+EXPLAIN_RESPONSE_FORMAT = _json_schema('spirit_animal_explanation', {
+    'explanation': _EXPLANATION,
+    'connection': _CONNECTION,
+})
+
+VISION_INSTRUCTIONS = """VIBE ANIMAL MATCH
+
+Look at the photo and pick the animal that best represents its energy and style. \
+The animal must be one of the values allowed by the response schema, written exactly as listed.
+Explain the vibe of the photo in one or two sentences, then connect its vibe and visual elements \
+to the animal in two to four short bullet points: why this animal *feels right* for this aesthetic."""
+
+EXPLAIN_INSTRUCTIONS = """VIBE ANIMAL MATCH
+
+Someone's photo was matched with the spirit animal named in the next message. \
+Explain the vibe this animal represents in one or two sentences, then, in two to four \
+short bullet points, why this animal *feels right* as a spirit animal for that vibe."""
+
+# Without structured output the list and the layout go in the prompt text instead
+_MARKDOWN_FORMAT = """
+
+Choose from these animals only, and write the name exactly as listed:
+{animals}
+
+Reply in this format:
+
+**animal:** [ANIMAL_NAME_FROM_THE_LIST_ABOVE]
+**Explanation:** [Explanation of the vibe]
+**Connection:** [Simplified bullet points]"""
+
+VISION_MARKDOWN_INSTRUCTIONS = VISION_INSTRUCTIONS + _MARKDOWN_FORMAT.format(animals=', '.join(ANIMAL_NAMES))
+EXPLAIN_MARKDOWN_INSTRUCTIONS = EXPLAIN_INSTRUCTIONS + """
+
+Reply in this format:
+
+**Explanation:** [Explanation of the vibe this animal represents]
+**Connection:** [Simplified bullet points]"""
+
+
+# Changes whenever the model settings, instructions or schemas do; part of the result cache keys
+PROMPT_VERSION = hashlib.sha256(json.dumps([
+    VISION_MODEL, VISION_MAX_TOKENS, VISION_INSTRUCTIONS, VISION_MARKDOWN_INSTRUCTIONS, VISION_RESPONSE_FORMAT,
+    EXPLAIN_MAX_TOKENS, EXPLAIN_INSTRUCTIONS, EXPLAIN_MARKDOWN_INSTRUCTIONS, EXPLAIN_RESPONSE_FORMAT,
+]).encode('utf-8')).hexdigest()[:12]
+
+
+def structured_output():
+    return os.getenv('OPENAI_STRUCTURED_OUTPUT', 'true').lower() == 'true'
+
+
+def vision_request(image_url, structured=None, detail=None):
+    """chat.completions.create arguments for the vision call on a data: URL"""
+    if structured is None:
+        structured = structured_output()
+    image = {'url': image_url}
+    detail = detail or vision_detail()
+    if detail != 'auto':
+        image['detail'] = detail
+    request = dict(
+        model=VISION_MODEL,
+        messages=[
+            {'role': 'system', 'content': VISION_INSTRUCTIONS if structured else VISION_MARKDOWN_INSTRUCTIONS},
+            {'role': 'user', 'content': [{'type': 'image_url', 'image_url': image}]},
+        ],
+        max_tokens=VISION_MAX_TOKENS,
+    )
+    if structured:
+        request['response_format'] = VISION_RESPONSE_FORMAT
+    return request
+
+
+def explain_request(animal, model, structured=None):
+    """chat.completions.create arguments for the text-only explanation of `animal`"""
+    if structured is None:
+        structured = structured_output()
+    request = dict(
+        model=model,
+        messages=[
+            {'role': 'system', 'content': EXPLAIN_INSTRUCTIONS if structured else EXPLAIN_MARKDOWN_INSTRUCTIONS},
+            {'role': 'user', 'content': f'Spirit animal: {animal}'},
+        ],
+        max_tokens=EXPLAIN_MAX_TOKENS,
+    )
+    if structured:
+        request['response_format'] = EXPLAIN_RESPONSE_FORMAT
+    return request
+
+
+def _bullet(item):
+    return item.strip().lstrip('-*• ').strip()
+
+
+def render_reply(fields):
+    """The markdown layout for a (possibly partial) structured reply"""
+    if 'animal' not in fields:
+        return ''
+    text = f"**animal:** {fields['animal']}\n"
+    if 'explanation' in fields:
+        text += f"**Explanation:** {fields['explanation']}"
+    if 'connection' in fields:
+        text += '\n**Connection:**' + ''.join(f'\n- {_bullet(item)}' for item in fields['connection'])
+    return text
+
+
+def parse_reply(content, animal=None):
+    """
+    Markdown for a complete structured reply, or None if it isn't the JSON
+    the schema asks for. `animal` fills in the label for explanation replies.
+    """
+    try:
+        fields = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(fields, dict):
+        return None
+    if animal is not None:
+        fields = {'animal': animal, **fields}
+    if not isinstance(fields.get('animal'), str):
+        return None
+    if not isinstance(fields.get('connection', []), list):
+        fields['connection'] = [str(fields['connection'])]
+    return render_reply({name: fields[name] for name in ('animal', 'explanation', 'connection') if name in fields})
+
+
+def _read_string(text, start, safe=None, value=''):
+    """
+    (value, end, complete, safe) for the JSON string whose opening quote is at
+    `start`. An unfinished string is cut before any incomplete escape; pass
+    back its `safe` and `value` to carry on from there once more text arrives.
+    """
+    index = safe = safe or start + 1
+    decoded = safe  # text[decoded:safe] is still to be added to value
+    while index < len(text):
+        char = text[index]
+        if char == '"':
+            return value + json.loads('"' + text[decoded:index] + '"'), index + 1, True, index + 1
+        if char == '\\':
+            if index + 1 >= len(text):
+                break
+            if text[index + 1] == 'u':
+                if index + 6 > len(text):
+                    break
+                # A high surrogate is only decodable together with its pair
+                if 0xD800 <= int(text[index + 2:index + 6], 16) <= 0xDBFF:
+                    if index + 12 > len(text):
+                        break
+                    index += 6
+                index += 6
+            else:
+                index += 2
+        else:
+            index += 1
+        safe = index
+    return value + json.loads('"' + text[decoded:safe] + '"'), len(text), False, safe
+
+
+def _skip(text, index, characters=' \t\r\n'):
+    while index < len(text) and text[index] in characters:
+        index += 1
+    return index
+
+
+class _PartialObject:
+    """
+    Reads a JSON object of strings and string arrays that is still arriving.
+    Each feed() carries on where the previous one stopped, so text is read
+    once however many pieces it comes in. `fields` holds the values so far
+    (the last one may be cut short), `complete` the names whose value is.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.fields = {}
+        self.complete = set()
+        self._index = 0
+        self._stage = 'open'
+        self._name = None  # member whose value is being read
+        self._string = None  # (opening quote, safe, value) of the string being read
+
+    def feed(self, delta):
+        self.text += delta
+        while self._step():
+            pass
+
+    def _step(self):
+        """Read on by one token; False once more text is needed, or when the text isn't such an object"""
+        text, index = self.text, self._index
+        if self._stage == 'open':
+            index = _skip(text, index)
+            if index >= len(text):
+                return False
+            if text[index] != '{':
+                self._stage = 'invalid'
+                return False
+            self._index, self._stage = index + 1, 'member'
+            return True
+
+        if self._stage == 'member':
+            index = _skip(text, index, ' \t\r\n,')
+            if index >= len(text):
+                return False
+            if text[index] != '"':
+                self._stage = 'end'
+                return False
+            name, index, done, _ = _read_string(text, index)
+            index = _skip(text, index, ' \t\r\n:')
+            if not done or index >= len(text):
+                return False  # The name is read again with the rest of it
+            if text[index] == '"':
+                self.fields[name] = ''
+                self._string, self._stage = (index, None, ''), 'string'
+            elif text[index] == '[':
+                self.fields[name] = []
+                self._stage = 'array'
+                index += 1
+            else:
+                self._stage = 'invalid'
+                return False
+            self._name, self._index = name, index
+            return True
+
+        if self._stage == 'array':
+            index = _skip(text, index, ' \t\r\n,')
+            if index >= len(text):
+                return False
+            if text[index] == ']':
+                self.complete.add(self._name)
+                self._index, self._stage = index + 1, 'member'
+            elif text[index] == '"':
+                self.fields[self._name].append('')
+                self._string, self._stage = (index, None, ''), 'item'
+            else:
+                self._stage = 'invalid'
+                return False
+            return True
+
+        if self._stage in ('string', 'item'):
+            quote, safe, value = self._string
+            value, end, done, safe = _read_string(text, quote, safe, value)
+            if self._stage == 'string':
+                self.fields[self._name] = value
+            else:
+                self.fields[self._name][-1] = value
+            if not done:
+                self._string = (quote, safe, value)
+                return False
+            self._index = end
+            if self._stage == 'string':
+                self.complete.add(self._name)
+                self._stage = 'member'
+            else:
+                self._stage = 'array'
+            return True
+        return False
+
+
+def partial_fields(text):
+    """
+    Fields of a JSON object of strings and string arrays that is still
+    arriving: ({name: value}, {names whose value is complete}). The last
+    value may be cut short.
+    """
+    reader = _PartialObject()
+    reader.feed(text)
+    return reader.fields, reader.complete
+
+
+class StreamingReply:
+    """
+    Follows a streamed structured reply and renders it to the markdown layout
+    as it arrives. feed() returns the markdown added by each delta; the
+    label is available from `animal` once its JSON string is closed.
+    """
+
+    def __init__(self):
+        self._reader = _PartialObject()
+        self.rendered = ''
+        self.animal = None
+
+    @property
+    def text(self):
+        return self._reader.text
+
+    def feed(self, delta):
+        self._reader.feed(delta)
+        fields = self._reader.fields
+        if 'animal' not in self._reader.complete:
+            return ''
+        self.animal = fields['animal']
+        rendered = render_reply(fields)
+        if not rendered.startswith(self.rendered):
+            return ''  # Fields out of schema order; the final text still renders in full
+        added = rendered[len(self.rendered):]
+        self.rendered = rendered
+        return added
+
+    def finish(self):
+        """The markdown for the whole reply (or what could be read of it)"""
+        return parse_reply(self.text) or self.rendered
@@ -0,0 +1,338 @@
+"""
+Content-addressed cache for analysis results.
+
+Two tiers are looked up in order:
+  exact       SHA-256 of the uploaded bytes (optional)
+  perceptual  64-bit DCT hash of the normalized image, so the same picture
+              re-encoded, resized or stripped of metadata still hits
+
+Different pictures can share a 64-bit hash, so a perceptual hit is only
+used if an 8x8 colour thumbnail stored with it is also within
+RESULT_CACHE_THUMBNAIL_DISTANCE of the new image's (mean absolute pixel
+difference, 0-1; re-encoded copies of the sample images differ by under
+0.003, different pictures by over 0.1).
+
+Keys in both tiers start with a version of everything that shapes the
+answer besides the image: the prompts and model settings (prompts.PROMPT_VERSION)
+and the settings in RESULT_SETTINGS. Changing any of them starts a fresh
+set of entries rather than serving results made the old way.
+
+Each tier is an in-memory LRU bounded by entry count and bytes with a TTL,
+optionally backed by a sqlite file so entries survive restarts.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from prompts import PROMPT_VERSION
+
+HASH_SIZE = 8
+HASH_INPUT_SIZE = 32
+THUMBNAIL_SIZE = 8
+
+# Settings that change the result for the same image (segmentation, crop, vision input, local classifier)
+RESULT_SETTINGS = (
+    'U2NETP_VARIANT', 'MASK_THRESHOLD', 'MASK_FEATHER', 'COMPOSITE_CROP', 'COMPOSITE_CROP_MARGIN',
+    'SMART_CROP', 'SMART_CROP_SIZE', 'SMART_CROP_MARGIN', 'SMART_CROP_REFINE', 'VISION_DETAIL', 'VISION_FORMAT',
+    'OPENAI_STRUCTURED_OUTPUT', 'LOCAL_CLASSIFIER_MODEL', 'LOCAL_CLASSIFIER_PROTOTYPES',
+    'LOCAL_CLASSIFIER_THRESHOLD', 'LOCAL_CLASSIFIER_TEMPERATURE', 'LOCAL_EXPLAIN_MODEL',
+)
+
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] *= 1 / np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+
+_DCT = _dct_matrix(HASH_INPUT_SIZE)
+
+
+def exact_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def config_version():
+    """Short digest of the prompts and RESULT_SETTINGS as currently configured"""
+    settings = [PROMPT_VERSION] + [f'{name}={os.getenv(name, "")}' for name in RESULT_SETTINGS]
+    return hashlib.sha256('\n'.join(settings).encode('utf-8')).hexdigest()[:12]
+
+
+def _phash(oriented):
+    normalized = oriented.convert('L').resize((HASH_INPUT_SIZE, HASH_INPUT_SIZE), Image.Resampling.LANCZOS)
+    pixels = np.asarray(normalized, dtype=np.float64)
+    low_freq = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    bits = (low_freq > np.median(low_freq)).flatten()
+    return '%016x' % int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def _thumbnail(oriented):
+    thumbnail = oriented.convert('RGB').resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BOX)
+    return np.asarray(thumbnail, dtype=np.uint8).tobytes().hex()
+
+
+def perceptual_hash(image):
+    """
+    pHash of a PIL image: EXIF-orient, grayscale, shrink to 32x32, keep the
+    low-frequency 8x8 DCT block and threshold it against its median.
+    """
+    return _phash(ImageOps.exif_transpose(image))
+
+
+def thumbnail_distance(first, second):
+    """Mean absolute difference (0-1) between two thumbnails from keys_for()"""
+    first = np.frombuffer(bytes.fromhex(first), dtype=np.uint8).astype(np.int16)
+    second = np.frombuffer(bytes.fromhex(second), dtype=np.uint8).astype(np.int16)
+    if first.shape != second.shape:
+        return 1.0
+    return float(np.abs(first - second).mean()) / 255
+
+
+class SqliteBacking:
+    """On-disk store for one cache tier"""
+
+    def __init__(self, path, table):
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                'created REAL NOT NULL, accessed REAL NOT NULL)'
+            )
+
+    def get(self, key, ttl):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                f'SELECT value, created FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if ttl and now - row[1] > ttl:
+                self._conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                return None
+            self._conn.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (now, key))
+            return row[0], row[1]
+
+    def set(self, key, value, size, created, max_entries, max_bytes):
+        with self._lock, self._conn:
+            self._conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, size, created, accessed) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, value, size, created, created),
+            )
+            # Drop least recently accessed rows until both bounds hold again
+            while True:
+                count, total = self._conn.execute(
+                    f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}'
+                ).fetchone()
+                if count <= max_entries and total <= max_bytes:
+                    break
+                self._conn.execute(
+                    f'DELETE FROM {self.table} WHERE key IN '
+                    f'(SELECT key FROM {self.table} ORDER BY accessed ASC LIMIT ?)',
+                    (max(1, count // 10),),
+                )
+
+
+class CacheTier:
+    """Thread-safe LRU with TTL, bounded by entry count and total bytes"""
+
+    def __init__(self, name, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl=24 * 3600, backing=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backing = backing
+
+        self._entries = OrderedDict()  # key -> (value, size, created)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    @staticmethod
+    def _size(key, value):
+        return len(key) + len(value.encode('utf-8'))
+
+    def _evict(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _insert(self, key, value, created):
+        size = self._size(key, value)
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (value, size, created)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._evict(next(iter(self._entries)))
+            self._stats['evictions'] += 1
+        return size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self.ttl and time.time() - entry[2] > self.ttl:
+                    self._evict(key)
+                    self._stats['expirations'] += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[0]
+
+        if self.backing is not None:
+            row = self.backing.get(key, self.ttl)
+            if row is not None:
+                with self._lock:
+                    self._insert(key, row[0], row[1])
+                    self._stats['hits'] += 1
+                    self._stats['disk_hits'] += 1
+                return row[0]
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def set(self, key, value):
+        created = time.time()
+        with self._lock:
+            size = self._insert(key, value, created)
+        if self.backing is not None:
+            self.backing.set(key, value, size, created, self.max_entries, self.max_bytes)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+class ResultCache:
+    """
+    Exact + perceptual result cache. Keys computed with keys_for() are used
+    for both lookup() and store().
+    """
+
+    def __init__(self, exact=True, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl=24 * 3600, path=None,
+                 version='', max_thumbnail_distance=0.03):
+        def backing(table):
+            return SqliteBacking(path, table) if path else None
+
+        self.exact = CacheTier('exact', max_entries, max_bytes, ttl, backing('exact_results')) if exact else None
+        self.perceptual = CacheTier('perceptual', max_entries, max_bytes, ttl, backing('perceptual_results'))
+        self.version = version
+        self.max_thumbnail_distance = max_thumbnail_distance
+        self._unconfirmed = 0
+        self._lock = threading.Lock()
+
+    def keys_for(self, image_bytes=None, image=None):
+        """Compute the keys for whichever inputs are given"""
+        keys = {}
+        if self.exact is not None and image_bytes is not None:
+            keys['exact'] = f'{self.version}:{exact_hash(image_bytes)}'
+        if image is not None:
+            oriented = ImageOps.exif_transpose(image)
+            keys['perceptual'] = f'{self.version}:{_phash(oriented)}'
+            keys['thumbnail'] = _thumbnail(oriented)
+        return keys
+
+    def _confirmed(self, entry, thumbnail):
+        """The result of a perceptual entry if its thumbnail matches, otherwise None"""
+        try:
+            entry = json.loads(entry)
+            stored, result = entry['thumbnail'], entry['result']
+        except (ValueError, TypeError, KeyError):
+            return None
+        if thumbnail is None or thumbnail_distance(stored, thumbnail) > self.max_thumbnail_distance:
+            with self._lock:
+                self._unconfirmed += 1
+            return None
+        return result
+
+    def lookup(self, keys):
+        """Return (result, tier_name) or (None, None)"""
+        for tier in (self.exact, self.perceptual):
+            key = keys.get(tier.name) if tier is not None else None
+            if key is None:
+                continue
+            result = tier.get(key)
+            if result is not None and tier is self.perceptual:
+                result = self._confirmed(result, keys.get('thumbnail'))
+            if result is not None:
+                return result, tier.name
+        return None, None
+
+    def store(self, keys, result):
+        if self.exact is not None and keys.get('exact') is not None:
+            self.exact.set(keys['exact'], result)
+        if keys.get('perceptual') is not None and keys.get('thumbnail') is not None:
+            self.perceptual.set(keys['perceptual'], json.dumps({'result': result, 'thumbnail': keys['thumbnail']}))
+
+    def stats(self):
+        stats = {
+            tier.name: tier.stats()
+            for tier in (self.exact, self.perceptual)
+            if tier is not None
+        }
+        # Counted as hits by the tier, then turned away by the thumbnail check
+        with self._lock:
+            stats['perceptual']['unconfirmed'] = self._unconfirmed
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # sqlite connections must not be shared across fork()
+    global _cache, _cache_lock
+    _cache = None
+    _cache_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_result_cache():
+    """
+    Return the process-wide result cache, or None when RESULT_CACHE_ENABLED=false.
+      RESULT_CACHE_EXACT         keep the SHA-256 tier (default true)
+      RESULT_CACHE_MAX_ENTRIES   entries per tier (default 1024)
+      RESULT_CACHE_MAX_BYTES     bytes per tier (default 32MB)
+      RESULT_CACHE_TTL           seconds (default 86400)
+      RESULT_CACHE_PATH          sqlite file for persistence (default: memory only)
+      RESULT_CACHE_THUMBNAIL_DISTANCE  largest thumbnail difference for a perceptual hit (default 0.03)
+    """
+    global _cache
+    if os.getenv('RESULT_CACHE_ENABLED', 'true').lower() != 'true':
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache(
+                    exact=os.getenv('RESULT_CACHE_EXACT', 'true').lower() == 'true',
+                    max_entries=int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1024')),
+                    max_bytes=int(os.getenv('RESULT_CACHE_MAX_BYTES', str(32 * 1024 * 1024))),
+                    ttl=float(os.getenv('RESULT_CACHE_TTL', str(24 * 3600))),
+                    path=os.getenv('RESULT_CACHE_PATH') or None,
+                    version=config_version(),
+                    max_thumbnail_distance=float(os.getenv('RESULT_CACHE_THUMBNAIL_DISTANCE', '0.03')),
+                )
+    return _cache
@@ -0,0 +1,448 @@
+"""
+Segmentation worker processes: U2NetP inference outside the web process.
+
+With SEGMENTATION_WORKERS set, the forward pass no longer runs in the
+request threads. Each worker is a separate Python process holding one warm
+U2NetP session, pinned to its own slice of the CPUs with onnxruntime sized
+to match, so inference can use every core while the web process's threads
+only decode, composite, encode and wait on the network, and the two tiers
+are sized independently. Workers are started with exec rather than fork:
+the web process has threads running, and nothing of it is needed there.
+
+Pixels don't go through the pipe. Each worker has a shared memory buffer
+(multiprocessing.shared_memory), owned by the web process: the 320px
+thumbnails are copied in, the worker runs them as one batch and writes the
+float32 predictions back into the same buffer, and only offsets, shapes
+and timings are pickled. The buffer grows when a batch doesn't fit.
+
+Request threads check workers out the way they check sessions out of the
+in-process pool (see session_pool.py), so both can be used the same way;
+get_segmenter() returns whichever is configured. A worker that dies, or
+takes longer than SEGMENTATION_TIMEOUT over a batch, is killed and
+restarted, and the batch is retried once on the new process.
+
+Configuration (environment):
+  SEGMENTATION_WORKERS   worker processes per web process (default 0: segment in-process)
+  SEGMENTATION_PIN_CPUS  pin each worker to its own CPUs (default true; Linux only; with
+                         several web processes, turn it off or their workers share CPUs)
+  SEGMENTATION_TIMEOUT   seconds a batch may take before its worker is restarted (default 30)
+Workers load the model variant selected by U2NETP_VARIANT.
+"""
+import argparse
+import atexit
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Connection
+
+import numpy as np
+from PIL import Image
+
+from metrics import STAGE_SECONDS
+from session_pool import INPUT_SIZE, get_session_pool
+
+# Model load, including a first-time download
+START_TIMEOUT = 300
+STOP_TIMEOUT = 5
+# Shared buffers grow in steps of this many bytes
+BUFFER_STEP = 1 << 20
+ALIGNMENT = 64
+
+
+class WorkerCrashed(RuntimeError):
+    """A segmentation worker died or hung twice on the same batch"""
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _attach(name):
+    """Open the web process's buffer `name` without taking ownership of it"""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    buffer = shared_memory.SharedMemory(name=name)
+    # Attaching registers the segment with this process's resource tracker,
+    # which would unlink it from under the web process when the worker exits
+    resource_tracker.unregister(buffer._name, 'shared_memory')
+    return buffer
+
+
+class SegmentationWorker:
+    """The web process's handle on one worker process and its shared buffer"""
+
+    def __init__(self, index, cpus, intra_op_threads):
+        self.index = index
+        self.cpus = cpus
+        self.intra_op_threads = intra_op_threads
+        self.process = None
+        self._conn = None
+        self._buffer = None
+        self._stats = {
+            'jobs': 0,
+            'images': 0,
+            'busy_seconds_total': 0.0,
+            'inference_seconds_total': 0.0,
+            'restarts': 0,
+            'failures': 0,
+        }
+
+    def launch(self):
+        """Start the process; ready() waits for it to load the model"""
+        ours, theirs = socket.socketpair()
+        command = [sys.executable, os.path.abspath(__file__), '--fd', str(theirs.fileno())]
+        if self.cpus:
+            command += ['--cpus', ','.join(map(str, self.cpus))]
+        threads = str(self.intra_op_threads)
+        env = dict(os.environ, SEGMENTATION_WORKERS='0', SESSION_POOL_SIZE='1',
+                   ORT_INTRA_OP_THREADS=threads, ORT_INTER_OP_THREADS='1', OMP_NUM_THREADS=threads)
+        try:
+            self.process = subprocess.Popen(command, pass_fds=(theirs.fileno(),), env=env)
+        finally:
+            theirs.close()
+        self._conn = Connection(ours.detach())
+
+    def ready(self):
+        try:
+            if not self._conn.poll(START_TIMEOUT):
+                raise WorkerCrashed(f"Segmentation worker {self.index} didn't start within {START_TIMEOUT}s")
+            reply = self._conn.recv()
+        except (EOFError, OSError):
+            reply = ('error', f'exited with status {self.process.wait()}')
+        if reply[0] != 'ready':
+            self.stop()
+            raise WorkerCrashed(f"Segmentation worker {self.index} failed to start: {reply[1]}")
+
+    def start(self):
+        self.launch()
+        self.ready()
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self._conn.send(('stop',))
+            self.process.wait(STOP_TIMEOUT)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self._conn.close()
+        self.process = self._conn = None
+
+    def restart(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self._conn.close()
+            self.process = self._conn = None
+        self._stats['restarts'] += 1
+        self.start()
+
+    def close(self):
+        self.stop()
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer.unlink()
+            self._buffer = None
+
+    def _reserve(self, size):
+        """The shared buffer, replaced by a bigger one if it is under `size` bytes"""
+        if self._buffer is None or self._buffer.size < size:
+            if self._buffer is not None:
+                self._buffer.close()
+                self._buffer.unlink()
+            self._buffer = shared_memory.SharedMemory(create=True, size=_align(size) + BUFFER_STEP)
+        return self._buffer
+
+    def _run(self, arrays, timeout):
+        layout = []
+        offset = 0
+        for array in arrays:
+            layout.append((offset, array.shape))
+            offset = _align(offset + array.nbytes)
+        output_shape = (len(arrays),) + INPUT_SIZE[::-1]
+        buffer = self._reserve(offset + int(np.prod(output_shape)) * 4)
+        for (start, shape), array in zip(layout, arrays):
+            np.ndarray(shape, np.uint8, buffer=buffer.buf, offset=start)[...] = array
+
+        if self.process is None:
+            self.start()
+        elif self.process.poll() is not None:
+            print(f"Warning: Segmentation worker {self.index} exited with status {self.process.returncode}; "
+                  f"restarting it")
+            self.restart()
+        try:
+            self._conn.send(('segment', buffer.name, layout, offset))
+            if not self._conn.poll(timeout):
+                raise WorkerCrashed(f"Segmentation worker {self.index} took over {timeout}s")
+            reply = self._conn.recv()
+        except (EOFError, OSError) as e:
+            raise WorkerCrashed(f"Segmentation worker {self.index} exited: {e}")
+        if reply[0] == 'error':
+            raise RuntimeError(reply[1])
+        _, shape, inference_seconds = reply
+        output = np.ndarray((len(arrays),) + tuple(shape), np.float32, buffer=buffer.buf, offset=offset)
+        # Copied out: the buffer is reused by the next batch
+        return list(output.copy()), inference_seconds
+
+    def predict_mask_arrays(self, images, timeout):
+        """
+        U2NetP predictions for a batch of PIL thumbnails, computed in the
+        worker. Restarts the worker and retries once if it dies or hangs.
+        """
+        arrays = [np.asarray(image.convert('RGB')) for image in images]
+        start = time.perf_counter()
+        try:
+            try:
+                predictions, inference_seconds = self._run(arrays, timeout)
+            except WorkerCrashed as e:
+                print(f"Warning: {e}; restarting it")
+                self.restart()
+                predictions, inference_seconds = self._run(arrays, timeout)
+        except Exception:
+            self._stats['failures'] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        self._stats['jobs'] += 1
+        self._stats['images'] += len(arrays)
+        self._stats['busy_seconds_total'] += elapsed
+        self._stats['inference_seconds_total'] += inference_seconds
+        return predictions, inference_seconds, elapsed
+
+    def metrics(self):
+        stats = dict(self._stats)
+        stats.update({
+            'index': self.index,
+            'pid': self.process.pid if self.process is not None else None,
+            'alive': self.process is not None and self.process.poll() is None,
+            'cpus': self.cpus,
+            'intra_op_threads': self.intra_op_threads,
+        })
+        return stats
+
+
+def _cpu_slices(workers, pin):
+    """Per worker: (the CPUs to pin it to or None, its onnxruntime thread count)"""
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus, pin = list(range(os.cpu_count() or 1)), False
+    share = max(1, len(cpus) // workers)
+    slices = []
+    for index in range(workers):
+        first = index * share % len(cpus)
+        slices.append((cpus[first:first + share] if pin else None, share))
+    return slices
+
+
+class SegmentationService:
+    """
+    A pool of segmentation worker processes with the session pool's
+    interface: predict_mask_arrays, warm_up, backlog_seconds, metrics.
+    """
+
+    def __init__(self, workers=2, pin_cpus=True, timeout=30.0):
+        self.size = max(1, int(workers))
+        self.timeout = float(timeout)
+        self.workers = [SegmentationWorker(index, cpus, threads)
+                        for index, (cpus, threads) in enumerate(_cpu_slices(self.size, pin_cpus))]
+        # LIFO like the session pool: the most recently used worker has warm caches
+        self._idle = queue.LifoQueue()
+        for worker in reversed(self.workers):
+            self._idle.put(worker)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._recent_inference = None
+        self._warm = False
+
+    def warm_up(self):
+        """Start every worker and wait until each has a warm session"""
+        workers = []
+        try:
+            while True:
+                workers.append(self._idle.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            pending = [worker for worker in workers if worker.process is None]
+            if pending:
+                # One first, so the others don't all download a missing model at once
+                pending[0].start()
+                for worker in pending[1:]:
+                    worker.launch()
+                for worker in pending[1:]:
+                    worker.ready()
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+        self._warm = True
+        return self
+
+    def checkout(self, timeout=None):
+        start = time.perf_counter()
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self._waiting += 1
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No segmentation worker available after {timeout}s")
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage='session_wait')
+        return worker
+
+    def checkin(self, worker):
+        self._idle.put(worker)
+
+    def predict_mask_arrays(self, images, timeout=None):
+        """
+        Batched forward pass in a worker process; same result as
+        SessionPool.predict_mask_arrays.
+        """
+        worker = self.checkout(timeout=timeout)
+        try:
+            predictions, inference_seconds, elapsed = worker.predict_mask_arrays(images, self.timeout)
+        finally:
+            self.checkin(worker)
+        STAGE_SECONDS.observe(inference_seconds, stage='segment_inference')
+        STAGE_SECONDS.observe(elapsed - inference_seconds, stage='segment_handoff')
+        with self._lock:
+            if self._recent_inference is None:
+                self._recent_inference = elapsed
+            else:
+                self._recent_inference += 0.2 * (elapsed - self._recent_inference)
+        return predictions
+
+    def backlog_seconds(self):
+        """Roughly how long a checkout now would wait for a worker"""
+        with self._lock:
+            if self._recent_inference is None:
+                return 0.0
+            waiting = self._waiting
+        if waiting == 0 and self._idle.qsize():
+            return 0.0
+        return (waiting // self.size + 1) * self._recent_inference
+
+    def metrics(self):
+        return {
+            'size': self.size,
+            'idle': self._idle.qsize(),
+            'waiting': self._waiting,
+            'warm': self._warm,
+            'workers': [worker.metrics() for worker in self.workers],
+        }
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+def _serve(conn):
+    """Worker process: answer segment requests from the web process until told to stop"""
+    pool = get_session_pool()
+    try:
+        pool.warm_up()
+    except Exception as e:
+        conn.send(('error', str(e)))
+        return
+    conn.send(('ready', pool.variant))
+
+    buffer = None
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message[0] == 'stop':
+            break
+        _, name, layout, output_offset = message
+        if buffer is None or buffer.name != name:
+            if buffer is not None:
+                buffer.close()
+            buffer = _attach(name)
+        try:
+            images = [Image.fromarray(np.ndarray(shape, np.uint8, buffer=buffer.buf, offset=offset))
+                      for offset, shape in layout]
+            start = time.perf_counter()
+            predictions = pool.predict_mask_arrays(images)
+            elapsed = time.perf_counter() - start
+            del images
+            output = np.ndarray((len(predictions),) + predictions[0].shape, np.float32,
+                                buffer=buffer.buf, offset=output_offset)
+            output[...] = predictions
+            del output
+        except Exception as e:
+            conn.send(('error', f'{type(e).__name__}: {e}'))
+        else:
+            conn.send(('ok', predictions[0].shape, elapsed))
+    if buffer is not None:
+        buffer.close()
+
+
+def _worker_main():
+    parser = argparse.ArgumentParser(description='Segmentation worker (started by SegmentationService)')
+    parser.add_argument('--fd', type=int, required=True)
+    parser.add_argument('--cpus')
+    args = parser.parse_args()
+    if args.cpus:
+        os.sched_setaffinity(0, [int(cpu) for cpu in args.cpus.split(',')])
+    conn = Connection(args.fd)
+    try:
+        _serve(conn)
+    finally:
+        conn.close()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # The worker processes and their pipes belong to the parent
+    global _service, _service_lock
+    _service = None
+    _service_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _close_service():
+    if _service is not None:
+        _service.close()
+
+
+atexit.register(_close_service)
+
+
+def get_segmenter():
+    """
+    What runs U2NetP for this process: the SegmentationService when
+    SEGMENTATION_WORKERS > 0, otherwise the in-process session pool.
+    """
+    global _service
+    workers = int(os.getenv('SEGMENTATION_WORKERS', '0'))
+    if workers <= 0:
+        return get_session_pool()
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = SegmentationService(
+                    workers=workers,
+                    pin_cpus=os.getenv('SEGMENTATION_PIN_CPUS', 'true').lower() == 'true',
+                    timeout=float(os.getenv('SEGMENTATION_TIMEOUT', '30')),
+                )
+    return _service
+
+
+if __name__ == '__main__':
+    _worker_main()
@@ -0,0 +1,397 @@
+"""
+Process-wide pool of warm U2NetP sessions for background removal.
+
+Loading the ONNX model costs more than running it, so sessions are created
+once and shared by every request. Each Flask worker thread checks a session
+out, runs inference and checks it back in; with several sessions in the pool
+concurrent requests don't queue behind a single one.
+
+onnxruntime and rembg are imported when the first session is built, not at
+import time, so importing this module stays cheap.
+
+U2NETP_VARIANT picks the graph the sessions run: 'fp32' (default) is the
+stock model rembg downloads; 'optimized' and 'int8' are artifacts written
+into model/ by `python model_prep.py`, with all of onnxruntime's graph
+optimizations already applied (and, for int8, quantized weights and
+activations), so they are loaded with optimization off. A prepared variant
+is only used if the manifest next to it says it passed the mask IoU check
+and was written by the installed onnxruntime version on this CPU model;
+otherwise the pool warns and falls back to fp32.
+"""
+import json
+import os
+import platform
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+from metrics import STAGE_SECONDS
+
+# Set U2NET_HOME to the model directory relative to this file
+current_dir = os.path.dirname(os.path.abspath(__file__))
+model_dir = os.path.join(current_dir, 'model')
+os.environ['U2NET_HOME'] = model_dir
+
+MODEL_NAME = 'u2netp'
+
+# Artifacts written by model_prep.py; fp32 is rembg's own download
+MODEL_VARIANTS = {
+    'fp32': None,
+    'optimized': 'u2netp.opt.onnx',
+    'int8': 'u2netp.int8.onnx',
+}
+MANIFEST_NAME = 'u2netp.prep.json'
+
+# U2NetP input normalization, as used by rembg's U2netpSession
+INPUT_MEAN = (0.485, 0.456, 0.406)
+INPUT_STD = (0.229, 0.224, 0.225)
+INPUT_SIZE = (320, 320)
+
+
+class SessionPool:
+    """
+    A bounded pool of rembg sessions with checkout/checkin semantics.
+    Sessions are created lazily up to `size`, or all at once by warm_up().
+    """
+
+    def __init__(self, size=2, intra_op_threads=0, inter_op_threads=0, model_name=MODEL_NAME, variant='fp32'):
+        self.size = max(1, int(size))
+        self.intra_op_threads = int(intra_op_threads)
+        self.inter_op_threads = int(inter_op_threads)
+        self.model_name = model_name
+        self.requested_variant = variant
+        self.variant = None  # resolved when the first session is loaded
+
+        # LIFO so the most recently used (cache-hot) session is handed out first
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._warm = False
+        self._waiting = 0  # threads blocked in checkout()
+        self._recent_inference = None  # seconds, moving average
+        # Flipped off the first time the model rejects a batch dimension > 1
+        self._batching = True
+
+        self._stats = {
+            'sessions_loaded': 0,
+            'load_seconds_total': 0.0,
+            'checkouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'inferences': 0,
+            'inference_seconds_total': 0.0,
+        }
+
+    def _resolve_variant(self):
+        with self._lock:
+            if self.variant is None:
+                self.variant = resolve_variant(self.requested_variant)
+            return self.variant
+
+    def _load_session(self):
+        import rembg
+        variant = self._resolve_variant()
+        start = time.perf_counter()
+        sess_opts = session_options(variant, self.intra_op_threads, self.inter_op_threads)
+        if variant == 'fp32':
+            session = rembg.new_session(model_name=self.model_name, sess_opts=sess_opts)
+        else:
+            session = rembg.new_session('u2net_custom', model_path=variant_path(variant), sess_opts=sess_opts)
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage='session_load')
+        with self._lock:
+            self._stats['sessions_loaded'] += 1
+            self._stats['load_seconds_total'] += elapsed
+        return session
+
+    def _reserve_slot(self):
+        """Claim the right to create a new session, if the pool isn't full yet"""
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return True
+            return False
+
+    def _release_slot(self):
+        with self._lock:
+            self._created -= 1
+
+    def _create_idle_session(self):
+        try:
+            return self._load_session()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def warm_up(self):
+        """
+        Load every session in the pool and run a dummy inference through each,
+        so the first real request doesn't pay for model load or graph init.
+        """
+        while self._reserve_slot():
+            self._idle.put(self._create_idle_session())
+
+        sessions = []
+        try:
+            while True:
+                sessions.append(self._idle.get_nowait())
+        except queue.Empty:
+            pass
+
+        import rembg
+        dummy = Image.new('RGB', (64, 64), (255, 255, 255))
+        try:
+            for session in sessions:
+                rembg.remove(dummy, session=session)
+        finally:
+            for session in sessions:
+                self._idle.put(session)
+
+        self._warm = True
+        return self
+
+    def checkout(self, timeout=None):
+        """
+        Take a session out of the pool. Creates one if the pool still has room,
+        otherwise blocks until another thread checks one back in.
+        """
+        start = time.perf_counter()
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            if self._reserve_slot():
+                session = self._create_idle_session()
+            else:
+                with self._lock:
+                    self._waiting += 1
+                try:
+                    session = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No {self.model_name} session available after {timeout}s")
+                finally:
+                    with self._lock:
+                        self._waiting -= 1
+        waited = time.perf_counter() - start
+        STAGE_SECONDS.observe(waited, stage='session_wait')
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+        return session
+
+    def checkin(self, session):
+        """Return a session previously obtained from checkout()"""
+        self._idle.put(session)
+
+    @contextmanager
+    def session(self, timeout=None):
+        session = self.checkout(timeout=timeout)
+        try:
+            yield session
+        finally:
+            self.checkin(session)
+
+    def _record_inference(self, elapsed):
+        STAGE_SECONDS.observe(elapsed, stage='segment_inference')
+        with self._lock:
+            self._stats['inferences'] += 1
+            self._stats['inference_seconds_total'] += elapsed
+            if self._recent_inference is None:
+                self._recent_inference = elapsed
+            else:
+                self._recent_inference += 0.2 * (elapsed - self._recent_inference)
+
+    def backlog_seconds(self):
+        """Roughly how long a checkout now would wait for a session"""
+        with self._lock:
+            if self._recent_inference is None or self._created < self.size:
+                return 0.0
+            waiting = self._waiting
+        if waiting == 0 and self._idle.qsize():
+            return 0.0
+        # Every session busy: the waiters ahead go through the pool `size` at a time
+        return (waiting // self.size + 1) * self._recent_inference
+
+    def remove(self, image, timeout=None, **kwargs):
+        """Run rembg.remove on a pooled session"""
+        import rembg
+        with self.session(timeout=timeout) as session:
+            start = time.perf_counter()
+            output = rembg.remove(image, session=session, **kwargs)
+            self._record_inference(time.perf_counter() - start)
+        return output
+
+    def predict_mask(self, image, timeout=None):
+        """
+        Run only the U2NetP forward pass on a pooled session.
+        Returns the L-mode mask at the input image's size.
+        """
+        with self.session(timeout=timeout) as session:
+            start = time.perf_counter()
+            mask = session.predict(image)[0]
+            self._record_inference(time.perf_counter() - start)
+        return mask
+
+    def predict_mask_arrays(self, images, timeout=None):
+        """
+        Batched forward pass: all images go through U2NetP in one run.
+        Returns one float32 array per image at the model's 320x320 output,
+        min-max scaled to 0..1, without converting to PIL or resizing.
+        Falls back to one run per image if the model has a fixed batch size.
+        """
+        with self.session(timeout=timeout) as session:
+            start = time.perf_counter()
+            feeds = [session.normalize(image, INPUT_MEAN, INPUT_STD, INPUT_SIZE) for image in images]
+            input_name = next(iter(feeds[0]))
+
+            predictions = None
+            if self._batching and len(feeds) > 1:
+                batch = np.concatenate([feed[input_name] for feed in feeds])
+                try:
+                    predictions = session.inner_session.run(None, {input_name: batch})[0]
+                except Exception:
+                    self._batching = False
+            if predictions is None:
+                predictions = np.concatenate([session.inner_session.run(None, feed)[0] for feed in feeds])
+            self._record_inference(time.perf_counter() - start)
+
+        arrays = []
+        for prediction in predictions[:, 0, :, :]:
+            low, high = prediction.min(), prediction.max()
+            prediction = prediction - low
+            prediction *= 1.0 / max(high - low, 1e-8)
+            arrays.append(prediction.astype(np.float32, copy=False))
+        return arrays
+
+    def predict_masks(self, images, timeout=None):
+        """
+        Like predict_mask_arrays, but returns one L-mode mask per image,
+        each at that image's size.
+        """
+        masks = []
+        for image, prediction in zip(images, self.predict_mask_arrays(images, timeout=timeout)):
+            mask = Image.fromarray((prediction * 255).astype('uint8'), mode='L')
+            masks.append(mask.resize(image.size, Image.Resampling.LANCZOS))
+        return masks
+
+    def metrics(self):
+        """Snapshot of pool counters; safe to call from any thread"""
+        with self._lock:
+            stats = dict(self._stats)
+            created = self._created
+        stats.update({
+            'model': self.model_name,
+            'variant': self.variant or self.requested_variant,
+            'size': self.size,
+            'created': created,
+            'idle': self._idle.qsize(),
+            'waiting': self._waiting,
+            'warm': self._warm,
+            'intra_op_threads': self.intra_op_threads,
+            'inter_op_threads': self.inter_op_threads,
+            'batching': self._batching,
+        })
+        return stats
+
+
+def session_options(variant, intra_op_threads=0, inter_op_threads=0):
+    """onnxruntime options for a session running `variant`"""
+    import onnxruntime as ort
+    sess_opts = ort.SessionOptions()
+    sess_opts.intra_op_num_threads = intra_op_threads
+    sess_opts.inter_op_num_threads = inter_op_threads
+    if variant != 'fp32':
+        # Prepared graphs were optimized in full by model_prep.py; redoing it is most of their load time
+        sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+    return sess_opts
+
+
+def host_cpu():
+    """The CPU model; fully optimized graphs use a memory layout specific to it"""
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def variant_path(variant):
+    return os.path.join(model_dir, MODEL_VARIANTS[variant])
+
+
+def load_manifest():
+    """model_prep.py's record of the prepared variants, or None"""
+    try:
+        with open(os.path.join(model_dir, MANIFEST_NAME)) as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return None
+
+
+def resolve_variant(variant):
+    """`variant` if its prepared artifact is usable, otherwise 'fp32' (with a warning)"""
+    if variant == 'fp32':
+        return variant
+    if variant not in MODEL_VARIANTS:
+        print(f"Warning: Unknown U2NETP_VARIANT '{variant}', using fp32")
+        return 'fp32'
+
+    import onnxruntime as ort
+    entry = ((load_manifest() or {}).get('variants') or {}).get(variant)
+    if entry is None or not os.path.exists(variant_path(variant)):
+        problem = "hasn't been prepared (run `python model_prep.py`)"
+    elif entry.get('onnxruntime') != ort.__version__:
+        # Optimized graphs are only guaranteed to load in the version that wrote them
+        problem = f"was prepared with onnxruntime {entry.get('onnxruntime')}, not {ort.__version__}"
+    elif entry.get('cpu') != host_cpu():
+        # Their layout transformations only run on the CPU they were made for
+        problem = f"was prepared on a different CPU ({entry.get('cpu')})"
+    elif not entry.get('passed'):
+        problem = f"failed the mask IoU check (mean {entry.get('iou_mean')})"
+    else:
+        return variant
+    print(f"Warning: U2NetP variant '{variant}' {problem}; using fp32")
+    return 'fp32'
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # onnxruntime thread pools don't survive fork(); children build their own sessions
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_session_pool():
+    """
+    Return the process-wide session pool, creating it from the environment on
+    first use:
+      SESSION_POOL_SIZE      number of sessions (default 2)
+      ORT_INTRA_OP_THREADS   onnxruntime intra-op threads per session (0 = ORT default)
+      ORT_INTER_OP_THREADS   onnxruntime inter-op threads per session (0 = ORT default)
+      U2NETP_VARIANT         fp32, optimized or int8 (default fp32)
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = SessionPool(
+                    size=int(os.getenv('SESSION_POOL_SIZE', '2')),
+                    intra_op_threads=int(os.getenv('ORT_INTRA_OP_THREADS', '0')),
+                    inter_op_threads=int(os.getenv('ORT_INTER_OP_THREADS', '0')),
+                    variant=os.getenv('U2NETP_VARIANT', 'fp32').lower(),
+                )
+    return _pool
@@ -0,0 +1,278 @@
+"""
+Single-flight coalescing of identical concurrent predictions.
+
+When the same image is uploaded many times at once, only the first upload
+(the leader) runs the pipeline; the duplicates wait for its output instead
+of running segmentation and the vision call again before the result cache
+has anything to offer. Duplicates are recognised by the SHA-256 of the
+uploaded bytes.
+
+Within a process, duplicates wait on the leader's future. Across gunicorn
+workers, the leader holds an flock on <key>.lock in SINGLEFLIGHT_DIR and
+writes its output to <key>.json before letting go; duplicates in other
+workers poll for the lock and then read the result. The kernel releases
+flocks of dead processes, so a crashed leader can't wedge its duplicates.
+
+Errors are shared: duplicates that were waiting get the leader's error, as
+they would have hit it themselves, but nothing is remembered afterwards. If
+the leader is cancelled (its client disconnected, the worker is shutting
+down) no result is published and one of the waiting duplicates takes over.
+A duplicate that has waited SINGLEFLIGHT_TIMEOUT runs on its own.
+
+Configuration (environment):
+  SINGLEFLIGHT          coalesce identical concurrent requests (default true)
+  SINGLEFLIGHT_DIR      directory for the cross-process lock and result files (default
+                        empty = within a process only; gunicorn.conf.py sets
+                        <tmp>/vibe-singleflight when it starts more than one worker)
+  SINGLEFLIGHT_TIMEOUT  seconds a duplicate waits before running on its own (default 120)
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: coalesce within a process only
+    fcntl = None
+
+from metrics import REGISTRY
+
+COALESCED = REGISTRY.counter(
+    'singleflight_coalesced_total',
+    'Requests answered by a concurrent identical request, by scope (thread: same worker, process: another worker)')
+
+# Result files only need to outlive the duplicates' next poll
+RESULT_TTL = 10.0
+POLL_INITIAL = 0.01
+POLL_MAX = 0.1
+
+# Set on an in-process call whose leader went away without an answer
+_ABANDONED = object()
+
+
+class CoalescedError(Exception):
+    """The leader in another worker failed; `error` and `message` are what it reported"""
+
+    def __init__(self, error, message):
+        super().__init__(message)
+        self.error = error
+        self.message = message
+
+
+def _lock(path):
+    """A held flock on `path`, or None if another process holds it"""
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            current = os.stat(path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            current = False
+        if current:
+            return fd
+        os.close(fd)  # Locked a file its previous holder had already removed; try the new one
+
+
+def _unlock(path, fd):
+    # Whoever holds the lock removes it, so lock files don't pile up
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+
+
+class Flight:
+    """
+    One request's place in a single flight; use as a context manager.
+    After entering, `output` is the output of a concurrent duplicate, or
+    None if this request has to do the work itself and resolve() it.
+    """
+
+    def __init__(self, group, key):
+        self.group = group
+        self.key = key
+        self.output = None
+        self.coalesced = False
+        self.resolved = False
+        self._call = None  # our future while leading in this process
+        self._lock_fd = None  # while leading across processes
+
+    def __enter__(self):
+        self.group._join(self)
+        return self
+
+    def resolve(self, output):
+        self.output = output
+        self.resolved = True
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.group._leave(self, exc)
+        return False
+
+
+class SingleFlight:
+    def __init__(self, directory=None, timeout=120.0):
+        self.directory = directory if fcntl is not None else None
+        self.timeout = timeout
+        self._calls = {}  # key -> Future of the in-process leader
+        self._lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def flight(self, data):
+        return Flight(self, hashlib.sha256(data).hexdigest())
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _join(self, flight):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._lock:
+                call = self._calls.get(flight.key)
+                if call is None:
+                    call = self._calls[flight.key] = Future()
+                    flight._call = call
+            if flight._call is not None:
+                break
+            try:
+                output = call.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeout:
+                return  # Waited long enough; run without coalescing
+            except Exception:
+                COALESCED.inc(scope='thread')
+                raise
+            if output is not _ABANDONED:
+                COALESCED.inc(scope='thread')
+                flight.output, flight.coalesced = output, True
+                return
+            # The leader was cancelled; the next one in line takes over
+
+        if self.directory:
+            try:
+                record = self._join_processes(flight, deadline)
+            except BaseException as e:
+                self._leave(flight, e)
+                raise
+            if record is not None:
+                COALESCED.inc(scope='process')
+                if 'output' not in record:
+                    error = CoalescedError(record['error'], record['message'])
+                    self._leave(flight, error)
+                    raise error
+                flight.resolve(record['output'])
+                flight.coalesced = True
+
+    def _join_processes(self, flight, deadline):
+        """The record another worker published for this key, or None once this worker leads (or gave up waiting)"""
+        lock_path = self._path(flight.key, '.lock')
+        since = time.time()
+        delay = POLL_INITIAL
+        while True:
+            fd = _lock(lock_path)
+            if fd is not None:
+                record = self._read(flight.key, since)
+                if record is None:
+                    flight._lock_fd = fd
+                    return None
+                _unlock(lock_path, fd)
+                return record
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX)
+
+    def _read(self, key, since):
+        """The result published for `key` at or after `since`, if any"""
+        try:
+            with open(self._path(key, '.json')) as result_file:
+                record = json.load(result_file)
+        except (OSError, ValueError):
+            return None
+        return record if record.get('created', 0) >= since else None
+
+    def _publish(self, key, record):
+        record['created'] = time.time()
+        path = self._path(key, '.json')
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as result_file:
+            json.dump(record, result_file)
+        os.replace(temporary, path)
+
+        # Sweep results nobody can still be waiting for
+        expired = time.time() - RESULT_TTL
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.directory, name)) < expired:
+                    os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _leave(self, flight, exc):
+        call = flight._call
+        if call is None:
+            return  # A duplicate, or one that stopped waiting
+        flight._call = None
+
+        # Errors are handed on; cancellations (GeneratorExit, SystemExit, ...) are not
+        failed = not flight.resolved and isinstance(exc, Exception)
+        if flight._lock_fd is not None:
+            try:
+                if flight.resolved:
+                    self._publish(flight.key, {'output': flight.output})
+                elif failed:
+                    self._publish(flight.key, {'error': getattr(exc, 'error', type(exc).__name__),
+                                               'message': getattr(exc, 'message', str(exc))})
+            except (OSError, TypeError, ValueError) as e:
+                print(f"Warning: Could not publish a single-flight result: {e}")
+            finally:
+                _unlock(self._path(flight.key, '.lock'), flight._lock_fd)
+                flight._lock_fd = None
+
+        with self._lock:
+            self._calls.pop(flight.key, None)
+        if flight.resolved:
+            call.set_result(flight.output)
+        elif failed:
+            call.set_exception(exc)
+        else:
+            call.set_result(_ABANDONED)
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # In-flight calls and held locks belong to the parent
+    global _single_flight, _single_flight_lock
+    _single_flight = None
+    _single_flight_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_single_flight():
+    """The process-wide SingleFlight, or None when SINGLEFLIGHT=false"""
+    global _single_flight
+    if os.getenv('SINGLEFLIGHT', 'true').lower() != 'true':
+        return None
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight(
+                    directory=os.getenv('SINGLEFLIGHT_DIR') or None,
+                    timeout=float(os.getenv('SINGLEFLIGHT_TIMEOUT', '120')),
+                )
+    return _single_flight
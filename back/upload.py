@@ -0,0 +1,225 @@
+"""
+Image upload validation while the request body is still arriving.
+
+By default werkzeug spools each uploaded file (to a temporary file once the
+request is over 500KB), and junk only fails once the pipeline tries to
+decode it. ImageUploadStream is written to by the multipart parser instead
+and looks at the first bytes as they come in:
+
+  - the magic bytes must identify a supported format; the extension isn't
+    trusted, since misnamed files (a WebP saved as .png) are common and
+    decode fine
+  - the dimensions are read from the header in the first few KB, without
+    decoding any pixels, and must fit the pixel budget; this is also what
+    stops decompression bombs (small files declaring enormous images)
+
+Raising from the stream aborts the form parsing, so a rejected upload is
+answered before the rest of its body is read. Files are kept in memory,
+bounded by MAX_CONTENT_LENGTH.
+
+decode_image() is the one place uploads are decoded: it checks the budget
+again, decodes only the first frame of an animated GIF or WebP, and lets
+JPEGs decode at a reduced DCT scale (draft mode) when the pipeline would
+shrink them anyway.
+
+Configuration (environment):
+  UPLOAD_MAX_PIXELS  largest accepted width x height (default 40000000)
+"""
+import io
+import os
+
+from PIL import Image
+
+from preprocess import vision_target_size
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'avif'}
+
+MAGIC_NUMBERS = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+)
+AVIF_BRANDS = (b'avif', b'avis')
+# Enough to tell every format above apart, including RIFF....WEBP and ....ftypavif
+SNIFF_BYTES = 12
+# Give up on a header that hasn't parsed by then (JPEG EXIF blocks can be up to 64KB)
+HEADER_LIMIT = 256 * 1024
+
+
+def _max_pixels():
+    return int(os.getenv('UPLOAD_MAX_PIXELS', '40000000'))
+
+
+class UploadRejected(Exception):
+    """An upload that isn't worth decoding; `status` is the HTTP status to answer with"""
+
+    def __init__(self, error, message, status=400):
+        super().__init__(message)
+        self.error = error
+        self.message = message
+        self.status = status
+
+
+def allowed_extension(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def sniff_format(head):
+    """The Pillow format name from the file's magic bytes, or None"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    if head[4:8] == b'ftyp' and head[8:12] in AVIF_BRANDS:
+        return 'AVIF'
+    for magic, image_format in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return image_format
+    return None
+
+
+def _webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8X' and len(head) >= 30:
+        return 1 + int.from_bytes(head[24:27], 'little'), 1 + int.from_bytes(head[27:30], 'little')
+    if chunk == b'VP8 ' and len(head) >= 30 and head[23:26] == b'\x9d\x01\x2a':
+        return int.from_bytes(head[26:28], 'little') & 0x3fff, int.from_bytes(head[28:30], 'little') & 0x3fff
+    if chunk == b'VP8L' and len(head) >= 25:
+        bits = int.from_bytes(head[21:25], 'little')
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    return None
+
+
+def _avif_size(head):
+    # The image spatial extents ('ispe') property: version/flags, then 32-bit width and height
+    index = head.find(b'ispe')
+    if index < 0 or len(head) < index + 16:
+        return None
+    return int.from_bytes(head[index + 8:index + 12], 'big'), int.from_bytes(head[index + 12:index + 16], 'big')
+
+
+def header_size(head, image_format):
+    """(width, height) from the start of a file, or None if more bytes are needed"""
+    # Pillow hands the whole file to libwebp/libavif to open these, so read their headers ourselves
+    if image_format == 'WEBP':
+        return _webp_size(head)
+    if image_format == 'AVIF':
+        return _avif_size(head)
+    try:
+        with Image.open(io.BytesIO(head), formats=[image_format]) as image:
+            return image.size
+    except Image.DecompressionBombError as e:
+        raise UploadRejected('Image too large', str(e), 413)
+    except (OSError, SyntaxError, ValueError):
+        # Truncated header (or not an image after all)
+        return None
+
+
+def check_pixels(size, max_pixels=None):
+    if max_pixels is None:
+        max_pixels = _max_pixels()
+    width, height = size
+    if width * height > max_pixels:
+        raise UploadRejected(
+            'Image too large',
+            f'The image is {width}x{height}; please upload an image of at most {max_pixels // 1000000} megapixels',
+            413,
+        )
+
+
+class ImageUploadStream(io.BytesIO):
+    """
+    In-memory file for one uploaded image that checks the format and
+    dimensions as soon as enough of it has been written. With abort=False a
+    bad file is recorded in `rejection` and the rest of it is discarded.
+    """
+
+    def __init__(self, filename=None, max_pixels=None, abort=True):
+        super().__init__()
+        # An empty filename is "no file selected", which the endpoints report themselves
+        self.enabled = bool(filename)
+        self.filename = filename
+        self.max_pixels = max_pixels if max_pixels is not None else _max_pixels()
+        self.abort = abort
+        self.format = None
+        self.size = None
+        self.rejection = None
+        self._next_inspection = SNIFF_BYTES
+
+    def write(self, data):
+        if self.rejection is not None:
+            return len(data)
+        written = super().write(data)
+        if self.enabled and self.size is None and self.tell() >= self._next_inspection:
+            # Each look re-reads everything so far; waiting for the buffer to double
+            # keeps that linear in the upload however small the chunks are
+            self._next_inspection = min(2 * self.tell(), HEADER_LIMIT)
+            try:
+                self._inspect(final=False)
+            except UploadRejected as e:
+                self._reject(e)
+        return written
+
+    def _reject(self, rejection):
+        self.rejection = rejection
+        self.seek(0)
+        self.truncate()
+        if self.abort:
+            raise rejection
+
+    def _inspect(self, final):
+        head = self.getvalue()
+        if self.format is None:
+            if len(head) < SNIFF_BYTES and not final:
+                return
+            if not allowed_extension(self.filename):
+                raise UploadRejected(
+                    'Invalid file type',
+                    f'Please upload an image in one of these formats: {", ".join(sorted(ALLOWED_EXTENSIONS)).upper()}',
+                )
+            self.format = sniff_format(head)
+            if self.format is None:
+                raise UploadRejected(
+                    'Invalid image', f"'{self.filename}' is not a PNG, JPEG, GIF, BMP, WebP or AVIF image", 415)
+        size = header_size(head, self.format)
+        if size is None:
+            if final or len(head) >= HEADER_LIMIT:
+                raise UploadRejected('Invalid image', f"Could not read the image header of '{self.filename}'")
+            return
+        check_pixels(size, self.max_pixels)
+        self.size = size
+
+    def validate(self):
+        """Raise UploadRejected if the upload was rejected or its header never parsed"""
+        if self.enabled and self.rejection is None and self.size is None:
+            position = self.tell()
+            try:
+                self._inspect(final=True)
+            except UploadRejected as e:
+                self.rejection = e
+            self.seek(position)
+        if self.rejection is not None:
+            raise self.rejection
+
+
+def decode_image(image_data, max_side=None):
+    """
+    Decode the first frame of an encoded image, checking the pixel budget
+    before any pixel data is read. JPEGs are decoded at the smallest DCT
+    scale that still covers the vision size (max_side as for
+    resize_for_vision), so big photos skip most of the decoding work.
+    Raises UploadRejected for files that don't decode (e.g. truncated ones).
+    """
+    try:
+        image = Image.open(io.BytesIO(image_data))
+        check_pixels(image.size)
+        # Only JPEG supports draft mode; for other formats this is a no-op.
+        # vision_target_size is symmetric, so EXIF rotation applied later doesn't matter
+        image.draft('RGB', vision_target_size(image.size, max_side))
+        # load() decodes the current frame only, which is the first one after open()
+        image.load()
+    except Image.DecompressionBombError as e:
+        raise UploadRejected('Image too large', str(e), 413)
+    except (OSError, SyntaxError, ValueError) as e:
+        raise UploadRejected('Invalid image', f'The image could not be decoded: {e}')
+    return image
@@ -0,0 +1,175 @@
+"""
+Startup warm-up and readiness.
+
+Importing the app is kept cheap: onnxruntime/rembg, the OpenAI SDK and
+stripe are loaded on first use rather than at import time, so a new
+instance binds its port quickly. The expensive part happens here instead,
+explicitly: import the heavy libraries, then, in a background thread, load
+the U2NetP sessions (which runs a dummy inference through each, or starts
+the segmentation workers, see segmentation_service.py) and create the
+OpenAI and Stripe clients. /ready reports 503 until it has finished, while
+/health answers as soon as the process is up.
+
+In background mode the imports run on the warm-up thread too, so
+`import app` returns before any of them. rembg pulls in pymatting, whose
+numba kernels initialise numba's threading layer on import; the TBB layer,
+initialised from a non-main thread, leaves the interpreter hanging at exit,
+so unless NUMBA_THREADING_LAYER says otherwise the background warm-up uses
+numba's own workqueue layer. Under gunicorn the master has already imported
+them (see when_ready), so this stage costs workers nothing.
+
+Configuration (environment):
+  STARTUP_WARMUP   background (default), blocking, or off
+"""
+import atexit
+import importlib
+import os
+import threading
+import time
+
+import openai_client
+import payments
+from segmentation_service import get_segmenter
+
+# Libraries too slow to import on the request path
+HEAVY_MODULES = ('numpy', 'onnxruntime', 'rembg', 'openai', 'stripe')
+
+# Seconds an exiting process waits for an unfinished warm-up
+EXIT_JOIN_TIMEOUT = 60
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def preload_modules():
+    """Import the heavy libraries, e.g. in a gunicorn master before it forks"""
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+
+
+def _warm_openai():
+    openai_client.warm_up()
+    return DONE if os.getenv('OPENAI_API_KEY') else SKIPPED
+
+
+def _warm_stripe():
+    payments.warm_up()
+    return DONE if os.getenv('STRIPE_SECRET_KEY') else SKIPPED
+
+
+class WarmUp:
+    """Runs the warm-up stages in order and records how each went"""
+
+    def __init__(self):
+        self.stages = [
+            ('imports', preload_modules),
+            ('session_pool', lambda: get_segmenter().warm_up()),
+            ('openai', _warm_openai),
+            ('stripe', _warm_stripe),
+        ]
+        # The service can't segment anything until these have succeeded
+        self.required = {'imports', 'session_pool'}
+        self._lock = threading.Lock()
+        self._state = {name: {'status': PENDING} for name, _ in self.stages}
+        self._thread = None
+        self._started = None
+        self._finished = None
+
+    def _run_stage(self, name, stage):
+        self._update(name, status=RUNNING)
+        start = time.perf_counter()
+        try:
+            outcome = stage()
+        except Exception as e:
+            print(f"Warning: Warm-up stage '{name}' failed: {e}")
+            self._update(name, status=FAILED, error=str(e))
+        else:
+            self._update(name, status=outcome if outcome in (DONE, SKIPPED) else DONE)
+        self._update(name, seconds=round(time.perf_counter() - start, 3))
+
+    def _run_stages(self, stages):
+        for name, stage in stages:
+            self._run_stage(name, stage)
+        with self._lock:
+            self._finished = time.time()
+
+    def run(self):
+        """Run every stage on the calling thread"""
+        with self._lock:
+            self._started = time.time()
+        self._run_stages(self.stages)
+
+    def start(self):
+        """Run every stage in a background thread (once)"""
+        with self._lock:
+            if self._thread is not None:
+                return self
+            self._started = time.time()
+            self._thread = threading.Thread(target=self._run_stages, args=(self.stages,),
+                                            name='warm-up', daemon=True)
+        # TBB hangs the exit when first initialised off the main thread
+        os.environ.setdefault('NUMBA_THREADING_LAYER', 'workqueue')
+        self._thread.start()
+        # Exiting mid-way through loading onnxruntime aborts the interpreter
+        atexit.register(self._thread.join, EXIT_JOIN_TIMEOUT)
+        return self
+
+    def _update(self, name, **fields):
+        with self._lock:
+            self._state[name].update(fields)
+
+    def status(self):
+        """(ready, report): ready once every required stage is done"""
+        with self._lock:
+            stages = {name: dict(state) for name, state in self._state.items()}
+            finished = self._finished
+            started = self._started
+        ready = all(stages[name]['status'] == DONE for name in self.required)
+        report = {
+            'ready': ready,
+            'finished': finished is not None,
+            'seconds': round((finished or time.time()) - started, 3) if started else None,
+            'stages': stages,
+        }
+        return ready, report
+
+
+_warm_up = None
+_warm_up_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # The warm-up thread and everything it loaded belong to the parent
+    global _warm_up, _warm_up_lock
+    _warm_up = None
+    _warm_up_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_warm_up():
+    """The process-wide warm-up, not started until start_warm_up() is called"""
+    global _warm_up
+    if _warm_up is None:
+        with _warm_up_lock:
+            if _warm_up is None:
+                _warm_up = WarmUp()
+    return _warm_up
+
+
+def start_warm_up(mode=None):
+    """
+    Start warming up according to `mode` (default STARTUP_WARMUP):
+    'background' returns immediately, 'blocking' waits, 'off' does nothing.
+    """
+    mode = (mode or os.getenv('STARTUP_WARMUP', 'background')).lower()
+    warm_up = get_warm_up()
+    if mode == 'blocking':
+        warm_up.run()
+    elif mode != 'off':
+        warm_up.start()
+    return warm_up
@@ -20,6 +20,7 @@ function App() {
   const [confettiEmoji, setConfettiEmoji] = useState("");
   const [showPaymentPopup, setShowPaymentPopup] = useState(false);
   const [hasPaid, setHasPaid] = useState(false);
+  const [usageToken, setUsageToken] = useState(null);
 
   // Example images for the carousel
   const exampleImages = [
@@ -385,7 +386,7 @@ function App() {
   }, [result]); // Effect runs whenever the 'result' state changes
 
   // Allowed file extensions for images
-  const ALLOWED_EXTENSIONS = ["png", "jpg", "jpeg", "gif", "bmp"];
+  const ALLOWED_EXTENSIONS = ["png", "jpg", "jpeg", "gif", "bmp", "webp", "avif"];
 
   /**
    * Handles the selection of an image file, setting it as the selected file
@@ -499,7 +500,7 @@ function App() {
   /**
    * Performs the actual image analysis by sending the image to the backend API.
    */
-  const performAnalysis = async () => {
+  const performAnalysis = async (token = usageToken) => {
     setIsLoading(true);
     setError(null);
     setResult(null);
@@ -523,6 +524,7 @@ function App() {
       const response = await fetch(`${apiUrl}/predict`, {
         method: "POST",
         body: formData,
+        headers: token ? { Authorization: `Bearer ${token}` } : {},
       });
 
       // console.log("📡 Response status:", response.status);
@@ -547,6 +549,7 @@ function App() {
         // console.log("🦁 Extracted animal name:", animalName);
 
         setResult(data.result); // Set the analysis result
+        setUsageToken(null); // Tokens are single-use
       } else {
         // console.error("❌ API call failed");
         // console.error("❌ Error data:", data);
@@ -565,11 +568,12 @@ function App() {
   /**
    * Callback function for successful payment. Sets payment status and proceeds with analysis.
    */
-  const handlePaymentSuccess = () => {
+  const handlePaymentSuccess = (token) => {
     setHasPaid(true);
+    setUsageToken(token);
     setShowPaymentPopup(false);
     // Automatically proceed with analysis after successful payment
-    performAnalysis();
+    performAnalysis(token);
   };
 
   /**
@@ -13,10 +13,38 @@ const stripePromise = loadStripe(
   import.meta.env.VITE_STRIPE_PUBLISHABLE_KEY || ""
 );
 
+/**
+ * Exchanges a paid intent for a usage token, retrying while the backend
+ * waits for Stripe's webhook confirming the payment.
+ */
+const fetchUsageToken = async (apiUrl, paymentIntentId, attempts = 15) => {
+  for (let attempt = 0; attempt < attempts; attempt++) {
+    const response = await fetch(`${apiUrl}/payment-token`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({ payment_intent: paymentIntentId }),
+    });
+    if (response.status === 200) {
+      const { token } = await response.json();
+      return token;
+    }
+    if (response.status !== 202) {
+      break;
+    }
+    const retryAfter = Number(response.headers.get("Retry-After")) || 1;
+    await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+  }
+  throw new Error("Payment confirmation timed out");
+};
+
 const PaymentForm = ({ onSuccess, onCancel, isLoading, setIsLoading }) => {
   const stripe = useStripe();
   const elements = useElements();
   const [error, setError] = useState(null);
+  // One key per checkout, so a retried submit can't create a second intent
+  const [idempotencyKey] = useState(() => crypto.randomUUID());
 
   const handleSubmit = async (event) => {
     event.preventDefault();
@@ -35,6 +63,7 @@ const PaymentForm = ({ onSuccess, onCancel, isLoading, setIsLoading }) => {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
+          "Idempotency-Key": idempotencyKey,
         },
         body: JSON.stringify({
           amount: 99, // 99 cents
@@ -56,7 +85,7 @@ const PaymentForm = ({ onSuccess, onCancel, isLoading, setIsLoading }) => {
       if (paymentError) {
         setError(paymentError.message);
       } else if (paymentIntent.status === "succeeded") {
-        onSuccess();
+        onSuccess(await fetchUsageToken(apiUrl, paymentIntent.id));
       }
     } catch (err) {
       setError("Payment failed. Please try again.");